@@ -1,26 +1,519 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import os
 from datetime import datetime
 import re
 import codecs
 import csv
+import time
+import threading
+import asyncio
+import math
+import sys
+import bisect
+import mmap
+import sqlite3
+from array import array
+import hashlib
+import hmac
+import logging
+import logging.handlers
+import queue
+import random
+import atexit
+import heapq
+import itertools
+from collections import defaultdict, OrderedDict
+from collections.abc import Sequence
+from contextlib import contextmanager, asynccontextmanager
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+# semantic retrieval ใช้ได้เมื่อมี numpy (sentence-transformers สำหรับโมเดลบน CPU)
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+# Levenshtein similarity (0-1): python-Levenshtein > fuzzywuzzy > difflib
+try:
+    from Levenshtein import ratio as levenshtein_ratio
+except ImportError:
+    try:
+        from fuzzywuzzy import fuzz
+
+        def levenshtein_ratio(a, b):
+            return fuzz.ratio(a, b) / 100
+    except ImportError:
+        from difflib import SequenceMatcher
+
+        def levenshtein_ratio(a, b):
+            return SequenceMatcher(None, a, b).ratio()
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
 
 # Configuration
-CHAT_API_URL = "http://209.15.123.47:11434/api/generate"
+CHAT_API_URL = os.environ.get('CHAT_API_URL', "http://209.15.123.47:11434/api/generate")  # คำตอบแชทส่งไป /api/chat บน server เดียวกัน
 CHAT_MODEL = "Qwen3:14b"
 DEFAULT_SHEET_ID = "1_YcWW9AWew9afLVk08Tl5lN4iQMhxiQDz4qU3LsB-iE"
+GOOGLE_SHEETS_BASE_URL = os.environ.get('GOOGLE_SHEETS_BASE_URL', "https://docs.google.com/spreadsheets/d")
+SHEET_CACHE_TTL = int(os.environ.get('SHEET_CACHE_TTL', 60))  # seconds
+# Refresh แบบ incremental: patch index/response cache เมื่อแถวที่เปลี่ยนไม่เกินสัดส่วนนี้
+INCREMENTAL_REFRESH_MAX_FRACTION = float(os.environ.get('INCREMENTAL_REFRESH_MAX_FRACTION', 0.2))
+SOURCE_FETCH_WORKERS = int(os.environ.get('SOURCE_FETCH_WORKERS', 4))  # ดาวน์โหลดหลายแหล่งข้อมูลพร้อมกัน
+# แหล่งข้อมูลในเครื่อง (CSV / SQLite) - อ่านได้เฉพาะไฟล์ภายใต้โฟลเดอร์นี้
+LOCAL_DATA_DIR = os.path.abspath(os.environ.get('LOCAL_DATA_DIR', 'data'))
+LOCAL_CSV_MEMORY_MAX_BYTES = int(os.environ.get('LOCAL_CSV_MEMORY_MAX_BYTES', 20 * 2**20))  # ใหญ่กว่านี้ค้นผ่าน mmap
+SQLITE_BUILD_FTS = os.environ.get('SQLITE_BUILD_FTS', '1') == '1'
+# FTS5 index ของตาราง SQLite เก็บเป็นไฟล์แยก - ไม่เขียนลงฐานข้อมูลของผู้ใช้
+SQLITE_FTS_DIR = os.path.abspath(os.environ.get('SQLITE_FTS_DIR', 'fts'))
+# Semantic retrieval - เวกเตอร์ของแถวเก็บเป็นไฟล์ .npy (memory-mapped) ต่อ snapshot
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'bge-m3')  # Ollama embedding model ที่รองรับภาษาไทย
+LOCAL_EMBEDDING_MODEL = os.environ.get('LOCAL_EMBEDDING_MODEL', 'intfloat/multilingual-e5-small')
+EMBEDDING_STORE_DIR = os.path.abspath(os.environ.get('EMBEDDING_STORE_DIR', 'embeddings'))
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 64))
+EMBEDDING_TIMEOUT = float(os.environ.get('EMBEDDING_TIMEOUT', 60))
+# embed คำถามอยู่บนเส้นทางของแชท: timeout สั้น และพักการค้นหาตามความหมายเมื่อล้มเหลวติดกัน
+EMBEDDING_QUERY_TIMEOUT = float(os.environ.get('EMBEDDING_QUERY_TIMEOUT', 2))
+EMBEDDING_QUERY_FAILURES = int(os.environ.get('EMBEDDING_QUERY_FAILURES', 3))
+EMBEDDING_QUERY_COOLDOWN = float(os.environ.get('EMBEDDING_QUERY_COOLDOWN', 30))
+
+# HTTP connection pools (ต่อ process)
+MODEL_HTTP_POOL_SIZE = int(os.environ.get('MODEL_HTTP_POOL_SIZE', 10))
+MODEL_HTTP_TIMEOUT = float(os.environ.get('MODEL_HTTP_TIMEOUT', 30))
+SHEETS_HTTP_POOL_SIZE = int(os.environ.get('SHEETS_HTTP_POOL_SIZE', 4))
+SHEETS_HTTP_TIMEOUT = float(os.environ.get('SHEETS_HTTP_TIMEOUT', 10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.3))
+
+# ข้อความตอบกลับเมื่อเรียกโมเดลไม่สำเร็จ (ไม่เก็บลง response cache)
+AI_CONNECTION_ERROR = "ขออภัย เกิดข้อผิดพลาดในการเชื่อมต่อ AI"
+AI_PROCESSING_ERROR = "เกิดข้อผิดพลาดในการประมวลผล โปรดลองใหม่อีกครั้ง"
+AI_ERROR_RESPONSES = (AI_CONNECTION_ERROR, AI_PROCESSING_ERROR)
+
+# Response cache สำหรับคำถามซ้ำ
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 600))  # seconds
+
+# Health check ของ AI backend (ใช้ /api/tags, /api/version แทนการสั่งให้โมเดลตอบ)
+HEALTH_CACHE_TTL = float(os.environ.get('HEALTH_CACHE_TTL', 15))  # seconds
+HEALTH_TIMEOUT = float(os.environ.get('HEALTH_TIMEOUT', 3))
+
+# Ollama /api/chat - คำตอบที่ load_duration เกินค่านี้นับเป็น cold start (ต้องโหลดโมเดลใหม่)
+MODEL_COLD_LOAD_MS = float(os.environ.get('MODEL_COLD_LOAD_MS', 500))
+MODEL_WARMUP = os.environ.get('MODEL_WARMUP', '1') == '1'
+
+# Admission control ของการเรียกโมเดล (ต่อ process - ทั้งระบบคือค่านี้ x จำนวน worker)
+# จำนวนที่ส่งให้ Ollama พร้อมกัน, ความยาวคิว, เวลารอสูงสุดในคิว
+MODEL_MAX_IN_FLIGHT = int(os.environ.get('MODEL_MAX_IN_FLIGHT', 2))
+MODEL_MAX_QUEUE = int(os.environ.get('MODEL_MAX_QUEUE', 16))
+MODEL_QUEUE_TIMEOUT = float(os.environ.get('MODEL_QUEUE_TIMEOUT', 20))  # seconds
+MODEL_BUSY_RETRY_AFTER = int(os.environ.get('MODEL_BUSY_RETRY_AFTER', 5))  # seconds
+MODEL_BUSY_MESSAGE = "ขณะนี้มีผู้ใช้งานจำนวนมาก กรุณาลองใหม่อีกครั้งในอีกสักครู่"
+
+# Model backend pool - หลาย Ollama host / โมเดล; MODEL_BACKENDS เป็น JSON เช่น
+# [{"url": "http://gpu1:11434", "model": "Qwen3:14b"}, {"url": "http://gpu2:11434", "model": "qwen3:1.7b", "role": "small"}]
+SMALL_CHAT_MODEL = os.environ.get('SMALL_CHAT_MODEL', '')  # โมเดลเล็กบน host หลัก สำหรับคำขอดูข้อมูล
+MODEL_BACKENDS = json.loads(os.environ['MODEL_BACKENDS']) if os.environ.get('MODEL_BACKENDS') else (
+    [{'url': CHAT_API_URL, 'model': CHAT_MODEL, 'role': 'chat'}] +
+    ([{'url': CHAT_API_URL, 'model': SMALL_CHAT_MODEL, 'role': 'small'}] if SMALL_CHAT_MODEL else [])
+)
+MODEL_EJECT_FAILURES = int(os.environ.get('MODEL_EJECT_FAILURES', 3))  # ผิดพลาดติดกันกี่ครั้งจึงพัก backend
+MODEL_EJECT_SECONDS = float(os.environ.get('MODEL_EJECT_SECONDS', 30))
+PROCESS_STARTED_AT = time.time()
 
 # Default login credentials
 DEFAULT_USER = "admin"
 DEFAULT_PASSWORD = "password"
 
+# Credential store ที่สร้างจากชีต (คอลัมน์ A = ชื่อผู้ใช้, B = รหัสผ่าน)
+LOGIN_NEGATIVE_CACHE_TTL = float(os.environ.get('LOGIN_NEGATIVE_CACHE_TTL', 60))  # seconds
+LOGIN_NEGATIVE_CACHE_SIZE = int(os.environ.get('LOGIN_NEGATIVE_CACHE_SIZE', 1024))
+
+# Logging - ระดับ, รูปแบบ (text | json), สัดส่วน log ระดับ DEBUG ที่เก็บ และขนาดคิว
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 1.0))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 0.05))  # seconds
+
+logger = logging.getLogger('custom_ai')
+
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+def _log_fields(record):
+    """Fields passed with ``extra=`` on a log call"""
+    return {key: value for key, value in vars(record).items() if key not in _LOG_RECORD_FIELDS}
+
+class JSONLogFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any ``extra`` fields"""
+    
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            **_log_fields(record)
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    """``time LEVEL logger: message key=value ...``"""
+    
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        return line + ''.join(f" {key}={value}" for key, value in _log_fields(record).items())
+
+class DebugSampler(logging.Filter):
+    """Keep every INFO-or-higher record and a random ``rate`` share of DEBUG records"""
+    
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.sampled_out = 0
+    
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Queue records for the writer thread; never blocks the request thread.
+
+    Records are queued unformatted (message, arguments and traceback are
+    rendered by the listener), and a full queue drops the record and counts
+    it instead of waiting.
+    """
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LingeringQueueListener(logging.handlers.QueueListener):
+    """QueueListener that, once the queue is empty, waits ``LOG_FLUSH_INTERVAL``
+    before blocking again, so records arriving in a burst are written in
+    one wake-up of the writer thread instead of one per record."""
+    
+    def dequeue(self, block):
+        if block and self.queue.empty():
+            time.sleep(LOG_FLUSH_INTERVAL)
+        return self.queue.get(block)
+    
+    def enqueue_sentinel(self):
+        # คิวอาจเต็มตอนหยุด - รอให้ listener ระบายก่อน
+        self.queue.put(self._sentinel)
+
+_log_config = {}
+_log_handler = None
+_log_listener = None
+
+def _start_log_listener():
+    global _log_handler, _log_listener
+    output = logging.StreamHandler(_log_config['stream'] or sys.stderr)
+    output.setFormatter(JSONLogFormatter() if _log_config['format'] == 'json' else TextLogFormatter())
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(DebugSampler(_log_config['sample_rate']))
+    if _log_handler is not None:
+        logger.removeHandler(_log_handler)
+    logger.addHandler(handler)
+    _log_handler = handler
+    _log_listener = LingeringQueueListener(handler.queue, output)
+    _log_listener.start()
+
+def stop_logging():
+    """Write out everything still queued (called at exit)"""
+    if _log_listener is not None and _log_listener._thread is not None:
+        _log_listener.stop()
+
+def configure_logging(level=None, log_format=None, sample_rate=None, stream=None):
+    """(Re)configure the app logger.
+
+    Log calls only put the record on a bounded queue; one listener thread
+    formats and writes them to ``stream`` (stderr by default). Records below
+    ``level`` cost one level check and nothing else.
+    """
+    stop_logging()
+    _log_config.update({
+        'format': log_format or LOG_FORMAT,
+        'sample_rate': LOG_DEBUG_SAMPLE_RATE if sample_rate is None else sample_rate,
+        'stream': stream
+    })
+    logger.setLevel(level or LOG_LEVEL)
+    logger.propagate = False
+    _start_log_listener()
+
+def get_logging_stats():
+    sampler = _log_handler.filters[0]
+    return {
+        'level': logging.getLevelName(logger.level),
+        'format': _log_config['format'],
+        'debug_sample_rate': sampler.rate,
+        'queued': _log_handler.queue.qsize(),
+        'dropped': _log_handler.dropped,
+        'sampled_out': sampler.sampled_out
+    }
+
+configure_logging()
+atexit.register(stop_logging)
+# worker ที่ fork มาจาก gunicorn --preload ไม่มี thread ของ listener - เริ่มใหม่ในแต่ละ worker
+os.register_at_fork(after_in_child=_start_log_listener)
+
+# ---------------------------------------------------------------------------
+# Metrics - เวลาแต่ละขั้นของ pipeline แชท, สถานะ upstream, ขนาด prompt/คำตอบ (ต่อ process)
+# ---------------------------------------------------------------------------
+
+METRICS_PREFIX = 'custom_ai_'
+# Prometheus ใช้ "Authorization: Bearer <token>"; ถ้าไม่ตั้งค่า /metrics เปิดให้เฉพาะผู้ที่เข้าสู่ระบบ
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# name -> (type, help, buckets) - ลำดับนี้คือลำดับใน /metrics
+METRIC_DEFINITIONS = {
+    'stage_duration_seconds': (
+        'histogram', 'Time spent in each chat pipeline stage',
+        (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    ),
+    'prompt_chars': (
+        'histogram', 'Characters sent to the model per request (system prompt, context and question)',
+        (500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+    ),
+    'response_chars': (
+        'histogram', 'Characters in each fresh model answer',
+        (50, 100, 250, 500, 1000, 2000, 4000, 8000)
+    ),
+    'model_tokens_per_second': (
+        'histogram', 'Generation speed reported by Ollama (eval_count / eval_duration)',
+        (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500)
+    ),
+    'upstream_responses_total': ('counter', 'Upstream HTTP responses by status code (error = no response)', None),
+    'chat_requests_total': ('counter', 'Chat requests answered, by endpoint and response cache result', None),
+    'model_shed_total': ('counter', 'Model calls rejected by the scheduler, by priority and reason', None),
+    'model_backend_calls_total': ('counter', 'Model calls per pool backend (model@url) and outcome', None),
+}
+
+class Histogram:
+    """Fixed-bucket histogram; quantiles are estimated by interpolating within a bucket"""
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # ช่องสุดท้ายคือ +Inf
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+    
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+class Metrics:
+    """Process-wide counters and histograms, keyed by metric name and labels.
+
+    Every gunicorn worker keeps its own numbers; Prometheus sums the scrapes.
+    """
+    
+    def __init__(self, definitions, prefix=METRICS_PREFIX):
+        self.definitions = definitions
+        self.prefix = prefix
+        self._series = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, name, labels):
+        if name not in self.definitions:
+            raise KeyError(f'Unknown metric: {name}')
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+    
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._series.get(key)
+            if histogram is None:
+                histogram = self._series[key] = Histogram(self.definitions[name][2])
+            histogram.observe(value)
+    
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+    
+    def total(self, name, **labels):
+        """Sum of a counter over every series matching ``labels``"""
+        wanted = {(key, str(value)) for key, value in labels.items()}
+        with self._lock:
+            return sum(value for (series_name, series_labels), value in self._series.items()
+                       if series_name == name and wanted <= set(series_labels))
+    
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+    
+    def _sorted_series(self):
+        with self._lock:
+            items = [
+                (key, (histogram.counts[:], histogram.count, histogram.sum) if isinstance(histogram, Histogram) else histogram)
+                for key, histogram in self._series.items()
+            ]
+        return sorted(items)
+    
+    def prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+        
+        series = self._sorted_series()
+        lines = [
+            f'# HELP {self.prefix}uptime_seconds Seconds since the process started',
+            f'# TYPE {self.prefix}uptime_seconds gauge',
+            f'{self.prefix}uptime_seconds {get_uptime_seconds():.3f}'
+        ]
+        for name, (metric_type, help_text, buckets) in self.definitions.items():
+            full_name = self.prefix + name
+            lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} {metric_type}')
+            for (series_name, labels), value in series:
+                if series_name != name:
+                    continue
+                if metric_type == 'counter':
+                    lines.append(f'{full_name}{label_text(labels)} {value}')
+                    continue
+                counts, count, total = value
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f'{full_name}_bucket{label_text(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{full_name}_sum{label_text(labels)} {total:.6f}')
+                lines.append(f'{full_name}_count{label_text(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+    
+    def summary(self):
+        """JSON view: count / avg / p50 / p95 / p99 per histogram series, value per counter series"""
+        result = {}
+        for (name, labels), value in self._sorted_series():
+            entry = dict(labels)
+            if self.definitions[name][0] == 'counter':
+                entry['value'] = value
+            else:
+                counts, count, total = value
+                histogram = Histogram(self.definitions[name][2])
+                histogram.counts, histogram.count, histogram.sum = counts, count, total
+                entry.update({
+                    'count': count,
+                    'avg': total / count if count else None,
+                    'p50': histogram.quantile(0.5),
+                    'p95': histogram.quantile(0.95),
+                    'p99': histogram.quantile(0.99)
+                })
+            result.setdefault(name, []).append(entry)
+        return result
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+@contextmanager
+def span(stage):
+    """Time a block (or, as a decorator, a function) into the stage duration histogram.
+
+    Usage: ``with span('search'): ...`` - the time is recorded even when the
+    block raises, so slow failures show up in the same histogram.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('stage_duration_seconds', time.perf_counter() - started, stage=stage)
+
+# จำนวนแชทของวันนี้ (เวลาเครื่อง) สำหรับ dashboard
+_chat_day = {'date': None, 'count': 0}
+_chat_day_lock = threading.Lock()
+
+def count_chat_request(endpoint, cached):
+    metrics.inc('chat_requests_total', endpoint=endpoint, cached=str(bool(cached)).lower())
+    today = datetime.now().date()
+    with _chat_day_lock:
+        if _chat_day['date'] != today:
+            _chat_day['date'], _chat_day['count'] = today, 0
+        _chat_day['count'] += 1
+
+def get_chat_counts():
+    with _chat_day_lock:
+        today = _chat_day['count'] if _chat_day['date'] == datetime.now().date() else 0
+    return {'total': metrics.total('chat_requests_total'), 'today': today}
+
+def get_metrics_summary():
+    """Metrics for dashboard.html - stage latencies in milliseconds"""
+    summary = metrics.summary()
+    for entry in summary.get('stage_duration_seconds', []):
+        for key in ('avg', 'p50', 'p95', 'p99'):
+            if entry[key] is not None:
+                entry[key] = round(entry[key] * 1000, 1)
+    for name in ('prompt_chars', 'response_chars', 'model_tokens_per_second'):
+        for entry in summary.get(name, []):
+            for key in ('avg', 'p50', 'p95', 'p99'):
+                if entry[key] is not None:
+                    entry[key] = round(entry[key], 1)
+    return {
+        'stages_ms': summary.get('stage_duration_seconds', []),
+        'upstream': summary.get('upstream_responses_total', []),
+        'prompt_chars': (summary.get('prompt_chars') or [None])[0],
+        'response_chars': (summary.get('response_chars') or [None])[0],
+        'tokens_per_second': (summary.get('model_tokens_per_second') or [None])[0],
+        'chats': get_chat_counts(),
+        'uptime_seconds': int(get_uptime_seconds()),
+        'timestamp': datetime.now().isoformat()
+    }
+
 # In-memory storage (for demo purposes - in production use database)
+# ค่าที่ /api/settings รับได้ (ค่าอื่นทำให้การค้นหาแบบ fuzzy/semantic ปิดไปเงียบๆ)
+SEARCH_MODES = ('exact', 'fuzzy', 'auto')
+SEMANTIC_SEARCH_MODES = ('off', 'fallback', 'hybrid')
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
 app_settings = {
     'system_prompt': '''คุณเป็น AI Assistant ที่ช่วยค้นหาข้อมูลจาก Google Sheets อย่างชาญฉลาด ตอบคำถามด้วยความเป็นมิตรและให้ข้อมูลที่ถูกต้อง
 
@@ -41,214 +534,3565 @@ app_settings = {
 - จัดรูปแบบข้อมูลให้อ่านง่าย เช่น ใส่หัวข้อ หรือจัดเรียงเป็นรายการ
 - หาก Context มีข้อมูล ให้ตอบจากข้อมูลนั้นเสมอ''',
     'google_sheet_id': DEFAULT_SHEET_ID,
+    # แหล่งข้อมูลทั้งหมด (แท็บ/ชีต, CSV, SQLite) ที่ใช้ค้นหา - รายการแรกคือแหล่งหลัก
+    'data_sources': [{'type': 'sheets', 'sheet_id': DEFAULT_SHEET_ID, 'gid': '0', 'label': 'ข้อมูลหลัก'}],
+    'sheet_cache_ttl': SHEET_CACHE_TTL,
+    'incremental_refresh': os.environ.get('INCREMENTAL_REFRESH', '1') == '1',
+    'search_tokenizer': os.environ.get('SEARCH_TOKENIZER', 'thai'),
+    'search_mode': os.environ.get('SEARCH_MODE', 'auto'),  # exact | fuzzy | auto
+    'fuzzy_threshold': int(os.environ.get('FUZZY_THRESHOLD', 80)),  # 0-100
+    'fuzzy_budget_ms': int(os.environ.get('FUZZY_BUDGET_MS', 50)),
+    # context ที่ส่งให้โมเดล: จำนวนแถวสูงสุด และงบ token โดยประมาณ (Qwen3:14b)
+    'context_max_rows': int(os.environ.get('CONTEXT_MAX_ROWS', 20)),
+    'context_token_budget': int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1500)),
+    # ค้นหาตามความหมาย: off | fallback (เมื่อค้นคำไม่พบ) | hybrid (รวมอันดับกับการค้นคำ)
+    'semantic_search': os.environ.get('SEMANTIC_SEARCH', 'off'),
+    'embedding_backend': os.environ.get('EMBEDDING_BACKEND', 'ollama'),  # ollama | local | hash
+    'semantic_min_score': float(os.environ.get('SEMANTIC_MIN_SCORE', 0.35)),
+    # ให้ Ollama เก็บโมเดลไว้ในหน่วยความจำหลังคำขอล่าสุด (เช่น 30m, 3600, -1 = ตลอด)
+    'model_keep_alive': os.environ.get('OLLAMA_KEEP_ALIVE', '30m'),
+    # พารามิเตอร์การสร้างคำตอบ - ส่งให้ Ollama เป็น options (max_tokens = num_predict)
+    'model_params': {'temperature': 0.3, 'max_tokens': 500, 'top_p': 0.8},
+    # backend ของโมเดล - รายการแรกที่เป็น role chat คือ backend หลัก (health check, dashboard)
+    'model_backends': MODEL_BACKENDS,
+    'model_routing': os.environ.get('MODEL_ROUTING', 'least_outstanding'),  # least_outstanding | latency_weighted
+    # ส่งคำขอดูข้อมูลให้ backend role small (ถ้ามี)
+    'small_model_routing': os.environ.get('SMALL_MODEL_ROUTING', '1') == '1',
     'line_token': '',
     'telegram_api': ''
 }
 
+# Process-wide cache ของข้อมูล Google Sheets (key = (sheet_id, gid))
+_sheet_cache = {}
+_sheet_cache_lock = threading.Lock()
+sheet_cache_stats = {
+    'hits': 0,
+    'stale_hits': 0,
+    'misses': 0,
+    'revalidations': 0,
+    'not_modified': 0,
+    'refreshed': 0,
+    'unchanged': 0,
+    'incremental_refreshes': 0,
+    'full_refreshes': 0,
+    'rows_changed': 0,
+    'errors': 0
+}
+
+
+class PooledHTTPClient:
+    """Shared keep-alive HTTP client for one upstream backend.
+
+    Wraps a requests.Session whose adapter keeps up to ``pool_size``
+    connections per host. Idempotent methods (GET/HEAD) are retried with
+    exponential backoff on connection errors and 502/503/504; POST is only
+    retried when the connection could not be established.
+    """
+    
+    def __init__(self, name, pool_size=10, timeout=10, retries=2, backoff=0.3):
+        self.name = name
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            read=retries,
+            connect=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            raise_on_status=False
+        )
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+        self.errors = 0
+    
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self.requests_sent += 1
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors += 1
+            metrics.inc('upstream_responses_total', upstream=self.name, status='error')
+            raise
+        metrics.inc('upstream_responses_total', upstream=self.name, status=response.status_code)
+        return response
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def stats(self):
+        """Connection reuse stats summed over this client's urllib3 pools"""
+        connections = 0
+        pool_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+        return {
+            'requests': self.requests_sent,
+            'errors': self.errors,
+            'connections_opened': connections,
+            'connection_reuse_rate': round(1 - connections / pool_requests, 3) if pool_requests else 0.0,
+            'pool_size': self.pool_size,
+            'timeout': self.timeout
+        }
+
+model_client = PooledHTTPClient('model', MODEL_HTTP_POOL_SIZE, MODEL_HTTP_TIMEOUT, HTTP_RETRIES, HTTP_RETRY_BACKOFF)
+sheets_client = PooledHTTPClient('sheets', SHEETS_HTTP_POOL_SIZE, SHEETS_HTTP_TIMEOUT, HTTP_RETRIES, HTTP_RETRY_BACKOFF)
+
+class SingleFlightAborted(RuntimeError):
+    """The leader of a coalesced call was cancelled or interrupted before finishing"""
+
+
+class SingleFlight:
+    """Coalesce concurrent identical upstream calls into one in-flight request.
+
+    The first caller for a key (the leader) runs the function; callers that
+    arrive with the same key while it is in flight wait for and share its
+    result or exception. ``do`` is for threads, ``do_async`` for coroutines
+    on the async server.
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+    
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        except BaseException:
+            # KeyboardInterrupt/SystemExit ของ leader - ผู้รอต้องได้ error ไม่ใช่ None
+            call['error'] = SingleFlightAborted(f'{self.name}: leader aborted')
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+    
+    async def do_async(self, key, coro_fn, *args, **kwargs):
+        with self._lock:
+            future = self._async_calls.get(key)
+            leader = future is None
+            if leader:
+                future = asyncio.get_running_loop().create_future()
+                self._async_calls[key] = future
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            return await asyncio.shield(future)
+        
+        try:
+            result = await coro_fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            # CancelledError (เช่น client ตัดการเชื่อมต่อ) ไม่ใช่ Exception -
+            # ต้องปิด future เสมอ ไม่งั้นผู้รอทุกคนค้างตลอดไป
+            if not future.done():
+                if not isinstance(e, Exception):
+                    e = SingleFlightAborted(f'{self.name}: leader cancelled')
+                future.set_exception(e)
+                # ไม่มีผู้รอ - กันไม่ให้ asyncio เตือนว่า exception ไม่ถูกอ่าน
+                future.exception()
+            raise
+        finally:
+            with self._lock:
+                del self._async_calls[key]
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls) + len(self._async_calls)
+            }
+
+class ResponseCache:
+    """LRU + TTL cache of model answers for repeated chat questions.
+
+    Keys hash the normalized question together with the sheet context, the
+    system prompt, the model and its parameters, so an entry can only be
+    served for an identical prompt. Entries are also dropped wholesale when
+    the system prompt changes or a sheet is replaced outright; an incremental
+    sheet refresh only evicts entries whose context quoted a changed row.
+    """
+    
+    # คำลงท้าย/คำสุภาพที่ไม่เปลี่ยนความหมายของคำถาม
+    POLITE_PARTICLES_RE = re.compile(r'(ครับ|ค่ะ|คะ|นะ|จ้ะ|จ้า|หน่อย)+$')
+    PUNCTUATION_RE = re.compile(r'[\s?!.,;:"\'()\[\]]+')
+    
+    def __init__(self, max_entries=256, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.row_evictions = 0
+    
+    @classmethod
+    def normalize_question(cls, question):
+        normalized = cls.PUNCTUATION_RE.sub(' ', question.lower()).strip()
+        normalized = cls.POLITE_PARTICLES_RE.sub('', normalized).strip()
+        return ' '.join(normalized.split())
+    
+    def make_key(self, question, context, role='chat'):
+        """Cache key for a question answered from ``context`` by ``role``'s backends with the current AI settings"""
+        parts = [
+            self.normalize_question(question),
+            hashlib.sha256(context.encode('utf-8')).hexdigest(),
+            hashlib.sha256(app_settings['system_prompt'].encode('utf-8')).hexdigest(),
+            role,
+            ','.join(model_pool.models_for(role)),
+            json.dumps(app_settings.get('model_params', {}), sort_keys=True)
+        ]
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, response, context=''):
+        if response in AI_ERROR_RESPONSES:
+            return
+        with self._lock:
+            self._entries[key] = (response, time.time(), context)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self, reason=''):
+        with self._lock:
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+                logger.info("Response cache cleared: %s", reason)
+    
+    def evict_containing(self, texts, reason=''):
+        """Drop entries whose context contains any of ``texts`` (rows that changed)"""
+        texts = [text for text in texts if text]
+        if not texts:
+            return 0
+        with self._lock:
+            stale = [
+                key for key, (_, _, context) in self._entries.items()
+                if any(text in context for text in texts)
+            ]
+            for key in stale:
+                del self._entries[key]
+            self.row_evictions += len(stale)
+        if stale:
+            logger.info("Response cache evicted %d entries: %s", len(stale), reason)
+        return len(stale)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'row_evictions': self.row_evictions
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+# รวมคำขอที่ซ้ำกันขณะกำลังรอผล (ดาวน์โหลดชีต / เรียกโมเดลด้วย prompt เดียวกัน)
+sheet_flight = SingleFlight('sheets')
+model_flight = SingleFlight('model')
+index_flight = SingleFlight('index')  # สร้าง search index ของ snapshot เดียวกันครั้งเดียว
+backend_flight = SingleFlight('backends')  # เปิดแหล่งข้อมูลในเครื่องครั้งเดียวต่อแหล่ง
+
+# ---------------------------------------------------------------------------
+# Model scheduler - จำกัดจำนวน generation ที่ส่งให้ Ollama พร้อมกัน และจัดคิวตามความสำคัญ
+# ---------------------------------------------------------------------------
+
+# ยิ่งน้อยยิ่งได้ก่อน: แชทของผู้ใช้ > หน้า testing / admin > งานเบื้องหลัง (warm-up)
+MODEL_PRIORITIES = {'chat': 0, 'test': 1, 'background': 2}
+
+class ModelBusyError(Exception):
+    """The model scheduler shed this call (queue full or waited too long)"""
+    
+    def __init__(self, reason, retry_after=MODEL_BUSY_RETRY_AFTER):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class _QueuedCall:
+    __slots__ = ('rank', 'wake', 'granted', 'withdrawn')
+    
+    def __init__(self, rank, wake):
+        self.rank = rank
+        self.wake = wake
+        self.granted = False
+        self.withdrawn = False
+
+class ModelScheduler:
+    """Bounded concurrency for model generations with a priority wait queue.
+
+    At most ``max_in_flight`` calls run at once; the rest wait ordered by
+    priority, then arrival. A freed slot is handed straight to the next
+    waiter, so new arrivals cannot overtake the queue. A call is shed with
+    ModelBusyError immediately when too many calls of its priority or higher
+    are already waiting (lower priorities get a shorter queue), or after
+    ``queue_timeout`` seconds in the queue. Threads use ``slot``, coroutines
+    on the async server ``slot_async``; both share the same slots.
+    """
+    
+    def __init__(self, max_in_flight, max_queue, queue_timeout):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._heap = []
+        self._order = itertools.count()
+        self._waiting = [0] * len(MODEL_PRIORITIES)  # จำนวนที่รออยู่ต่อ rank
+        self._lock = threading.Lock()
+        self._stats = {
+            name: {'admitted': 0, 'queued': 0, 'shed': 0, 'timeouts': 0, 'wait_ms': 0.0, 'max_wait_ms': 0.0}
+            for name in MODEL_PRIORITIES
+        }
+    
+    def configure(self, max_in_flight=None, max_queue=None, queue_timeout=None):
+        with self._lock:
+            if max_in_flight is not None:
+                self.max_in_flight = max(1, int(max_in_flight))
+            if max_queue is not None:
+                self.max_queue = max(0, int(max_queue))
+            if queue_timeout is not None:
+                self.queue_timeout = float(queue_timeout)
+            # เพิ่มจำนวน slot - ปล่อยคิวที่รออยู่ทันที
+            while self.in_flight < self.max_in_flight and self._grant_next():
+                self.in_flight += 1
+    
+    def queue_limit(self, priority):
+        """Waiting calls of this priority or higher beyond which a new call is shed"""
+        rank = MODEL_PRIORITIES[priority]
+        if rank == 0:
+            return self.max_queue
+        # งานทดสอบได้คิวสั้นกว่า งานเบื้องหลังทำเฉพาะตอนมี slot ว่าง
+        return self.max_queue // 4 if rank == 1 else 0
+    
+    def _grant_next(self):
+        """Hand a slot to the best waiter (lock held); False when nobody is waiting"""
+        while self._heap:
+            _, _, call = heapq.heappop(self._heap)
+            if call.withdrawn:
+                continue
+            call.granted = True
+            self._waiting[call.rank] -= 1
+            call.wake()
+            return True
+        return False
+    
+    def _enter(self, priority, wake):
+        """Take a free slot (returns None) or join the queue (returns the queued call)"""
+        rank = MODEL_PRIORITIES[priority]
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not any(self._waiting):
+                self.in_flight += 1
+                return None
+            if sum(self._waiting[:rank + 1]) >= self.queue_limit(priority):
+                self._stats[priority]['shed'] += 1
+                shed = True
+            else:
+                shed = False
+                call = _QueuedCall(rank, wake)
+                heapq.heappush(self._heap, (rank, next(self._order), call))
+                self._waiting[rank] += 1
+                self._stats[priority]['queued'] += 1
+        if shed:
+            metrics.inc('model_shed_total', priority=priority, reason='queue_full')
+            logger.info("Model call shed: queue full (%s)", priority, extra={'priority': priority})
+            raise ModelBusyError('queue_full')
+        return call
+    
+    def _withdraw(self, call, priority, timed_out):
+        """Leave the queue; returns False when a slot was handed over first (the caller owns it)"""
+        with self._lock:
+            if call.granted:
+                return False
+            call.withdrawn = True
+            self._waiting[call.rank] -= 1
+            if timed_out:
+                self._stats[priority]['timeouts'] += 1
+        if timed_out:
+            metrics.inc('model_shed_total', priority=priority, reason='timeout')
+            logger.info("Model call shed: waited %.0f s in queue (%s)", self.queue_timeout, priority,
+                        extra={'priority': priority})
+        return True
+    
+    def _admitted(self, priority, wait):
+        with self._lock:
+            stats = self._stats[priority]
+            stats['admitted'] += 1
+            stats['wait_ms'] += wait * 1000
+            stats['max_wait_ms'] = max(stats['max_wait_ms'], wait * 1000)
+        metrics.observe('stage_duration_seconds', wait, stage='model_queue')
+    
+    def _release(self):
+        with self._lock:
+            if self.in_flight > self.max_in_flight or not self._grant_next():
+                self.in_flight -= 1
+    
+    @contextmanager
+    def slot(self, priority='chat'):
+        """Hold one generation slot for the duration of the block; raises ModelBusyError when shed"""
+        started = time.perf_counter()
+        ready = threading.Event()
+        call = self._enter(priority, ready.set)
+        if call is not None and not ready.wait(self.queue_timeout):
+            if self._withdraw(call, priority, timed_out=True):
+                raise ModelBusyError('timeout')
+        self._admitted(priority, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self._release()
+    
+    @asynccontextmanager
+    async def slot_async(self, priority='chat'):
+        """``slot`` for coroutines - waits on the event loop instead of blocking a thread"""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        
+        def wake():
+            # อาจถูกเรียกจาก thread อื่น (ตอน thread ของ Flask คืน slot)
+            loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(None))
+        
+        call = self._enter(priority, wake)
+        if call is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(ready), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if self._withdraw(call, priority, timed_out=True):
+                    raise ModelBusyError('timeout')
+            except asyncio.CancelledError:
+                # ผู้ใช้ตัดการเชื่อมต่อระหว่างรอ - ถ้าได้ slot มาแล้วต้องคืน
+                if not self._withdraw(call, priority, timed_out=False):
+                    self._release()
+                raise
+        self._admitted(priority, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self._release()
+    
+    def stats(self):
+        with self._lock:
+            result = {
+                'max_in_flight': self.max_in_flight,
+                'max_queue': self.max_queue,
+                'queue_timeout': self.queue_timeout,
+                'in_flight': self.in_flight,
+                'queued': sum(self._waiting),
+                'priorities': {}
+            }
+            for name, stats in self._stats.items():
+                entry = dict(stats, waiting=self._waiting[MODEL_PRIORITIES[name]], queue_limit=self.queue_limit(name))
+                entry['avg_wait_ms'] = round(stats['wait_ms'] / stats['admitted'], 1) if stats['admitted'] else None
+                entry['wait_ms'] = round(stats['wait_ms'], 1)
+                entry['max_wait_ms'] = round(stats['max_wait_ms'], 1)
+                result['priorities'][name] = entry
+        return result
+
+model_scheduler = ModelScheduler(MODEL_MAX_IN_FLIGHT, MODEL_MAX_QUEUE, MODEL_QUEUE_TIMEOUT)
+
+def model_flight_key(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def model_api_base(api_url=None):
+    """Ollama base URL (scheme://host:port) derived from the generate endpoint"""
+    api_url = api_url or CHAT_API_URL
+    marker = api_url.find('/api/')
+    return api_url[:marker] if marker != -1 else api_url.rstrip('/')
+
+def model_chat_url():
+    """Chat endpoint of the primary backend"""
+    return model_pool.primary().chat_url()
+
+def format_uptime(seconds):
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes = seconds // 60
+    if days:
+        return f"{days}d {hours}h {minutes}m"
+    return f"{hours}h {minutes}m"
+
+def get_uptime_seconds():
+    return time.time() - PROCESS_STARTED_AT
+
+_health_cache = {}
+_health_lock = threading.Lock()
+health_stats = {'probes': 0, 'cache_hits': 0, 'failures': 0}
+
+def _probe_model_backend(base_url, model):
+    """Hit the cheap Ollama endpoints: model list (+ version) - no inference"""
+    result = {
+        'status': 'error',
+        'model': model,
+        'model_available': False,
+        'base_url': base_url,
+        'checked_at': time.time()
+    }
+    started = time.perf_counter()
+    try:
+        response = model_client.get(f"{base_url}/api/tags", timeout=HEALTH_TIMEOUT)
+        result['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        result['http_status'] = response.status_code
+        if response.status_code == 200:
+            models = [m.get('name') or m.get('model') or '' for m in response.json().get('models', [])]
+            result['models'] = len(models)
+            result['model_available'] = model.lower() in (name.lower() for name in models)
+            result['status'] = 'connected' if result['model_available'] else 'model_missing'
+            try:
+                version = model_client.get(f"{base_url}/api/version", timeout=HEALTH_TIMEOUT)
+                if version.status_code == 200:
+                    result['version'] = version.json().get('version')
+            except (requests.RequestException, ValueError):
+                pass
+    except (requests.RequestException, ValueError) as e:
+        result['latency_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        result['error'] = str(e)
+    
+    with _health_lock:
+        health_stats['probes'] += 1
+        if result['status'] == 'error':
+            health_stats['failures'] += 1
+        _health_cache[(base_url, model)] = result
+    model_pool.record_health(base_url, model, result['status'])
+    logger.debug("Model health %s@%s: %s (%s ms)", model, base_url, result['status'], result['latency_ms'])
+    return result
+
+def check_model_health(force=False, backend=None):
+    """Cached health of one backend (the primary by default); dashboards refreshing every 30 s share one probe per window"""
+    backend = backend or model_pool.primary()
+    key = (backend.url, backend.model)
+    if not force:
+        with _health_lock:
+            cached = _health_cache.get(key)
+            if cached and time.time() - cached['checked_at'] < HEALTH_CACHE_TTL:
+                health_stats['cache_hits'] += 1
+                return dict(cached, cached=True)
+    result = model_flight.do(('health',) + key, _probe_model_backend, *key)
+    return dict(result, cached=False)
+
+def describe_model_health(health):
+    if health['status'] == 'connected':
+        details = f"HTTP {health['http_status']} - {health['latency_ms']} ms - model {health['model']} available"
+    elif health['status'] == 'model_missing':
+        details = f"HTTP {health['http_status']} - model {health['model']} not found on server"
+    elif 'http_status' in health:
+        details = f"HTTP {health['http_status']}"
+    else:
+        details = f"Error: {health.get('error', 'unknown')}"
+    if health.get('version'):
+        details += f" (Ollama {health['version']})"
+    return details
+
+def get_health_stats():
+    with _health_lock:
+        return {
+            **health_stats,
+            'ttl': HEALTH_CACHE_TTL,
+            'last': {f"{model}@{url}": dict(entry) for (url, model), entry in _health_cache.items()},
+            'uptime_seconds': int(get_uptime_seconds())
+        }
+
+# ---------------------------------------------------------------------------
+# Model backend pool - กระจายคำขอไปหลาย Ollama host, พัก host ที่เสีย และลองตัวถัดไป
+# ---------------------------------------------------------------------------
+
+MODEL_ROLES = ('chat', 'small')
+MODEL_ROUTING_POLICIES = ('least_outstanding', 'latency_weighted')
+
+class ModelBackend:
+    """One Ollama host + model in the pool, with its live load and failure state"""
+    
+    def __init__(self, url, model, role='chat', max_in_flight=MODEL_MAX_IN_FLIGHT):
+        self.url = url
+        self.model = model
+        self.role = role
+        self.max_in_flight = max_in_flight
+        self.outstanding = 0
+        self.latency_ms = None  # EWMA ของเวลาตอบที่สำเร็จ
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.health = None  # สถานะจาก health probe ล่าสุด
+        self.last_error = None
+    
+    @property
+    def key(self):
+        return (self.url, self.model)
+    
+    @property
+    def name(self):
+        return f"{self.model}@{self.url}"
+    
+    def chat_url(self):
+        return f"{self.url}/api/chat"
+    
+    def available(self, now):
+        return now >= self.ejected_until and self.health in (None, 'connected')
+    
+    def load(self):
+        return self.outstanding / self.max_in_flight
+    
+    def stats(self, now):
+        return {
+            'url': self.url,
+            'model': self.model,
+            'role': self.role,
+            'max_in_flight': self.max_in_flight,
+            'outstanding': self.outstanding,
+            'latency_ms': round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            'calls': self.calls,
+            'failures': self.failures,
+            'health': self.health,
+            'available': self.available(now),
+            'ejected_for_s': round(self.ejected_until - now, 1) if self.ejected_until > now else 0,
+            'last_error': self.last_error
+        }
+
+def normalize_model_backend(backend):
+    """Validate one backend entry; raises ValueError when unusable"""
+    url = str(backend.get('url', '')).strip()
+    model = str(backend.get('model', '')).strip()
+    if not url.startswith(('http://', 'https://')) or not model:
+        raise ValueError('backend ต้องมี url (http/https) และ model')
+    role = str(backend.get('role', 'chat')).strip() or 'chat'
+    if role not in MODEL_ROLES:
+        raise ValueError(f'ไม่รองรับ role {role}')
+    return {
+        'url': model_api_base(url),
+        'model': model,
+        'role': role,
+        'max_in_flight': max(1, int(backend.get('max_in_flight', MODEL_MAX_IN_FLIGHT)))
+    }
+
+class ModelPool:
+    """Routes each model call to a backend and fails over to the next one.
+
+    Picks among available backends of the wanted role by least outstanding
+    calls per slot, or randomly weighted by capacity / (latency x load).
+    A backend is ejected for MODEL_EJECT_SECONDS after MODEL_EJECT_FAILURES
+    failures in a row and while its health probe reports a problem; when
+    every candidate is out, the untried ones are used anyway rather than
+    failing the request. Calls for role ``small`` fall back to ``chat``.
+    """
+    
+    def __init__(self):
+        self.backends = []
+        self._lock = threading.Lock()
+        self._monitor_pid = None
+    
+    def configure(self, entries):
+        """Replace the backend list, keeping the live state of backends that stay"""
+        with self._lock:
+            previous = {backend.key: backend for backend in self.backends}
+            backends = []
+            for entry in entries:
+                backend = previous.get((entry['url'], entry['model'])) or ModelBackend(entry['url'], entry['model'])
+                backend.role = entry['role']
+                backend.max_in_flight = entry['max_in_flight']
+                backends.append(backend)
+            self.backends = backends
+    
+    def models_for(self, role):
+        """Sorted model names that may answer ``role`` (small falls back to chat)"""
+        backends = self.backends
+        models = {backend.model for backend in backends if backend.role == role}
+        if role != 'chat':
+            models |= {backend.model for backend in backends if backend.role == 'chat'}
+        return sorted(models)
+    
+    def primary(self):
+        backends = self.backends
+        return next((backend for backend in backends if backend.role == 'chat'), backends[0])
+    
+    def capacity(self):
+        return sum(backend.max_in_flight for backend in self.backends)
+    
+    def _pick(self, candidates):
+        if app_settings.get('model_routing') == 'latency_weighted':
+            # backend ที่ยังไม่มีเวลาตอบ ใช้ค่ากลางของตัวอื่น (ได้ลองบ้าง)
+            known = [backend.latency_ms for backend in candidates if backend.latency_ms]
+            typical = sorted(known)[len(known) // 2] if known else 1.0
+            weights = [backend.max_in_flight / ((backend.latency_ms or typical) * (1 + backend.outstanding))
+                       for backend in candidates]
+            return random.choices(candidates, weights)[0]
+        best = min(backend.load() for backend in candidates)
+        return random.choice([backend for backend in candidates if backend.load() == best])
+    
+    def _choose(self, role, tried):
+        now = time.monotonic()
+        with self._lock:
+            groups = [role] if role == 'chat' else [role, 'chat']
+            untried = [[backend for backend in self.backends if backend.role == group and backend.key not in tried]
+                       for group in groups]
+            for candidates in untried:
+                available = [backend for backend in candidates if backend.available(now)]
+                if available:
+                    backend = self._pick(available)
+                    break
+            else:
+                # ทุกตัวถูกพักอยู่ - ลองตัวที่ใกล้หมดเวลาพักที่สุดแทนการตอบว่าใช้ไม่ได้
+                remaining = [backend for candidates in untried for backend in candidates]
+                if not remaining:
+                    return None
+                backend = min(remaining, key=lambda backend: backend.ejected_until)
+            backend.outstanding += 1
+            backend.calls += 1
+            return backend
+    
+    def failover(self, role='chat'):
+        """Backends to try for one call, best first; each one is outstanding until ``release``"""
+        self._ensure_monitor()
+        tried = set()
+        while True:
+            backend = self._choose(role, tried)
+            if backend is None:
+                return
+            tried.add(backend.key)
+            yield backend
+    
+    def release(self, backend, started, error=None, track_latency=True):
+        """Finish a call on ``backend``; ``error`` (exception or text) marks it failed.
+
+        ``track_latency=False`` keeps calls that are not generations (embeddings)
+        out of the latency average used for routing.
+        """
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        ejected = False
+        with self._lock:
+            backend.outstanding -= 1
+            if error is None:
+                backend.consecutive_failures = 0
+                if track_latency:
+                    backend.latency_ms = elapsed_ms if backend.latency_ms is None else 0.8 * backend.latency_ms + 0.2 * elapsed_ms
+            else:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                backend.last_error = str(error)
+                if backend.consecutive_failures >= MODEL_EJECT_FAILURES:
+                    # ลองตัวที่ถูกพักแล้วยังเสีย = ต่อเวลาพัก (log เฉพาะตอนเริ่มพัก)
+                    now = time.monotonic()
+                    ejected = backend.ejected_until <= now
+                    backend.ejected_until = now + MODEL_EJECT_SECONDS
+        metrics.inc('model_backend_calls_total', backend=backend.name, outcome='ok' if error is None else 'error')
+        if ejected:
+            logger.warning("Model backend %s ejected for %.0f s after %d failures: %s", backend.name,
+                           MODEL_EJECT_SECONDS, backend.consecutive_failures, error)
+    
+    def record_health(self, base_url, model, status):
+        with self._lock:
+            for backend in self.backends:
+                if backend.key == (base_url, model):
+                    if status == 'connected' and backend.health not in (None, 'connected'):
+                        logger.info("Model backend %s is healthy again", backend.name)
+                    backend.health = status
+    
+    def _ensure_monitor(self):
+        # probe ทุก backend เป็นระยะเมื่อมีมากกว่าหนึ่งตัว (เริ่มใหม่ในแต่ละ worker หลัง fork)
+        if len(self.backends) < 2 or self._monitor_pid == os.getpid():
+            return
+        with self._lock:
+            if self._monitor_pid == os.getpid():
+                return
+            self._monitor_pid = os.getpid()
+        threading.Thread(target=self._monitor, name='model-health', daemon=True).start()
+    
+    def _monitor(self):
+        while True:
+            try:
+                check_pool_health()
+            except Exception as e:
+                logger.warning("Model health monitor error: %s", e)
+            time.sleep(HEALTH_CACHE_TTL)
+    
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'routing': app_settings.get('model_routing'),
+                'small_model_routing': app_settings.get('small_model_routing'),
+                'backends': [backend.stats(now) for backend in self.backends]
+            }
+
+model_pool = ModelPool()
+
+def normalize_model_backends(backends):
+    """Validate a whole backend list without applying it; raises ValueError when unusable"""
+    if not isinstance(backends, list) or not all(isinstance(backend, dict) for backend in backends):
+        raise ValueError('backends ต้องเป็นรายการของ object')
+    normalized = [normalize_model_backend(backend) for backend in backends]
+    if not any(backend['role'] == 'chat' for backend in normalized):
+        raise ValueError('ต้องมี backend role chat อย่างน้อยหนึ่งตัว')
+    return normalized
+
+def set_model_backends(backends):
+    """Validate and apply the backend list; the scheduler gets one slot per backend slot"""
+    normalized = normalize_model_backends(backends)
+    app_settings['model_backends'] = normalized
+    model_pool.configure(normalized)
+    model_scheduler.configure(max_in_flight=model_pool.capacity())
+    return normalized
+
+def model_role_for(message):
+    """``small`` for plain "show data" requests when a small backend is configured"""
+    if (app_settings.get('small_model_routing') and is_show_data_request(message)
+            and any(backend.role == 'small' for backend in model_pool.backends)):
+        return 'small'
+    return 'chat'
+
+def model_backend_failed(status_code):
+    # 404 = โมเดลไม่มีบน host นี้, 5xx = host มีปัญหา - ลอง backend ถัดไป
+    return status_code == 404 or status_code >= 500
+
+def check_pool_health(force=False):
+    """Health of every backend in the pool (cached per backend like check_model_health)"""
+    return [check_model_health(force, backend) for backend in list(model_pool.backends)]
+
+set_model_backends(MODEL_BACKENDS)
 
 def clean_thai_text(text):
     """แปลง Unicode escape sequences กลับเป็นภาษาไทย"""
     if not text or not isinstance(text, str):
         return text
     
-    # ตรวจสอบว่ามี Unicode escape sequences หรือไม่
-    if '\\u' not in text:
-        return text
+    # ตรวจสอบว่ามี Unicode escape sequences หรือไม่
+    if '\\u' not in text:
+        return text
+    
+    try:
+        # วิธีที่ 1: ใช้ codecs.decode สำหรับ unicode_escape
+        cleaned = codecs.decode(text, 'unicode_escape')
+        return cleaned
+    except:
+        try:
+            # วิธีที่ 2: ใช้ encode/decode method
+            cleaned = text.encode().decode('unicode_escape')
+            return cleaned
+        except:
+            try:
+                # วิธีที่ 3: ใช้ regular expression กับ codecs
+                def decode_match(match):
+                    return chr(int(match.group(1), 16))
+                cleaned = re.sub(r'\\u([0-9a-fA-F]{4})', decode_match, text)
+                return cleaned
+            except:
+                # หากแปลงไม่ได้ทุกวิธี ให้คืนค่าเดิม
+                return text
+                
+def build_sheet_csv_url(sheet_id, gid=0):
+    """Build the public CSV export URL for a Google Sheet tab"""
+    return f"{GOOGLE_SHEETS_BASE_URL}/{sheet_id}/export?format=csv&gid={gid}"
+
+# ปรับปรุง headers เพื่อรองรับ UTF-8
+SHEET_REQUEST_HEADERS = {
+    'Accept': 'text/csv; charset=utf-8',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+
+# ตัวคั่นเซลล์ตอนแปลงหลายเซลล์ในครั้งเดียว (ไม่ใช่ส่วนหนึ่งของ escape ใดๆ ยกเว้นเมื่อตามหลัง backslash)
+_ESCAPE_CELL_SEPARATOR = '\x00'
+
+def _repair_escaped_cells(cells):
+    """Decode the Unicode escapes of many cells with a single codec call.
+
+    Gives the same result as calling clean_thai_text on each cell; falls back
+    to that when a cell could change how its neighbour decodes (trailing
+    backslash) or when the joined decode fails.
+    """
+    joined = _ESCAPE_CELL_SEPARATOR.join(cells)
+    if len(cells) > 1 and not joined.endswith('\\') and '\\' + _ESCAPE_CELL_SEPARATOR not in joined:
+        try:
+            decoded = codecs.decode(joined, 'unicode_escape').split(_ESCAPE_CELL_SEPARATOR)
+            if len(decoded) == len(cells):
+                return decoded
+        except (UnicodeDecodeError, ValueError):
+            pass
+    return [clean_thai_text(cell) for cell in cells]
+
+def parse_sheet_csv(csv_content):
+    """Parse CSV export content into rows, converting Unicode escapes in each cell"""
+    data = list(csv.reader(StringIO(csv_content)))
+    
+    # ส่วนใหญ่ไม่มี escape เลย - คืนเซลล์จาก csv reader ตรงๆ ไม่ต้องวนทุกเซลล์
+    if '\\u' not in csv_content or not data:
+        return data
+    
+    # ตรวจทีละคอลัมน์ แล้วแปลงเฉพาะเซลล์ที่มี escape ด้วยการ decode ครั้งเดียวต่อคอลัมน์
+    width = max(len(row) for row in data)
+    repaired_cells = 0
+    for col in range(width):
+        cells = [row[col] if col < len(row) else '' for row in data]
+        if '\\u' not in _ESCAPE_CELL_SEPARATOR.join(cells):
+            continue
+        row_nums = [row_num for row_num, cell in enumerate(cells) if '\\u' in cell]
+        for row_num, cell in zip(row_nums, _repair_escaped_cells([cells[row_num] for row_num in row_nums])):
+            data[row_num][col] = cell
+        repaired_cells += len(row_nums)
+    
+    logger.debug("Repaired Unicode escapes in %d cells", repaired_cells)
+    return data
+
+class SheetRow(Sequence):
+    """Read-only view of one snapshot row; cells are read from the column store on access"""
+    
+    __slots__ = ('_snapshot', '_row')
+    
+    def __init__(self, snapshot, row):
+        self._snapshot = snapshot
+        self._row = row
+    
+    def __len__(self):
+        return self._snapshot.row_lengths[self._row]
+    
+    def __getitem__(self, col):
+        if isinstance(col, slice):
+            return [self[i] for i in range(*col.indices(len(self)))]
+        length = len(self)
+        if col < 0:
+            col += length
+        if not 0 <= col < length:
+            raise IndexError('row index out of range')
+        return self._snapshot.cell(self._row, col)
+    
+    def __iter__(self):
+        row = self._row
+        for values, codes in self._snapshot.columns[:len(self)]:
+            yield values[codes[row]]
+    
+    def __eq__(self, other):
+        if isinstance(other, (SheetRow, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+    
+    def __repr__(self):
+        return repr(list(self))
+    
+    def to_list(self):
+        return list(self)
+
+class SheetRowsView(Sequence):
+    """Lazy slice of a snapshot (``snapshot[1:]`` does not copy rows)"""
+    
+    __slots__ = ('_snapshot', '_rows')
+    
+    def __init__(self, snapshot, rows):
+        self._snapshot = snapshot
+        self._rows = rows
+    
+    def __len__(self):
+        return len(self._rows)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SheetRowsView(self._snapshot, self._rows[index])
+        return SheetRow(self._snapshot, self._rows[index])
+    
+    def to_list(self):
+        return [list(row) for row in self]
+
+class SheetSnapshot(Sequence):
+    """Immutable, column-oriented copy of one sheet tab.
+
+    Each column is dictionary-encoded: its distinct cell strings (interned
+    for low-cardinality columns) plus an ``array('I')`` of codes, one per
+    row, so repeated values such as provinces or statuses are stored once.
+    Behaves like the old list of rows: ``len()``, indexing and iteration give
+    lazy ``SheetRow`` views and slices give ``SheetRowsView`` without copying.
+    
+    ``row_hashes`` lets a refreshed snapshot diff itself against the one it
+    replaces (``diff_from``); ``base``/``diff`` keep that result so the
+    search index can be patched instead of rebuilt.
+    """
+    
+    def __init__(self, rows, content_hash=None):
+        self.row_lengths = array('I', [len(row) for row in rows])
+        self.row_hashes = array('q', [hash('\x1f'.join(row)) for row in rows])
+        width = max(self.row_lengths) if rows else 0
+        self.columns = []
+        for col in range(width):
+            # ค่าที่ซ้ำกันในคอลัมน์ได้ code เดียวกัน
+            lookup = {}
+            codes = array('I', [
+                lookup.setdefault(row[col] if col < len(row) else '', len(lookup)) for row in rows
+            ])
+            values = list(lookup)
+            if len(values) * 2 <= len(rows):
+                # คอลัมน์ค่าซ้ำเยอะ (สถานะ จังหวัด ฯลฯ) - intern เพื่อใช้ string ร่วมกันข้าม snapshot
+                values = [sys.intern(value) for value in values]
+            self.columns.append((values, codes))
+        
+        self.header = tuple(rows[0]) if rows else ()
+        self.column_index = {name: col for col, name in reversed(list(enumerate(self.header))) if name}
+        self.content_hash = content_hash or self._hash_rows(rows)
+        self._displays = [None] * len(rows)
+        self.base = None
+        self.diff = None
+    
+    @classmethod
+    def from_csv(cls, csv_content, previous=None):
+        """Build a snapshot from CSV export content; returns ``previous`` when the content is unchanged"""
+        content_hash = hashlib.sha256(csv_content.encode('utf-8')).hexdigest()
+        if previous is not None and previous.content_hash == content_hash:
+            return previous
+        return cls(parse_sheet_csv(csv_content), content_hash)
+    
+    @staticmethod
+    def _hash_rows(rows):
+        digest = hashlib.sha256()
+        for row in rows:
+            digest.update('\x1f'.join(row).encode('utf-8'))
+            digest.update(b'\x1e')
+        return digest.hexdigest()
+    
+    def __len__(self):
+        return len(self.row_lengths)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SheetRowsView(self, range(len(self))[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('snapshot index out of range')
+        return SheetRow(self, index)
+    
+    def __iter__(self):
+        for row in range(len(self)):
+            yield SheetRow(self, row)
+    
+    @property
+    def width(self):
+        return len(self.columns)
+    
+    def cell(self, row, col):
+        values, codes = self.columns[col]
+        return values[codes[row]]
+    
+    def column(self, col):
+        """All cells of column ``col`` (rows shorter than ``col`` give '')"""
+        values, codes = self.columns[col]
+        return [values[code] for code in codes]
+    
+    def display(self, row):
+        """Non-empty cells of ``row`` joined with ' | ' (cached per row)"""
+        display = self._displays[row]
+        if display is None:
+            display = ' | '.join(cell for cell in SheetRow(self, row) if cell)
+            self._displays[row] = display
+        return display
+    
+    def row_label(self, row):
+        return f"แถวที่ {row + 1}"
+    
+    def header_row_of(self, row):
+        return 0
+    
+    def diff_from(self, previous):
+        """Positional row diff against ``previous``: changed row numbers plus rows added/removed at the end"""
+        old_hashes, new_hashes = previous.row_hashes, self.row_hashes
+        common = min(len(old_hashes), len(new_hashes))
+        if old_hashes[:common] == new_hashes[:common]:
+            # กรณีที่พบบ่อย: มีแถวเพิ่ม/ลดท้ายชีตเท่านั้น
+            changed = []
+        else:
+            changed = [row for row in range(common) if old_hashes[row] != new_hashes[row]]
+        return {
+            'changed': changed,
+            'added': max(0, len(new_hashes) - len(old_hashes)),
+            'removed': max(0, len(old_hashes) - len(new_hashes)),
+            'rows': len(new_hashes)
+        }
+    
+    def touched_rows(self):
+        """Number of rows the attached diff touches"""
+        return len(self.diff['changed']) + self.diff['added'] + self.diff['removed'] if self.diff else 0
+    
+    @property
+    def header_rows(self):
+        return (0,) if len(self) else ()
+    
+    def to_list(self):
+        return [list(row) for row in self]
+    
+    def stats(self):
+        return {
+            'rows': len(self),
+            'columns': self.width,
+            'distinct_values': sum(len(values) for values, _ in self.columns),
+            'content_hash': self.content_hash[:12]
+        }
+
+class SourceSet(Sequence):
+    """Several data-source snapshots seen as one sequence of rows.
+
+    ``parts`` is a list of ``(source, snapshot)``; rows are numbered in that
+    order and ``locate`` maps a combined row back to its source, so search
+    results can say which tab or spreadsheet a hit came from.
+    """
+    
+    def __init__(self, parts):
+        self.parts = parts
+        self.offsets = []
+        total = 0
+        for _, snapshot in parts:
+            self.offsets.append(total)
+            total += len(snapshot)
+        self._length = total
+        self.diff = None
+    
+    def __len__(self):
+        return self._length
+    
+    def locate(self, row):
+        """``(source, snapshot, row within that snapshot)`` for a combined row number"""
+        part = bisect.bisect_right(self.offsets, row) - 1
+        source, snapshot = self.parts[part]
+        return source, snapshot, row - self.offsets[part]
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('source set index out of range')
+        _, snapshot, row = self.locate(index)
+        return snapshot[row]
+    
+    def __iter__(self):
+        for _, snapshot in self.parts:
+            yield from snapshot
+    
+    def same_snapshots(self, parts):
+        return len(parts) == len(self.parts) and all(
+            a[1] is b[1] and a[0] == b[0] for a, b in zip(parts, self.parts)
+        )
+    
+    def diff_to(self, parts):
+        """Combined-row diff from this set to ``parts``, or None when it cannot be patched.
+
+        Each refreshed part must carry an incremental diff from the snapshot
+        in this set; only the last part may change its row count, since any
+        other would shift the row numbers of every part after it.
+        """
+        if len(parts) != len(self.parts):
+            return None
+        changed = []
+        added = removed = 0
+        for part, ((source, data), (old_source, old_data)) in enumerate(zip(parts, self.parts)):
+            if source != old_source:
+                return None
+            if data is old_data:
+                continue
+            if data.base is not old_data or data.diff is None:
+                return None
+            if (data.diff['added'] or data.diff['removed']) and part != len(parts) - 1:
+                return None
+            changed.extend(self.offsets[part] + row for row in data.diff['changed'])
+            added, removed = data.diff['added'], data.diff['removed']
+        return {'changed': changed, 'added': added, 'removed': removed,
+                'rows': sum(len(data) for _, data in parts)}
+    
+    def touched_rows(self):
+        return len(self.diff['changed']) + self.diff['added'] + self.diff['removed'] if self.diff else 0
+    
+    def display(self, row):
+        _, snapshot, local_row = self.locate(row)
+        return snapshot.display(local_row)
+    
+    def row_label(self, row):
+        source, _, local_row = self.locate(row)
+        return f"[{source['label']}] แถวที่ {local_row + 1}"
+    
+    def header_row_of(self, row):
+        """Combined row number of the header row of ``row``'s source"""
+        return self.offsets[bisect.bisect_right(self.offsets, row) - 1]
+    
+    @property
+    def header_rows(self):
+        return tuple(offset for offset, (_, snapshot) in zip(self.offsets, self.parts) if len(snapshot))
+    
+    def to_list(self):
+        return [list(row) for row in self]
+
+class SheetJSONProvider(DefaultJSONProvider):
+    """Let jsonify() serialize snapshot rows and slices like plain lists"""
+    
+    def default(self, o):
+        if isinstance(o, SheetRow):
+            return o.to_list()
+        if isinstance(o, (SheetSnapshot, SheetRowsView, SourceSet)):
+            return o.to_list()
+        return super().default(o)
+
+app.json = SheetJSONProvider(app)
+
+def _fetch_sheet_csv(sheet_id, gid=0, etag=None, last_modified=None, previous=None):
+    """Download a sheet tab, sending conditional headers when validators are known.
+
+    Returns a dict with ``status`` (200, 304 or the error code), ``data``,
+    ``etag`` and ``last_modified``; ``data`` is None unless status is 200.
+    ``previous`` (the cached snapshot) is returned as ``data`` when the
+    downloaded content is unchanged, skipping the parse.
+    """
+    csv_url = build_sheet_csv_url(sheet_id, gid)
+    logger.debug("Fetching Google Sheet: %s", csv_url)
+    started = time.perf_counter()
+    
+    headers = dict(SHEET_REQUEST_HEADERS)
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    
+    with span('sheet_download'):
+        response = sheets_client.get(csv_url, headers=headers)
+        if response.status_code == 200:
+            # ตรวจสอบ encoding ของ response
+            response.encoding = 'utf-8'
+            csv_content = response.text
+    logger.debug("Google Sheets response status: %s", response.status_code)
+    
+    result = {
+        'status': response.status_code,
+        'data': None,
+        'etag': response.headers.get('ETag', etag),
+        'last_modified': response.headers.get('Last-Modified', last_modified)
+    }
+    
+    if response.status_code == 200:
+        logger.debug("Google Sheets CSV: %d characters", len(csv_content))
+        
+        with span('csv_parse'):
+            data = SheetSnapshot.from_csv(csv_content, previous)
+        
+        logger.debug("Parsed %d rows from Google Sheets", len(data))
+        
+        result['data'] = data
+    elif response.status_code != 304:
+        logger.warning("Google Sheets error: HTTP %s %.500s", response.status_code, response.text)
+    
+    result['fetch_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+def _store_sheet_entry(key, fetched):
+    """Save a successful fetch result into the sheet cache"""
+    with _sheet_cache_lock:
+        previous = _sheet_cache.get(key)
+        data = fetched['data']
+        unchanged = previous is not None and previous['data'].content_hash == data.content_hash
+        if unchanged:
+            # เนื้อหาเหมือนเดิม - ใช้ snapshot เดิมต่อ (search index และ response cache ยังใช้ได้)
+            data = previous['data']
+            sheet_cache_stats['unchanged'] += 1
+        _sheet_cache[key] = {
+            'data': data,
+            'etag': fetched['etag'],
+            'last_modified': fetched['last_modified'],
+            'fetch_ms': fetched.get('fetch_ms'),
+            'fetched_at': time.time(),
+            'refreshing': False
+        }
+    if previous is not None and not unchanged:
+        _apply_snapshot_change(key, previous['data'], data)
+
+def _apply_snapshot_change(key, previous, data, stats=None):
+    """Diff a refreshed snapshot against the one it replaces.
+
+    Small diffs are attached to the new snapshot so the search index can be
+    patched, and only response-cache entries quoting a changed row are
+    evicted; large diffs (or incremental mode off) fall back to a full
+    rebuild and clearing the response cache. The refresh is counted in
+    ``stats`` (the Google Sheets cache counters by default).
+    """
+    diff = data.diff_from(previous)
+    touched = len(diff['changed']) + diff['added'] + diff['removed']
+    incremental = (
+        app_settings.get('incremental_refresh', True) and
+        touched <= INCREMENTAL_REFRESH_MAX_FRACTION * max(len(data), 1)
+    )
+    summary = {
+        'changed': len(diff['changed']),
+        'added': diff['added'],
+        'removed': diff['removed'],
+        'incremental': incremental
+    }
+    stats = sheet_cache_stats if stats is None else stats
+    with _sheet_cache_lock:
+        stats['incremental_refreshes' if incremental else 'full_refreshes'] += 1
+        stats['rows_changed'] += touched
+        entry = _sheet_cache.get(key)
+        if entry is not None and entry['data'] is data:
+            entry['last_diff'] = summary
+    logger.info("Sheet refresh %s/%s: %s", key[0], key[1], summary)
+    
+    if incremental:
+        # เก็บเฉพาะ diff ล่าสุด ไม่ให้ snapshot เก่าต่อกันเป็นสาย
+        previous.base = None
+        previous.diff = None
+        data.base = previous
+        data.diff = diff
+        stale_rows = diff['changed'] + list(range(len(data), len(previous)))
+        response_cache.evict_containing([previous.display(row) for row in stale_rows], 'sheet rows changed')
+    else:
+        # snapshot ใหม่ - คำตอบที่เคยเก็บไว้อาจไม่ตรงกับข้อมูลแล้ว
+        response_cache.clear('sheet snapshot changed')
+
+def _revalidate_sheet(key):
+    """Background revalidation of a stale cache entry using a conditional request"""
+    sheet_id, gid = key
+    with _sheet_cache_lock:
+        entry = _sheet_cache.get(key)
+        etag = entry['etag'] if entry else None
+        last_modified = entry['last_modified'] if entry else None
+        previous = entry['data'] if entry else None
+    
+    try:
+        fetched = _fetch_sheet_csv(sheet_id, gid, etag, last_modified, previous)
+        if fetched['status'] == 304:
+            with _sheet_cache_lock:
+                sheet_cache_stats['not_modified'] += 1
+                entry = _sheet_cache.get(key)
+                if entry:
+                    entry['fetched_at'] = time.time()
+                    entry['fetch_ms'] = fetched['fetch_ms']
+            logger.debug("Sheet cache revalidated (not modified): %s/%s", sheet_id, gid)
+        elif fetched['status'] == 200:
+            with _sheet_cache_lock:
+                sheet_cache_stats['refreshed'] += 1
+                # ถ้า entry ถูกล้างไประหว่างโหลด (เช่นเปลี่ยน Sheet ID) ไม่ต้องเก็บ
+                still_cached = key in _sheet_cache
+            if still_cached:
+                _store_sheet_entry(key, fetched)
+            logger.info("Sheet cache refreshed: %s/%s", sheet_id, gid)
+        else:
+            with _sheet_cache_lock:
+                sheet_cache_stats['errors'] += 1
+    except Exception as e:
+        logger.warning("Sheet cache revalidation error: %s", e)
+        with _sheet_cache_lock:
+            sheet_cache_stats['errors'] += 1
+    finally:
+        with _sheet_cache_lock:
+            entry = _sheet_cache.get(key)
+            if entry:
+                entry['refreshing'] = False
+
+def _fetch_and_store_sheet(key):
+    fetched = _fetch_sheet_csv(*key)
+    if fetched['status'] == 200:
+        _store_sheet_entry(key, fetched)
+    return fetched
+
+def get_google_sheet_data(sheet_id, range_name="A:Z", gid=0):
+    """Fetch data from Google Sheets through the process-wide TTL cache.
+
+    Fresh entries are served from memory. Stale entries are served as-is while
+    a background thread revalidates them with a conditional request; only a
+    cold miss downloads synchronously.
+    """
+    key = (sheet_id, str(gid))
+    ttl = app_settings.get('sheet_cache_ttl', SHEET_CACHE_TTL)
+    revalidate = False
+    
+    with _sheet_cache_lock:
+        entry = _sheet_cache.get(key)
+        if entry:
+            if time.time() - entry['fetched_at'] < ttl:
+                sheet_cache_stats['hits'] += 1
+                return entry['data']
+            
+            sheet_cache_stats['stale_hits'] += 1
+            if not entry['refreshing']:
+                entry['refreshing'] = True
+                sheet_cache_stats['revalidations'] += 1
+                revalidate = True
+            data = entry['data']
+        else:
+            sheet_cache_stats['misses'] += 1
+    
+    if entry:
+        if revalidate:
+            threading.Thread(target=_revalidate_sheet, args=(key,), daemon=True).start()
+        return data
+    
+    try:
+        # หลายคำขอพร้อมกันตอน cache ว่าง ใช้การดาวน์โหลดเดียวกัน
+        fetched = sheet_flight.do(key, _fetch_and_store_sheet, key)
+        if fetched['status'] != 200:
+            with _sheet_cache_lock:
+                sheet_cache_stats['errors'] += 1
+            return None
+        return fetched['data']
+            
+    except Exception as e:
+        logger.exception("Error fetching Google Sheets data: %s", e)
+        with _sheet_cache_lock:
+            sheet_cache_stats['errors'] += 1
+        return None
+
+def is_sheet_cached(sheet_id, gid=0):
+    """True when get_google_sheet_data can answer without a blocking download"""
+    with _sheet_cache_lock:
+        return (sheet_id, str(gid)) in _sheet_cache
+
+def cache_sheet_csv(sheet_id, gid, csv_content, etag=None, last_modified=None, fetch_ms=None):
+    """Parse CSV content fetched elsewhere (e.g. by the async server) into the sheet cache"""
+    with span('csv_parse'):
+        data = SheetSnapshot.from_csv(csv_content)
+    _store_sheet_entry((sheet_id, str(gid)), {
+        'data': data,
+        'etag': etag,
+        'last_modified': last_modified,
+        'fetch_ms': fetch_ms
+    })
+    return data
+
+def invalidate_sheet_cache(sheet_id=None):
+    """Drop cached sheet data - all entries, or only those of ``sheet_id``"""
+    with _sheet_cache_lock:
+        if sheet_id is None:
+            _sheet_cache.clear()
+        else:
+            for key in [k for k in _sheet_cache if k[0] == sheet_id]:
+                del _sheet_cache[key]
+    response_cache.clear('sheet invalidated')
+    logger.info("Sheet cache invalidated: %s", sheet_id or 'all')
+
+def get_sheet_cache_stats():
+    """Snapshot of sheet cache counters and entries"""
+    with _sheet_cache_lock:
+        now = time.time()
+        lookups = sheet_cache_stats['hits'] + sheet_cache_stats['stale_hits'] + sheet_cache_stats['misses']
+        return {
+            **sheet_cache_stats,
+            'hit_rate': round((lookups - sheet_cache_stats['misses']) / lookups, 3) if lookups else 0.0,
+            'ttl': app_settings.get('sheet_cache_ttl', SHEET_CACHE_TTL),
+            'entries': [
+                {
+                    'sheet_id': key[0],
+                    'gid': key[1],
+                    'rows': len(entry['data']) if entry['data'] else 0,
+                    'columns': entry['data'].width if entry['data'] else 0,
+                    'content_hash': entry['data'].content_hash[:12] if entry['data'] else None,
+                    'age': round(now - entry['fetched_at'], 1),
+                    'fetch_ms': entry['fetch_ms'],
+                    'last_diff': entry.get('last_diff'),
+                    'etag': entry['etag'],
+                    'refreshing': entry['refreshing']
+                }
+                for key, entry in _sheet_cache.items()
+            ]
+        }
+
+class CredentialStore:
+    """Username -> keyed password digests for one sheet snapshot.
+
+    Building only maps each username (column A) to its row numbers, so a big
+    sheet costs one pass and no hashing. A row's digest is derived from the
+    snapshot the first time someone logs in as that user and kept for the
+    lifetime of the snapshot; the store never holds its own plaintext copy.
+    On an incremental refresh the digests of unchanged rows carry over.
+
+    Digests are HMAC-SHA256 with a per-process key, not a slow KDF: the
+    plaintext stays in the snapshot in memory anyway, so stretching would
+    only spend CPU (under the GIL) on every login without protecting
+    anything. The digest only allows a constant-time comparison.
+    """
+    
+    def __init__(self, data, previous=None):
+        self.data = data
+        self.users = defaultdict(list)
+        self.hashes = {}
+        self.patched = previous is not None and data.base is previous.data and bool(data.diff)
+        for row in range(1, len(data)):  # ข้ามแถวหัวตาราง
+            if data.row_lengths[row] >= 2:
+                self.users[data.cell(row, 0)].append(row)
+        
+        if self.patched:
+            touched = set(data.diff['changed'])
+            self.hashes = {
+                row: digest for row, digest in previous.hashes.items()
+                if row < len(data) and row not in touched
+            }
+    
+    @staticmethod
+    def digest(password):
+        return hmac.new(_credential_key, password.encode('utf-8'), 'sha256').digest()
+    
+    def _row_hash(self, row):
+        digest = self.hashes.get(row)
+        if digest is None:
+            digest = self.digest(self.data.cell(row, 1))
+            self.hashes[row] = digest
+            with _credential_lock:
+                login_stats['hashes_computed'] += 1
+        return digest
+    
+    def verify(self, username, password):
+        """Row number whose password matches, or None (unknown users cost no hashing)"""
+        rows = self.users.get(username, ())
+        candidate = self.digest(password) if rows else None
+        for row in rows:
+            if hmac.compare_digest(candidate, self._row_hash(row)):
+                return row
+        return None
+    
+    def stats(self):
+        return {
+            'users': len(self.users),
+            'hashed_rows': len(self.hashes),
+            'content_hash': self.data.content_hash[:12]
+        }
+
+_credential_store = None
+_credential_lock = threading.Lock()
+_credential_key = os.urandom(32)
+# ความพยายามที่ล้มเหลวล่าสุด: (username, keyed digest ของรหัสผ่าน) -> (content_hash, expiry)
+_failed_logins = OrderedDict()
+_failed_login_key = os.urandom(32)
+login_stats = {
+    'store_builds': 0,
+    'store_patches': 0,
+    'hashes_computed': 0,
+    'negative_hits': 0,
+    'successes': 0,
+    'failures': 0
+}
+
+def get_credential_store():
+    """CredentialStore for the current main-sheet snapshot, rebuilt only when the snapshot changes"""
+    global _credential_store
+    data = get_google_sheet_data(app_settings['google_sheet_id'])
+    if not data:
+        return None
+    
+    with _credential_lock:
+        store = _credential_store
+        if store is None or store.data is not data:
+            store = CredentialStore(data, previous=store)
+            login_stats['store_patches' if store.patched else 'store_builds'] += 1
+            logger.info("Credential store rebuilt: %s", store.stats())
+            _credential_store = store
+        return store
+
+def _failed_login_entry(username, password):
+    return (username, hmac.new(_failed_login_key, password.encode('utf-8'), 'sha256').digest())
+
+def authenticate_user(username, password):
+    """Authenticate user - first check default credentials, then the sheet credential store"""
+    try:
+        # Check default credentials first
+        if username == DEFAULT_USER and password == DEFAULT_PASSWORD:
+            logger.debug("User authenticated with default credentials: %s", username)
+            return True
+        if not username or not isinstance(password, str):
+            return False
+        
+        store = get_credential_store()
+        if store is None:
+            logger.debug("User authentication failed (no sheet data): %s", username)
+            return False
+        
+        failed_key = _failed_login_entry(username, password)
+        with _credential_lock:
+            failed = _failed_logins.get(failed_key)
+            # จำความล้มเหลวไว้เฉพาะกับ snapshot เดิม - ชีตเปลี่ยนแล้วต้องตรวจใหม่
+            if failed and failed[0] == store.data.content_hash and failed[1] > time.time():
+                login_stats['negative_hits'] += 1
+                login_stats['failures'] += 1
+                logger.debug("User authentication failed (cached): %s", username)
+                return False
+        
+        # ตรวจนอก lock เพื่อให้ login พร้อมกันไม่ต้องรอคิว
+        row = store.verify(username, password)
+        with _credential_lock:
+            if row is not None:
+                _failed_logins.pop(failed_key, None)
+                login_stats['successes'] += 1
+                logger.debug("User found in Google Sheets at row %d", row + 1)
+                return True
+            
+            _failed_logins[failed_key] = (store.data.content_hash, time.time() + LOGIN_NEGATIVE_CACHE_TTL)
+            _failed_logins.move_to_end(failed_key)
+            while len(_failed_logins) > LOGIN_NEGATIVE_CACHE_SIZE:
+                _failed_logins.popitem(last=False)
+            login_stats['failures'] += 1
+        
+        logger.debug("User authentication failed: %s", username)
+        return False
+    except Exception as e:
+        logger.error("Authentication error: %s", e)
+        # If Google Sheets fails, still allow default login
+        return username == DEFAULT_USER and password == DEFAULT_PASSWORD
+
+def get_login_stats():
+    with _credential_lock:
+        return {
+            **login_stats,
+            'negative_cache_entries': len(_failed_logins),
+            'store': _credential_store.stats() if _credential_store else None
+        }
+
+# ---------------------------------------------------------------------------
+# Tokenizers - ใช้ร่วมกันทั้งตอนสร้าง index และตอนตัดคำคำถาม
+# ---------------------------------------------------------------------------
+
+# ช่วงอักษรไทยแยกจากอักษร/ตัวเลขอื่น เช่น "ลูกค้าSD123" -> "ลูกค้า", "SD123"
+_WORD_RUN_RE = re.compile(r'[ก-๙]+|[^\W_ก-๙]+')
+
+# พจนานุกรมคำไทยพื้นฐานสำหรับตัดคำคำถาม (คำจากชีตจะถูกเพิ่มตอนสร้าง index)
+THAI_WORDS = {
+    'ขอ', 'ดู', 'ข้อมูล', 'แสดง', 'ทั้งหมด', 'แถว', 'แรก', 'รายการ', 'ของ', 'ที่', 'มี',
+    'อะไร', 'บ้าง', 'ไหม', 'หรือ', 'และ', 'กับ', 'ใน', 'คือ', 'เป็น', 'ให้', 'หน่อย',
+    'ครับ', 'ค่ะ', 'คะ', 'จ้า', 'ช่วย', 'หา', 'ค้นหา', 'เท่าไร', 'เท่าไหร่', 'กี่', 'ไหน',
+    'ใคร', 'เมื่อไร', 'อยาก', 'ทราบ', 'รู้', 'เกี่ยวกับ', 'จาก', 'ลูกค้า', 'สินค้า', 'ชื่อ',
+    'นามสกุล', 'รหัส', 'เลขที่', 'ราคา', 'จำนวน', 'ยอด', 'ยอดขาย', 'ที่อยู่', 'เบอร์',
+    'โทร', 'โทรศัพท์', 'อีเมล', 'วันที่', 'เดือน', 'ปี', 'สถานะ', 'ประเภท', 'หมวด',
+    'หมวดหมู่', 'พนักงาน', 'แผนก', 'บริษัท', 'จังหวัด', 'อำเภอ', 'ตำบล', 'สาขา',
+    'คำสั่งซื้อ', 'ใบแจ้งหนี้', 'สัญญา', 'บริการ', 'หมายเหตุ', 'รายละเอียด', 'นาย',
+    'นาง', 'นางสาว', 'คุณ',
+}
+
+# คำที่ไม่ใช้ในการค้นหา (คำสุภาพ คำถาม และคำสั่งให้แสดงข้อมูล)
+SEARCH_STOPWORDS = {
+    'ขอ', 'ดู', 'ข้อมูล', 'แสดง', 'ทั้งหมด', 'แถว', 'แรก', 'รายการ', 'ของ', 'ที่', 'มี',
+    'อะไร', 'บ้าง', 'ไหม', 'หรือ', 'และ', 'กับ', 'ใน', 'คือ', 'เป็น', 'ให้', 'หน่อย',
+    'ครับ', 'ค่ะ', 'คะ', 'จ้า', 'ช่วย', 'หา', 'ค้นหา', 'เท่าไร', 'เท่าไหร่', 'กี่', 'ไหน',
+    'ใคร', 'เมื่อไร', 'อยาก', 'ทราบ', 'รู้', 'เกี่ยวกับ', 'จาก', 'คุณ',
+    'show', 'display', 'view', 'data', 'first', 'rows', 'row', 'the', 'of', 'me', 'all',
+}
+
+def _is_thai_run(run):
+    return 'ก' <= run[0] <= '๙'
+
+class SimpleTokenizer:
+    """Split on non-word characters; each Thai run is one token"""
+    
+    name = 'simple'
+    
+    def learn(self, texts):
+        pass
+    
+    def tokenize(self, text):
+        return _WORD_RUN_RE.findall(text.lower())
+
+class NgramTokenizer(SimpleTokenizer):
+    """Thai runs become overlapping character bigrams, other runs stay whole"""
+    
+    name = 'ngram'
+    size = 2
+    
+    def tokenize(self, text):
+        tokens = []
+        for run in _WORD_RUN_RE.findall(text.lower()):
+            if _is_thai_run(run) and len(run) > self.size:
+                tokens.extend(run[i:i + self.size] for i in range(len(run) - self.size + 1))
+            else:
+                tokens.append(run)
+        return tokens
+
+class ThaiDictTokenizer(SimpleTokenizer):
+    """Greedy longest-matching Thai segmenter over THAI_WORDS plus words learned from the sheet.
+
+    Characters not covered by the dictionary are kept together as one
+    unknown chunk; the index answers those through its character n-grams.
+    """
+    
+    name = 'thai'
+    max_learned_length = 20
+    
+    def __init__(self):
+        self.words = set(THAI_WORDS)
+        self.max_length = max(len(word) for word in self.words)
+    
+    def learn(self, texts):
+        # คำสั้นๆ ที่อยู่ในเซลล์ เช่น ชื่อคน ชื่อสินค้า ถือเป็นคำในพจนานุกรม
+        for text in texts:
+            for run in _WORD_RUN_RE.findall(text.lower()):
+                if _is_thai_run(run) and 1 < len(run) <= self.max_learned_length:
+                    self.words.add(run)
+        self.max_length = max(len(word) for word in self.words)
+    
+    def _segment(self, run):
+        tokens = []
+        unknown_start = None
+        pos = 0
+        while pos < len(run):
+            for length in range(min(self.max_length, len(run) - pos), 0, -1):
+                if run[pos:pos + length] in self.words:
+                    break
+            else:
+                length = 0
+            
+            if length:
+                if unknown_start is not None:
+                    tokens.append(run[unknown_start:pos])
+                    unknown_start = None
+                tokens.append(run[pos:pos + length])
+                pos += length
+            else:
+                if unknown_start is None:
+                    unknown_start = pos
+                pos += 1
+        
+        if unknown_start is not None:
+            tokens.append(run[unknown_start:])
+        return tokens
+    
+    def tokenize(self, text):
+        tokens = []
+        for run in _WORD_RUN_RE.findall(text.lower()):
+            if _is_thai_run(run):
+                tokens.extend(self._segment(run))
+            else:
+                tokens.append(run)
+        return tokens
+
+class JiebaTokenizer(SimpleTokenizer):
+    """jieba segmentation for Chinese content (Thai runs pass through whole)"""
+    
+    name = 'jieba'
+    
+    def tokenize(self, text):
+        return [token for token in (t.strip().lower() for t in jieba.lcut(text)) if token]
+
+TOKENIZERS = {
+    'simple': SimpleTokenizer,
+    'ngram': NgramTokenizer,
+    'thai': ThaiDictTokenizer,
+}
+if jieba is not None:
+    TOKENIZERS['jieba'] = JiebaTokenizer
+
+def register_tokenizer(name, tokenizer_class):
+    """Register a tokenizer class (with ``learn`` and ``tokenize``) under ``name``"""
+    TOKENIZERS[name] = tokenizer_class
+
+def get_tokenizer_name():
+    name = app_settings.get('search_tokenizer', 'thai')
+    return name if name in TOKENIZERS else 'thai'
+
+def tokenize_query(tokenizer, query):
+    """Search terms of a question: tokens without stopwords and single Thai characters"""
+    return list(dict.fromkeys(
+        token for token in tokenizer.tokenize(query)
+        if token not in SEARCH_STOPWORDS and not (len(token) == 1 and _is_thai_run(token))
+    ))
+
+class SheetIndex:
+    """Lowercase inverted index over one sheet snapshot.
+
+    Built once per snapshot; holds a character-trigram index for substring
+    queries and a token index produced by the configured tokenizer. Queries
+    look up posting lists and verify only those candidate rows, instead of
+    scanning every cell.
+    """
+    
+    GRAM_SIZE = 3
+    # ตัวคั่นระหว่างเซลล์ เพื่อไม่ให้คำค้นหาจับคู่ข้ามเซลล์
+    CELL_SEPARATOR = '\x00'
+    # จำนวนแถวสูงสุดต่อคำ เมื่อต้องย้อนไปค้นด้วย n-gram
+    TERM_ROW_LIMIT = 2000
+    QUERY_CACHE_SIZE = 1024
+    # BM25 (term frequency แบบมี/ไม่มี เพราะแถวสั้น) และคะแนนเพิ่มเมื่อคำตรงกับคอลัมน์ที่ถามถึง
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+    FIELD_BOOST = 2.0
+    EXACT_CELL_BOOST = 1.0
+    
+    def __init__(self, data, tokenizer_name='thai'):
+        started = time.time()
+        self.data = data
+        self.haystacks = []
+        self.row_lengths = array('I')
+        postings = defaultdict(lambda: array('I'))
+        token_postings = defaultdict(lambda: array('I'))
+        
+        row_cells = [[cell for cell in row if cell] for row in data]
+        self.tokenizer = TOKENIZERS[tokenizer_name]()
+        self.tokenizer.learn(cell for cells in row_cells for cell in cells)
+        
+        for row_idx, cells in enumerate(row_cells):
+            haystack = self.CELL_SEPARATOR.join(cells).lower()
+            self.haystacks.append(haystack)
+            for gram in self._grams(haystack):
+                postings[gram].append(row_idx)
+            # ตัดคำครั้งเดียวตอนสร้าง index
+            tokens = {token for cell in cells for token in self.tokenizer.tokenize(cell)}
+            self.row_lengths.append(len(tokens))
+            for token in tokens:
+                token_postings[token].append(row_idx)
+        
+        self.postings = dict(postings)
+        self.token_postings = dict(token_postings)
+        self.header_tokens = {
+            token for row_idx in data.header_rows for token in self.tokenizer.tokenize(' '.join(row_cells[row_idx]))
+        }
+        self._query_terms = {}
+        self._vocab_grams = None
+        self._field_columns = {}
+        self.total_length = sum(self.row_lengths)
+        self.patched_rows = 0
+        self.build_time = time.time() - started
+    
+    def _row_terms(self, data, row_idx):
+        """(haystack, token set) of one row, as __init__ indexes it"""
+        cells = [cell for cell in data[row_idx] if cell]
+        tokens = {token for cell in cells for token in self.tokenizer.tokenize(cell)}
+        return self.CELL_SEPARATOR.join(cells).lower(), tokens
+    
+    def patched(self, data):
+        """New index for ``data`` built by patching this one with ``data.diff``.
+
+        Copy-on-write: posting lists are copied only where a changed row
+        touches them, so searches running on this index are not disturbed.
+        The tokenizer (and its learned dictionary) is shared, keeping row and
+        query tokenization consistent; returns None when accumulated patches
+        exceed INCREMENTAL_REFRESH_MAX_FRACTION of the rows, so the caller
+        rebuilds (and re-learns) from scratch.
+        """
+        diff = data.diff
+        old_rows = len(self.haystacks)
+        new_rows = diff['rows']
+        patched_rows = self.patched_rows + data.touched_rows()
+        if patched_rows > INCREMENTAL_REFRESH_MAX_FRACTION * max(new_rows, 1):
+            return None
+        
+        index = object.__new__(SheetIndex)
+        index.data = data
+        index.tokenizer = self.tokenizer
+        index.haystacks = self.haystacks[:new_rows] + [''] * (new_rows - old_rows)
+        index.postings = dict(self.postings)
+        index.token_postings = dict(self.token_postings)
+        index.row_lengths = self.row_lengths[:new_rows]
+        index.row_lengths.extend([0] * (new_rows - old_rows))
+        index._query_terms = {}
+        index._vocab_grams = None
+        index._field_columns = {}
+        index.patched_rows = patched_rows
+        started = time.time()
+        
+        copied = set()
+        
+        def writable(postings, kind, key):
+            rows = postings.get(key)
+            if (kind, key) not in copied:
+                rows = array('I', rows) if rows is not None else array('I')
+                postings[key] = rows
+                copied.add((kind, key))
+            return rows
+        
+        def unindex(row_idx):
+            haystack, tokens = self._row_terms(self.data, row_idx)
+            for kind, postings, keys in (('g', index.postings, self._grams(haystack)), ('t', index.token_postings, tokens)):
+                for key in keys:
+                    rows = writable(postings, kind, key)
+                    position = bisect.bisect_left(rows, row_idx)
+                    if position < len(rows) and rows[position] == row_idx:
+                        rows.pop(position)
+                    if not rows:
+                        del postings[key]
+                        copied.discard((kind, key))
+        
+        def reindex(row_idx):
+            haystack, tokens = self._row_terms(data, row_idx)
+            index.haystacks[row_idx] = haystack
+            index.row_lengths[row_idx] = len(tokens)
+            for kind, postings, keys in (('g', index.postings, self._grams(haystack)), ('t', index.token_postings, tokens)):
+                for key in keys:
+                    rows = writable(postings, kind, key)
+                    if not rows or rows[-1] < row_idx:
+                        rows.append(row_idx)
+                    else:
+                        rows.insert(bisect.bisect_left(rows, row_idx), row_idx)
+        
+        for row_idx in diff['changed']:
+            unindex(row_idx)
+            reindex(row_idx)
+        for row_idx in range(new_rows, old_rows):
+            unindex(row_idx)
+        for row_idx in range(old_rows, new_rows):
+            reindex(row_idx)
+        
+        if (data.header_rows != self.data.header_rows or old_rows == 0 or new_rows == 0
+                or not set(diff['changed']).isdisjoint(data.header_rows)):
+            index.header_tokens = {
+                token for row_idx in data.header_rows for token in index._row_terms(data, row_idx)[1]
+            }
+        else:
+            index.header_tokens = self.header_tokens
+        index.total_length = sum(index.row_lengths)
+        index.build_time = time.time() - started
+        return index
+    
+    @classmethod
+    def _grams(cls, text):
+        n = cls.GRAM_SIZE
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+    
+    def format_row(self, row_idx):
+        """Display string in the search result format"""
+        return f"{self.data.row_label(row_idx)}: {self.data.display(row_idx)}"
+    
+    def search(self, query_lower, limit=5):
+        """Return up to ``limit`` row indices (in sheet order) whose cells contain ``query_lower``"""
+        if len(query_lower) < self.GRAM_SIZE:
+            candidates = range(len(self.haystacks))
+        else:
+            grams = self._grams(query_lower)
+            if any(gram not in self.postings for gram in grams):
+                return []
+            candidates = min((self.postings[gram] for gram in grams), key=len)
+        
+        matches = []
+        for row_idx in candidates:
+            haystack = self.haystacks[row_idx]
+            if haystack and query_lower in haystack:
+                matches.append(row_idx)
+                if len(matches) >= limit:
+                    break
+        return matches
+    
+    def query_terms(self, query):
+        """Tokenize a question into search terms (stopwords removed), memoized per snapshot"""
+        terms = self._query_terms.get(query)
+        if terms is None:
+            terms = tokenize_query(self.tokenizer, query)
+            if len(self._query_terms) >= self.QUERY_CACHE_SIZE:
+                self._query_terms.clear()
+            self._query_terms[query] = terms
+        return terms
+    
+    def rows_for_term(self, term):
+        """Rows containing ``term`` - from the token index, else the n-gram index"""
+        rows = self.token_postings.get(term)
+        if rows is not None:
+            return rows
+        return self.search(term, limit=self.TERM_ROW_LIMIT)
+    
+    def _score_rows(self, weighted_rows):
+        """BM25 scores from ``(rows, factor)`` pairs - binary term frequency, row length in tokens"""
+        scores = defaultdict(float)
+        total_rows = len(self.haystacks)
+        average_length = self.total_length / total_rows if self.total_length else 1.0
+        k1, b = self.BM25_K1, self.BM25_B
+        row_lengths = self.row_lengths
+        for rows, factor in weighted_rows:
+            if not rows:
+                continue
+            idf = math.log(1 + (total_rows - len(rows) + 0.5) / (len(rows) + 0.5)) * factor
+            for row_idx in rows:
+                scores[row_idx] += idf * (k1 + 1) / (1 + k1 * (1 - b + b * row_lengths[row_idx] / average_length))
+        return scores
+    
+    def _rank_rows(self, weighted_rows, limit):
+        """Rank rows from ``(rows, factor)`` pairs by BM25 score"""
+        scores = self._score_rows(weighted_rows)
+        ranked = sorted(scores, key=lambda row_idx: (-scores[row_idx], row_idx))
+        return ranked[:limit]
+    
+    def search_terms(self, terms, limit=5):
+        """Rank rows by BM25 over the rows containing each of ``terms``"""
+        return self._rank_rows(((self.rows_for_term(term), 1.0) for term in terms), limit)
+    
+    def field_columns(self, header_row):
+        """token -> columns whose header (in ``header_row``) contains that token"""
+        fields = self._field_columns.get(header_row)
+        if fields is None:
+            fields = defaultdict(set)
+            for col, name in enumerate(self.data[header_row]):
+                for token in self.tokenizer.tokenize(name):
+                    fields[token].add(col)
+            fields = self._field_columns[header_row] = dict(fields)
+        return fields
+    
+    def rank(self, terms, limit=5, candidates=None):
+        """Best ``limit`` rows for ``terms``: BM25 plus header-aware field matching.
+
+        Terms naming a column (``จังหวัด``, ``ราคา``) are not scored on their
+        own; instead a row whose cell in that column contains another term
+        gets FIELD_BOOST. A cell equal to a term adds EXACT_CELL_BOOST.
+        ``candidates`` limits ranking to those rows (e.g. whole-query hits).
+        """
+        field_terms = [term for term in terms if term in self.header_tokens]
+        value_terms = [term for term in terms if term not in self.header_tokens] or terms
+        scores = self._score_rows((self.rows_for_term(term), 1.0) for term in value_terms)
+        if candidates is not None:
+            scores = {row_idx: scores.get(row_idx, 0.0) for row_idx in candidates}
+        
+        # ตรวจ field เฉพาะกลุ่มคะแนนต้นๆ ไม่ต้องอ่านเซลล์ทุกแถว
+        pool = sorted(scores, key=lambda row_idx: (-scores[row_idx], row_idx))[:max(limit * 4, 50)]
+        for row_idx in pool:
+            header_row = self.data.header_row_of(row_idx)
+            if row_idx == header_row:
+                continue
+            fields = self.field_columns(header_row)
+            wanted = {col for term in field_terms for col in fields.get(term, ())}
+            for col, cell in enumerate(self.data[row_idx]):
+                cell = cell.lower()
+                for term in value_terms:
+                    if term in cell:
+                        if col in wanted:
+                            scores[row_idx] += self.FIELD_BOOST
+                        if cell == term:
+                            scores[row_idx] += self.EXACT_CELL_BOOST
+        return sorted(pool, key=lambda row_idx: (-scores[row_idx], row_idx))[:limit]
+    
+    def header_line(self, row_idx):
+        """``(key, formatted header row)`` of ``row_idx``'s source, for context packing"""
+        header_row = self.data.header_row_of(row_idx)
+        return header_row, self.format_row(header_row)
+    
+    def _build_vocab_grams(self):
+        # trigram -> คำใน vocabulary (เติมตัวกำกับหัว/ท้ายเพื่อให้คำสั้นมี trigram)
+        vocab_grams = defaultdict(list)
+        for token in self.token_postings:
+            for gram in self._grams(f"\x02{token}\x03"):
+                vocab_grams[gram].append(token)
+        self._vocab_grams = dict(vocab_grams)
+    
+    def similar_tokens(self, term, threshold, deadline, max_candidates=200):
+        """Vocabulary tokens whose Levenshtein similarity to ``term`` is at least ``threshold`` (0-1).
+
+        Candidates are pruned to tokens sharing trigrams with ``term`` and
+        scored most-shared first until ``deadline`` passes. Returns
+        ``(matches, complete)`` where matches is a list of (token, similarity).
+        """
+        if self._vocab_grams is None:
+            self._build_vocab_grams()
+        
+        # นับ trigram ที่ตรงกัน เริ่มจาก trigram ที่พบน้อยที่สุด
+        shared = defaultdict(int)
+        gram_lists = sorted(
+            (self._vocab_grams.get(gram, ()) for gram in self._grams(f"\x02{term}\x03")),
+            key=len
+        )
+        for tokens in gram_lists:
+            if time.perf_counter() > deadline:
+                break
+            for token in tokens:
+                shared[token] += 1
+        
+        term_length = len(term)
+        candidates = sorted(shared, key=shared.get, reverse=True)[:max_candidates]
+        matches = []
+        for scored, token in enumerate(candidates):
+            if scored % 16 == 0 and time.perf_counter() > deadline:
+                return matches, False
+            # ratio ไม่มีทางเกิน 2*min/(a+b) - ข้ามคำที่ความยาวต่างกันมาก
+            token_length = len(token)
+            if 2 * min(term_length, token_length) / (term_length + token_length) < threshold:
+                continue
+            similarity = levenshtein_ratio(term, token)
+            if similarity >= threshold:
+                matches.append((token, similarity))
+        return matches, True
+    
+    def search_fuzzy(self, terms, threshold, budget_ms, limit=5):
+        """Rank rows by tokens similar to ``terms``; returns ``(rows, within_budget)``"""
+        if self._vocab_grams is None:
+            # สร้างครั้งเดียวต่อ snapshot ไม่นับรวมใน budget ของคำค้น
+            self._build_vocab_grams()
+        
+        deadline = time.perf_counter() + budget_ms / 1000
+        weighted_rows = []
+        within_budget = True
+        for term in terms:
+            matches, complete = self.similar_tokens(term, threshold, deadline)
+            within_budget = within_budget and complete
+            weighted_rows.extend((self.token_postings[token], similarity) for token, similarity in matches)
+            if not complete:
+                break
+        return self._rank_rows(weighted_rows, limit), within_budget
+    
+    def stats(self):
+        return {
+            'rows': len(self.haystacks),
+            'grams': len(self.postings),
+            'tokens': len(self.token_postings),
+            'tokenizer': self.tokenizer.name,
+            'build_ms': round(self.build_time * 1000, 1),
+            'patched_rows': self.patched_rows
+        }
+
+# Search index ต่อ snapshot ของชีต (key = (sheet_id, gid))
+_search_indexes = {}
+_search_index_lock = threading.Lock()
+search_stats = {
+    'fuzzy_queries': 0,
+    'fuzzy_budget_exceeded': 0,
+    'index_builds': 0,
+    'index_patches': 0,
+    'contexts_built': 0,
+    'context_rows_dropped': 0,
+    'context_tokens': 0
+}
+
+def get_search_index(sheet_id, gid=0):
+    """Return the SheetIndex for the current cached snapshot, building it on first use"""
+    data = get_google_sheet_data(sheet_id, gid=gid)
+    if not data:
+        return None
+    return get_snapshot_index((sheet_id, str(gid)), data)
+
+def get_snapshot_index(key, data):
+    """SheetIndex of snapshot ``data`` stored under ``key`` - reused, patched or rebuilt"""
+    tokenizer_name = get_tokenizer_name()
+    with _search_index_lock:
+        index = _search_indexes.get(key)
+        if index is not None and index.data is data and index.tokenizer.name == tokenizer_name:
+            return index
+    # คำขอพร้อมกันที่เห็น snapshot ใหม่เดียวกัน รอ index ที่สร้างครั้งเดียว (data ยังมีชีวิตอยู่ id จึงไม่ซ้ำ)
+    return index_flight.do((key, id(data), tokenizer_name), _update_snapshot_index, key, data, tokenizer_name)
+
+def _update_snapshot_index(key, data, tokenizer_name):
+    with _search_index_lock:
+        index = _search_indexes.get(key)
+        if index is not None and index.data is data and index.tokenizer.name == tokenizer_name:
+            return index
+    
+    if index is not None and data.base is index.data and index.tokenizer.name == tokenizer_name:
+        # refresh แบบ incremental - patch เฉพาะแถวที่เปลี่ยน
+        patched = index.patched(data)
+        if patched is not None:
+            logger.info("Patched search index for %s/%s: %d rows in %s ms", key[0], key[1], data.touched_rows(), patched.stats()['build_ms'])
+            with _search_index_lock:
+                _search_indexes[key] = patched
+                search_stats['index_patches'] += 1
+            return patched
+    
+    # snapshot ใหม่ (หรือเปลี่ยน tokenizer) - สร้าง index ใหม่นอก lock
+    index = SheetIndex(data, tokenizer_name)
+    logger.info("Built search index for %s/%s: %s", key[0], key[1], index.stats())
+    with _search_index_lock:
+        _search_indexes[key] = index
+        search_stats['index_builds'] += 1
+    return index
+
+# ---------------------------------------------------------------------------
+# Data sources - Google Sheets, ไฟล์ CSV และ SQLite ค้นหารวมกัน
+# ---------------------------------------------------------------------------
+
+_source_fetch_pool = ThreadPoolExecutor(max_workers=SOURCE_FETCH_WORKERS, thread_name_prefix='sheet-source')
+MERGED_INDEX_KEY = ('sources', 'merged')
+
+def _local_data_path(path):
+    """Absolute path of ``path`` under LOCAL_DATA_DIR; raises ValueError outside it or when missing"""
+    if not path:
+        raise ValueError('กรุณาใส่ path ของไฟล์')
+    root = os.path.realpath(LOCAL_DATA_DIR)
+    full_path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full_path]) != root:
+        raise ValueError(f'ไฟล์ต้องอยู่ในโฟลเดอร์ {LOCAL_DATA_DIR}')
+    if not os.path.isfile(full_path):
+        raise ValueError(f'ไม่พบไฟล์: {path}')
+    return full_path
+
+def _file_version(*paths):
+    """(mtime, size) of each existing path - changes whenever a file is rewritten"""
+    version = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+_ASCII_LETTERS_RE = re.compile(b'[a-z]+')
+
+def _display_cells(cells):
+    return ' | '.join(str(cell) for cell in cells if cell not in (None, ''))
+
+class SheetsBackend:
+    """Google Sheets CSV export - cached, snapshotted and indexed in memory"""
+    
+    type = 'sheets'
+    in_memory = True
+    
+    def __init__(self, source):
+        self.source = source
+        self.key = (source['sheet_id'], source['gid'])
+    
+    @staticmethod
+    def normalize(source):
+        sheet_id = str(source.get('sheet_id', '')).strip()
+        gid = str(source.get('gid', '0')).strip() or '0'
+        if not sheet_id:
+            raise ValueError('กรุณาใส่ Sheet ID')
+        if not gid.isdigit():
+            raise ValueError(f'gid ไม่ถูกต้อง: {gid}')
+        label = str(source.get('label', '')).strip() or f"{sheet_id[:8]}/{gid}"
+        return {'type': 'sheets', 'sheet_id': sheet_id, 'gid': gid, 'label': label}
+    
+    def is_cached(self):
+        return is_sheet_cached(*self.key)
+    
+    def snapshot(self):
+        return get_google_sheet_data(self.key[0], gid=self.key[1])
+    
+    def search_index(self):
+        return get_search_index(*self.key)
+    
+    def preview(self, num_rows):
+        """``(first rows, total rows)`` or None when the source is unreachable"""
+        data = self.snapshot()
+        return (data[:num_rows], len(data)) if data else None
+    
+    def status(self):
+        with _sheet_cache_lock:
+            entry = _sheet_cache.get(self.key)
+        return {
+            'cached': entry is not None,
+            'rows': len(entry['data']) if entry else 0,
+            'fetch_ms': entry['fetch_ms'] if entry else None,
+            'age': round(time.time() - entry['fetched_at'], 1) if entry else None
+        }
+
+class LocalCSVBackend:
+    """CSV file under LOCAL_DATA_DIR.
+
+    Files up to LOCAL_CSV_MEMORY_MAX_BYTES (or ``mode: memory``) are parsed
+    into a SheetSnapshot, reloaded when the file changes, and searched like a
+    sheet. Larger files stay on disk: the file is memory-mapped, record
+    offsets are kept in one array, and each query scans the mapping with a
+    bytes regex and parses only the matching records, so a 1M-row export
+    never becomes Python lists.
+    """
+    
+    type = 'csv'
+    
+    def __init__(self, source):
+        self.source = source
+        self.path = _local_data_path(source['path'])
+        self.key = ('csv', self.path)
+        mode = source.get('mode', 'auto')
+        self.in_memory = mode == 'memory' or (
+            mode == 'auto' and os.path.getsize(self.path) <= LOCAL_CSV_MEMORY_MAX_BYTES
+        )
+        self._lock = threading.Lock()
+        # (version, snapshot) หรือ (version, mmap, record offsets) - สลับทั้ง tuple เพื่อให้ผู้อ่านไม่ต้องล็อก
+        self._state = None
+        self.header = []
+        # นับแยกจาก sheet_cache_stats - ไฟล์ที่โหลดใหม่ไม่ใช่การ refresh ของ Google Sheets
+        self.refresh_stats = {'reloads': 0, 'incremental_refreshes': 0, 'full_refreshes': 0, 'rows_changed': 0}
+    
+    @staticmethod
+    def normalize(source):
+        path = str(source.get('path', '')).strip()
+        _local_data_path(path)
+        mode = str(source.get('mode', 'auto')).strip() or 'auto'
+        if mode not in ('auto', 'memory', 'mmap'):
+            raise ValueError(f'mode ไม่ถูกต้อง: {mode}')
+        label = str(source.get('label', '')).strip() or os.path.basename(path)
+        return {'type': 'csv', 'path': path, 'mode': mode, 'label': label}
+    
+    def _current(self):
+        version = _file_version(self.path)
+        state = self._state
+        if state is not None and state[0] == version:
+            return state
+        with self._lock:
+            if self._state is not None and self._state[0] == version:
+                return self._state
+            started = time.perf_counter()
+            if self.in_memory:
+                with open(self.path, encoding='utf-8-sig', newline='') as f:
+                    previous = self._state[1] if self._state else None
+                    data = SheetSnapshot.from_csv(f.read(), previous=previous)
+                if previous is not None and data is not previous:
+                    _apply_snapshot_change(self.key, previous, data, self.refresh_stats)
+                self.header = list(data[0]) if len(data) else []
+                self._state = (version, data)
+            else:
+                # mmap เดิมปิดเองเมื่อไม่มีคำค้นที่ใช้อยู่ (ไม่ปิดขณะถูกอ่าน)
+                with open(self.path, 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if version[0][1] else b''
+                offsets = self._record_offsets(mapped)
+                self._state = (version, mapped, offsets)
+                self.header = self._record(self._state, 0) if offsets else []
+                if state is not None:
+                    response_cache.clear('local file changed')
+            if state is not None:
+                self.refresh_stats['reloads'] += 1
+            logger.info("Loaded %s (%s) in %.1f ms", self.path, 'memory' if self.in_memory else 'mmap',
+                        (time.perf_counter() - started) * 1000)
+            return self._state
+    
+    @staticmethod
+    def _record_offsets(mapped):
+        """Start offset of every CSV record (newlines inside quoted cells do not start one)"""
+        offsets = array('Q', [0] if len(mapped) else [])
+        if mapped.find(b'"') == -1:
+            offsets.extend(match.end() for match in re.finditer(b'\n', mapped))
+        else:
+            quoted = False
+            for match in re.finditer(b'[\n"]', mapped):
+                if match.group() == b'"':
+                    quoted = not quoted
+                elif not quoted:
+                    offsets.append(match.end())
+        if offsets and offsets[-1] == len(mapped):
+            offsets.pop()  # newline ท้ายไฟล์
+        return offsets
+    
+    @staticmethod
+    def _record(state, row):
+        _, mapped, offsets = state
+        end = offsets[row + 1] if row + 1 < len(offsets) else len(mapped)
+        text = mapped[offsets[row]:end].decode('utf-8', 'replace')
+        if row == 0:
+            text = text.lstrip('\ufeff')
+        cells = next(csv.reader(StringIO(text)), [])
+        return _repair_escaped_cells(cells) if '\\u' in text else cells
+    
+    def is_cached(self):
+        return self._state is not None and self._state[0] == _file_version(self.path)
+    
+    def snapshot(self):
+        return self._current()[1] if self.in_memory else None
+    
+    def search_index(self):
+        data = self.snapshot()
+        return get_snapshot_index(self.key, data) if data else None
+    
+    def __len__(self):
+        state = self._current()
+        return len(state[1]) if self.in_memory else len(state[2])
+    
+    def _scan(self, state, text, limit):
+        """Rows (ascending) with a cell containing ``text``, up to ``limit``"""
+        text = text.lower()
+        needle = text.encode('utf-8')
+        _, mapped, offsets = state
+        # ส่วนที่ยาวที่สุดที่ไม่มีอักษรละติน ค้นด้วย mmap.find ได้เลยโดยไม่ต้องสนตัวพิมพ์เล็ก/ใหญ่
+        anchor = max(_ASCII_LETTERS_RE.split(needle), key=len)
+        if len(anchor) >= 3:
+            find = lambda start: mapped.find(anchor, start)
+        else:
+            pattern = re.compile(re.escape(needle), re.IGNORECASE)
+            find = lambda start: (lambda match: match.start() if match else -1)(pattern.search(mapped, start))
+        
+        rows = []
+        position = find(0)
+        while position != -1:
+            row = bisect.bisect_right(offsets, position) - 1
+            # ยืนยันกับเซลล์จริง (ตัวพิมพ์และไม่จับคู่ข้ามตัวคั่น)
+            if any(text in cell.lower() for cell in self._record(state, row)):
+                rows.append(row)
+                if len(rows) >= limit:
+                    break
+            if row + 1 >= len(offsets):
+                break
+            position = find(offsets[row + 1])
+        return rows
+    
+    def search(self, query_lower, limit=5):
+        return self._scan(self._current(), query_lower, limit)
+    
+    def search_terms(self, terms, limit=5):
+        """Rank records by the IDF-weighted number of ``terms`` they contain (one scan per term)"""
+        state = self._current()
+        scores = defaultdict(float)
+        for term in terms:
+            rows = self._scan(state, term, SheetIndex.TERM_ROW_LIMIT)
+            weight = math.log(1 + len(state[2]) / len(rows)) if rows else 0
+            for row in rows:
+                scores[row] += weight
+        return sorted(scores, key=lambda row: (-scores[row], row))[:limit]
+    
+    def format_row(self, row):
+        return f"[{self.source['label']}] แถวที่ {row + 1}: {_display_cells(self._record(self._current(), row))}"
+    
+    def header_line(self, row):
+        return 0, self.format_row(0)
+    
+    def first_rows(self, num_rows):
+        return list(range(min(num_rows, len(self))))
+    
+    def preview(self, num_rows):
+        state = self._current()
+        if self.in_memory:
+            return state[1][:num_rows], len(state[1])
+        return [self._record(state, row) for row in range(min(num_rows, len(state[2])))], len(state[2])
+    
+    def status(self):
+        state = self._state
+        return {
+            'cached': state is not None,
+            'loaded_as': 'memory' if self.in_memory else 'mmap',
+            'rows': (len(state[1]) if self.in_memory else len(state[2])) if state else 0,
+            'bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+            **self.refresh_stats
+        }
+
+def _quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+class SQLiteBackend:
+    """Table in a SQLite database under LOCAL_DATA_DIR, queried read-only in place.
+
+    Text search goes through an FTS5 index with the trigram tokenizer, which
+    matches substrings of Thai text without word boundaries. A ``<table>_fts``
+    table the user keeps in the database itself is used as is; otherwise,
+    when SQLITE_BUILD_FTS is on, a contentless index (rowids only) is built
+    in a background thread into its own file under SQLITE_FTS_DIR and
+    rebuilt whenever the database changes. Until it is ready, and for terms
+    shorter than a trigram, the backend falls back to LIKE on every column.
+    Rows are numbered rowid + 1 (row 1 being the column names, as in a sheet).
+    """
+    
+    type = 'sqlite'
+    in_memory = False
+    
+    def __init__(self, source):
+        self.source = source
+        self.path = _local_data_path(source['path'])
+        self.table = source['table']
+        self.key = ('sqlite', self.path, self.table)
+        self._local = threading.local()
+        self._version = _file_version(self.path, self.path + '-wal')
+        self.header = [row[1] for row in self._connection().execute(
+            f"PRAGMA table_info({_quote_identifier(self.table)})"
+        )]
+        if not self.header:
+            raise ValueError(f'ไม่พบตาราง {self.table}')
+        self.fts_table = f"{self.table}_fts"
+        self.fts_path = None  # None = FTS table ในฐานข้อมูลเอง
+        self.has_fts = False
+        self.fts_ready = threading.Event()
+        self._fts_lock = threading.Lock()
+        self._fts_building = False
+        self._fts_generation = 0
+        self._row_count = None  # (version, count(*)) - ใช้ได้จนกว่าฐานข้อมูลจะเปลี่ยน
+        self._ensure_fts()
+    
+    @staticmethod
+    def normalize(source):
+        path = str(source.get('path', '')).strip()
+        _local_data_path(path)
+        table = str(source.get('table', '')).strip()
+        if not table:
+            raise ValueError('กรุณาใส่ชื่อตาราง')
+        label = str(source.get('label', '')).strip() or table
+        return {'type': 'sqlite', 'path': path, 'table': table, 'label': label}
+    
+    def _connection(self):
+        # sqlite3 connection ใช้ได้เฉพาะ thread ที่สร้าง - เปิดแบบอ่านอย่างเดียวต่อ thread
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            self._local.connection = connection
+        return connection
+    
+    def _fts_connection(self):
+        if self.fts_path is None:
+            return self._connection()
+        # เปิดไฟล์ index ใหม่หลัง rebuild (ไฟล์เดิมถูกแทนที่) และปิดของเดิม ไม่ให้ค้างไฟล์ที่ถูกลบไว้
+        cached = getattr(self._local, 'fts', None)
+        if cached is None or cached[0] != self._fts_generation:
+            if cached is not None:
+                cached[1].close()
+            connection = sqlite3.connect(f"file:{self.fts_path}?mode=ro", uri=True)
+            cached = self._local.fts = (self._fts_generation, connection)
+        return cached[1]
+    
+    def _ensure_fts(self):
+        if self._connection().execute("SELECT 1 FROM sqlite_master WHERE name = ?", (self.fts_table,)).fetchone():
+            self.fts_path = None
+            self.has_fts = True
+            self.fts_ready.set()
+            return
+        if not SQLITE_BUILD_FTS:
+            return
+        identity = json.dumps([self.path, self.table], ensure_ascii=False)
+        self.fts_path = os.path.join(SQLITE_FTS_DIR, hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16] + '.sqlite')
+        version = json.dumps(self._version)
+        try:
+            with sqlite3.connect(f"file:{self.fts_path}?mode=ro", uri=True) as connection:
+                built, = connection.execute("SELECT version FROM fts_meta").fetchone()
+        except (sqlite3.Error, TypeError):
+            built = None
+        if built == version:
+            self.has_fts = True
+            self.fts_ready.set()
+        else:
+            self._start_fts_build()
+    
+    def _start_fts_build(self):
+        with self._fts_lock:
+            if self._fts_building:
+                return
+            self._fts_building = True
+        self.fts_ready.clear()
+        threading.Thread(target=self._build_fts, name='sqlite-fts', daemon=True).start()
+    
+    def _build_fts(self):
+        """Build the contentless trigram index into a temp file and swap it in"""
+        started = time.perf_counter()
+        version = json.dumps(_file_version(self.path, self.path + '-wal'))
+        temp_path = self.fts_path + '.tmp'
+        columns = ', '.join(f"c{i}" for i in range(len(self.header)))
+        selected = ', '.join(_quote_identifier(column) for column in self.header)
+        try:
+            os.makedirs(SQLITE_FTS_DIR, exist_ok=True)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            writer = sqlite3.connect(temp_path, uri=True)
+            try:
+                # ไฟล์ชั่วคราวที่จะแทนที่ทั้งไฟล์ - ไม่ต้องมี journal
+                writer.execute("PRAGMA journal_mode = OFF")
+                writer.execute("PRAGMA synchronous = OFF")
+                writer.execute("ATTACH DATABASE ? AS source", (f"file:{self.path}?mode=ro",))
+                with writer:
+                    writer.execute(f"CREATE VIRTUAL TABLE fts USING fts5({columns}, content='', tokenize='trigram')")
+                    writer.execute(f"INSERT INTO fts(rowid, {columns}) "
+                                   f"SELECT rowid, {selected} FROM source.{_quote_identifier(self.table)}")
+                    writer.execute("CREATE TABLE fts_meta (version TEXT)")
+                    writer.execute("INSERT INTO fts_meta VALUES (?)", (version,))
+            finally:
+                writer.close()
+            os.replace(temp_path, self.fts_path)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("SQLite FTS5 index not available for %s: %s", self.table, e)
+            return
+        finally:
+            with self._fts_lock:
+                self._fts_building = False
+        self._fts_generation += 1
+        if version != json.dumps(self._version):
+            # ฐานข้อมูลเปลี่ยนระหว่างสร้าง - สร้างใหม่อีกรอบ
+            self._start_fts_build()
+            return
+        self.has_fts = True
+        self.fts_ready.set()
+        logger.info("Built FTS5 index for %s in %.1f ms", self.table, (time.perf_counter() - started) * 1000)
+    
+    def _check_version(self):
+        version = _file_version(self.path, self.path + '-wal')
+        if version != self._version:
+            self._version = version
+            response_cache.clear('sqlite source changed')
+            if self.fts_path is not None and SQLITE_BUILD_FTS:
+                # index เดิมไม่ตรงกับข้อมูลแล้ว - ใช้ LIKE จนกว่าจะสร้างใหม่เสร็จ
+                self.has_fts = False
+                self._start_fts_build()
+    
+    def _like_clause(self, count):
+        """One ``(col1 LIKE ? OR col2 LIKE ? ...)`` clause per term"""
+        column_like = ' OR '.join(f"{_quote_identifier(column)} LIKE ? ESCAPE '\\'" for column in self.header)
+        return [f"({column_like})"] * count
+    
+    def _like_params(self, text):
+        pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return [pattern] * len(self.header)
+    
+    @staticmethod
+    def _fts_phrase(text):
+        return '"' + text.replace('"', '""') + '"'
+    
+    def _fts_rows(self, match, limit):
+        fts = 'fts' if self.fts_path else _quote_identifier(self.fts_table)
+        return [rowid for rowid, in self._fts_connection().execute(
+            f"SELECT rowid FROM {fts} WHERE {fts} MATCH ? ORDER BY rowid LIMIT ?", (match, limit)
+        )]
+    
+    def search(self, query_lower, limit=5):
+        self._check_version()
+        if self.has_fts and len(query_lower) >= 3:
+            return self._fts_rows(self._fts_phrase(query_lower), limit)
+        sql = (f"SELECT rowid FROM {_quote_identifier(self.table)} "
+               f"WHERE {self._like_clause(1)[0]} ORDER BY rowid LIMIT ?")
+        return [rowid for rowid, in self._connection().execute(sql, self._like_params(query_lower) + [limit])]
+    
+    def search_terms(self, terms, limit=5):
+        """Rows ranked by IDF-weighted matching terms over the FTS index, or by the number of matching terms with LIKE"""
+        self._check_version()
+        long_terms = [term for term in terms if len(term) >= 3]
+        if not (self.has_fts and long_terms):
+            score = ' + '.join(self._like_clause(len(terms)))
+            sql = (f"SELECT rowid FROM (SELECT rowid, {score} AS score FROM {_quote_identifier(self.table)}) "
+                   f"WHERE score > 0 ORDER BY score DESC, rowid LIMIT ?")
+            params = [param for term in terms for param in self._like_params(term)] + [limit]
+            return [rowid for rowid, in self._connection().execute(sql, params)]
+        
+        # แถวที่มีครบทุกคำได้คะแนนสูงสุดอยู่แล้ว - ลองก่อน ไม่ต้องจัดอันดับแถวที่ตรงเพียงบางคำ
+        if len(long_terms) > 1:
+            rows = self._fts_rows(' AND '.join(self._fts_phrase(term) for term in long_terms), limit)
+            if len(rows) >= limit:
+                return rows
+        # จัดอันดับแบบเดียวกับ index ในหน่วยความจำ: น้ำหนัก IDF ต่อคำ (จำกัดจำนวนแถวต่อคำ)
+        total_rows = len(self)
+        scores = defaultdict(float)
+        for term in long_terms:
+            rows = self._fts_rows(self._fts_phrase(term), SheetIndex.TERM_ROW_LIMIT)
+            weight = math.log(1 + total_rows / len(rows)) if rows else 0
+            for rowid in rows:
+                scores[rowid] += weight
+        return sorted(scores, key=lambda rowid: (-scores[rowid], rowid))[:limit]
+    
+    def _select(self, where='', params=(), limit=None):
+        columns = ', '.join(_quote_identifier(column) for column in self.header)
+        sql = f"SELECT {columns} FROM {_quote_identifier(self.table)} {where} ORDER BY rowid"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [['' if cell is None else str(cell) for cell in row] for row in self._connection().execute(sql, params)]
+    
+    def format_row(self, rowid):
+        rows = self._select('WHERE rowid = ?', (rowid,))
+        return f"[{self.source['label']}] แถวที่ {rowid + 1}: {_display_cells(rows[0]) if rows else ''}"
+    
+    def header_line(self, rowid):
+        return 'header', f"[{self.source['label']}] แถวที่ 1: {_display_cells(self.header)}"
+    
+    def first_rows(self, num_rows):
+        """Row ids of the first ``num_rows`` rows, counting the column names as row 1"""
+        sql = f"SELECT rowid FROM {_quote_identifier(self.table)} ORDER BY rowid LIMIT ?"
+        return [rowid for rowid, in self._connection().execute(sql, (max(num_rows - 1, 0),))]
+    
+    def __len__(self):
+        version = self._version
+        cached = self._row_count
+        if cached is None or cached[0] is not version:
+            count, = self._connection().execute(f"SELECT count(*) FROM {_quote_identifier(self.table)}").fetchone()
+            cached = self._row_count = (version, count)
+        return cached[1] + 1
+    
+    def preview(self, num_rows):
+        return [list(self.header)] + self._select(limit=max(num_rows - 1, 0)), len(self)
+    
+    def status(self):
+        return {'cached': True, 'rows': len(self), 'fts': self.has_fts, 'fts_building': self._fts_building}
+
+DATA_SOURCE_BACKENDS = {
+    'sheets': SheetsBackend,
+    'csv': LocalCSVBackend,
+    'sqlite': SQLiteBackend,
+}
+
+# backend ต่อแหล่งข้อมูล (เก็บ mmap / connection / FTS ไว้ใช้ซ้ำ)
+_backends = {}
+_backends_lock = threading.Lock()
+
+def normalize_data_source(source):
+    """Validate one data-source entry; raises ValueError when unusable.
+
+    ``type`` is ``sheets`` (``sheet_id``, ``gid``), ``csv`` (``path``, optional
+    ``mode``) or ``sqlite`` (``path``, ``table``); local paths are relative to
+    LOCAL_DATA_DIR.
+    """
+    source_type = str(source.get('type', 'sheets')).strip() or 'sheets'
+    if source_type not in DATA_SOURCE_BACKENDS:
+        raise ValueError(f'ไม่รองรับแหล่งข้อมูลประเภท {source_type}')
+    return DATA_SOURCE_BACKENDS[source_type].normalize(source)
+
+def source_identity(source):
+    """What makes two sources the same data, regardless of label"""
+    source_type = source.get('type', 'sheets')
+    if source_type == 'sheets':
+        return ('sheets', source.get('sheet_id'), str(source.get('gid', '0')))
+    return (source_type, source.get('path'), source.get('table'))
+
+def get_data_sources():
+    return app_settings.get('data_sources') or [
+        {'type': 'sheets', 'sheet_id': app_settings['google_sheet_id'], 'gid': '0', 'label': 'ข้อมูลหลัก'}
+    ]
+
+def get_backend(source):
+    """Backend for ``source`` (created once per distinct source); raises ValueError when unusable"""
+    key = json.dumps(source, sort_keys=True, ensure_ascii=False)
+    with _backends_lock:
+        backend = _backends.get(key)
+    if backend is not None:
+        return backend
+    # สร้างนอก lock รวม - แหล่งอื่นไม่ต้องรอ, คำขอพร้อมกันของแหล่งเดียวกันรอตัวที่สร้างอยู่
+    return backend_flight.do(key, _create_backend, key, source)
+
+def _create_backend(key, source):
+    with _backends_lock:
+        backend = _backends.get(key)
+    if backend is None:
+        backend = DATA_SOURCE_BACKENDS[source.get('type', 'sheets')](source)
+        with _backends_lock:
+            backend = _backends.setdefault(key, backend)
+    return backend
+
+def get_backends(sources=None):
+    """Backends of all usable sources, in source order (unusable ones are logged and skipped)"""
+    backends = []
+    for source in sources or get_data_sources():
+        try:
+            backends.append(get_backend(source))
+        except (ValueError, OSError, sqlite3.Error) as e:
+            logger.warning("Data source %s unavailable: %s", source.get('label'), e)
+    return backends
+
+def set_data_sources(sources):
+    """Replace the source list; drops cached data of sources no longer used"""
+    sources = [normalize_data_source(source) for source in sources]
+    if not sources:
+        raise ValueError('ต้องมีแหล่งข้อมูลอย่างน้อย 1 รายการ')
+    identities = [source_identity(source) for source in sources]
+    if len(set(identities)) != len(identities):
+        raise ValueError('มีแหล่งข้อมูลซ้ำกัน')
+    for source in sources:
+        if source['type'] == 'sqlite':
+            try:
+                get_backend(source)  # ตรวจตารางก่อนบันทึก (FTS สร้างใน background)
+            except sqlite3.Error as e:
+                raise ValueError(f'เปิดฐานข้อมูลไม่ได้: {e}')
+    
+    old_sheet_ids = {source['sheet_id'] for source in get_data_sources() if source.get('type', 'sheets') == 'sheets'}
+    new_sheet_ids = [source['sheet_id'] for source in sources if source['type'] == 'sheets']
+    app_settings['data_sources'] = sources
+    if new_sheet_ids:
+        app_settings['google_sheet_id'] = new_sheet_ids[0]
+    for sheet_id in old_sheet_ids - set(new_sheet_ids):
+        invalidate_sheet_cache(sheet_id)
+    keep = {json.dumps(source, sort_keys=True, ensure_ascii=False) for source in sources}
+    with _backends_lock:
+        for key in [key for key in _backends if key not in keep]:
+            del _backends[key]
+    with _search_index_lock:
+        _search_indexes.pop(MERGED_INDEX_KEY, None)
+    with _embedding_lock:
+        for key in [key for key in _embedding_indexes if key not in identities]:
+            del _embedding_indexes[key]
+    response_cache.clear('data sources changed')
+    return sources
+
+def replace_sheet_id(old_sheet_id, new_sheet_id):
+    """Point every source of ``old_sheet_id`` (and the primary sheet setting) at ``new_sheet_id``"""
+    app_settings['google_sheet_id'] = new_sheet_id
+    if old_sheet_id == new_sheet_id:
+        return
+    for source in app_settings.get('data_sources') or []:
+        if source.get('sheet_id') == old_sheet_id:
+            source['sheet_id'] = new_sheet_id
+    invalidate_sheet_cache(old_sheet_id)
+
+def _fetch_data_source(backend):
+    started = time.perf_counter()
+    data = backend.snapshot()
+    return data, round((time.perf_counter() - started) * 1000, 1)
+
+def fetch_data_sources(sources=None):
+    """Snapshots of the in-memory sources as ``[(source, snapshot or None, wait_ms)]``.
+
+    Sources missing from the cache are loaded concurrently on a bounded
+    thread pool; when everything is cached no thread is involved. Out-of-core
+    sources (large CSV, SQLite) are queried in place and not listed here.
+    """
+    backends = [backend for backend in get_backends(sources) if backend.in_memory]
+    if len(backends) <= 1 or all(backend.is_cached() for backend in backends):
+        results = [_fetch_data_source(backend) for backend in backends]
+    else:
+        results = list(_source_fetch_pool.map(_fetch_data_source, backends))
+    return [(backend.source, data, wait_ms) for backend, (data, wait_ms) in zip(backends, results)]
+
+def get_sources_search_index():
+    """Search index over the in-memory sources; a single one uses its own snapshot index"""
+    backends = [backend for backend in get_backends() if backend.in_memory]
+    if not backends:
+        return None
+    if len(backends) == 1:
+        return backends[0].search_index()
+    
+    parts = [(source, data) for source, data, _ in fetch_data_sources() if data]
+    if not parts:
+        return None
+    
+    tokenizer_name = get_tokenizer_name()
+    with _search_index_lock:
+        index = _search_indexes.get(MERGED_INDEX_KEY)
+        if index is not None and index.data.same_snapshots(parts) and index.tokenizer.name == tokenizer_name:
+            return index
+    flight_key = (MERGED_INDEX_KEY, tuple(id(data) for _, data in parts), tokenizer_name)
+    return index_flight.do(flight_key, _build_merged_index, parts, tokenizer_name)
+
+def _build_merged_index(parts, tokenizer_name):
+    with _search_index_lock:
+        index = _search_indexes.get(MERGED_INDEX_KEY)
+        if index is not None and index.data.same_snapshots(parts) and index.tokenizer.name == tokenizer_name:
+            return index
+    
+    if index is not None and index.tokenizer.name == tokenizer_name:
+        # แท็บที่ refresh แบบ incremental - patch เฉพาะแถวของแท็บนั้นใน index รวม
+        diff = index.data.diff_to(parts)
+        if diff is not None:
+            data = SourceSet(parts)
+            data.diff = diff
+            patched = index.patched(data)
+            if patched is not None:
+                logger.info("Patched merged search index: %d rows in %s ms", data.touched_rows(), patched.stats()['build_ms'])
+                with _search_index_lock:
+                    _search_indexes[MERGED_INDEX_KEY] = patched
+                    search_stats['index_patches'] += 1
+                return patched
+    
+    index = SheetIndex(SourceSet(parts), tokenizer_name)
+    logger.info("Built merged search index for %d sources: %s", len(parts), index.stats())
+    with _search_index_lock:
+        _search_indexes[MERGED_INDEX_KEY] = index
+        search_stats['index_builds'] += 1
+    return index
+
+_query_tokenizers = {}
+
+def get_query_tokenizer():
+    """Tokenizer (base dictionary only) for questions when no in-memory index is loaded"""
+    name = get_tokenizer_name()
+    tokenizer = _query_tokenizers.get(name)
+    if tokenizer is None:
+        tokenizer = _query_tokenizers[name] = TOKENIZERS[name]()
+    return tokenizer
+
+def get_disk_sources():
+    """Backends searched in place instead of through the in-memory index"""
+    return [backend for backend in get_backends() if not backend.in_memory]
+
+def get_primary_preview(num_rows):
+    """``(source, rows, total rows)`` of the first usable source, or None"""
+    for backend in get_backends():
+        try:
+            preview = backend.preview(num_rows)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Preview of %s failed: %s", backend.source.get('label'), e)
+            continue
+        if preview:
+            return backend.source, preview[0], preview[1]
+    return None
+
+def get_data_source_status(sources=None):
+    """Per-source row count and load state (sheets: fetch latency from the sheet cache)"""
+    status = []
+    for source in sources or get_data_sources():
+        try:
+            state = get_backend(source).status()
+        except (ValueError, OSError, sqlite3.Error) as e:
+            state = {'cached': False, 'rows': 0, 'error': str(e)}
+        status.append({**source, **state})
+    return status
+
+# ---------------------------------------------------------------------------
+# Semantic retrieval - embedding ของแถว (Ollama / โมเดลบน CPU / stub) ค้นด้วย dot product
+# ---------------------------------------------------------------------------
+
+class OllamaEmbedder:
+    """Ollama ``/api/embed`` (EMBEDDING_MODEL) on the pool's chat backends, one request per batch.
+
+    Row batches are background work and hold a scheduler slot like any other
+    model call; they wait for a free slot rather than queueing ahead of chats.
+    """
+    
+    name = 'ollama'
+    
+    def __init__(self):
+        self.model = EMBEDDING_MODEL
+        self.id = re.sub(r'[^\w.-]', '_', f"{self.name}-{self.model}")
+    
+    def _post(self, texts, timeout):
+        """POST to the pool's chat backends with failover; raises the last error when none answered"""
+        error = None
+        for backend in model_pool.failover('chat'):
+            started = time.perf_counter()
+            try:
+                response = model_client.post(
+                    f"{backend.url}/api/embed",
+                    json={'model': self.model, 'input': list(texts)},
+                    timeout=timeout
+                )
+            except requests.RequestException as e:
+                error = e
+                model_pool.release(backend, started, e, track_latency=False)
+                continue
+            if response.status_code >= 500:
+                error = requests.HTTPError(f"HTTP {response.status_code} from {backend.name}", response=response)
+                model_pool.release(backend, started, error, track_latency=False)
+                continue
+            # 4xx (เช่นไม่มี embedding model บน host นี้) ไม่ใช่ความเสียของ backend - ไม่พัก backend แชท
+            model_pool.release(backend, started, track_latency=False)
+            if response.status_code != 200:
+                error = requests.HTTPError(f"HTTP {response.status_code} from {backend.name}", response=response)
+                continue
+            return np.asarray(response.json()['embeddings'], dtype=np.float32)
+        raise error or RuntimeError('no model backend configured')
+    
+    def embed(self, texts):
+        deadline = time.monotonic() + EMBEDDING_TIMEOUT
+        while True:
+            try:
+                with model_scheduler.slot('background'):
+                    return self._post(texts, EMBEDDING_TIMEOUT)
+            except ModelBusyError as e:
+                # งานเบื้องหลังไม่เข้าคิว - รอ slot ว่างแล้วลองใหม่
+                if time.monotonic() + e.retry_after > deadline:
+                    raise
+                time.sleep(e.retry_after)
+    
+    def embed_query(self, texts):
+        """Embed search queries within EMBEDDING_QUERY_TIMEOUT, without waiting in the scheduler queue"""
+        return self._post(texts, EMBEDDING_QUERY_TIMEOUT)
+
+class LocalEmbedder:
+    """sentence-transformers model (LOCAL_EMBEDDING_MODEL) on the CPU, no Ollama needed"""
+    
+    name = 'local'
+    
+    def __init__(self):
+        self.model = LOCAL_EMBEDDING_MODEL
+        self.id = re.sub(r'[^\w.-]', '_', f"{self.name}-{self.model}")
+        self._model = SentenceTransformer(self.model, device='cpu')
+    
+    def embed(self, texts):
+        return np.asarray(self._model.encode(list(texts), batch_size=EMBEDDING_BATCH_SIZE), dtype=np.float32)
+
+class HashingEmbedder:
+    """Deterministic offline stand-in: signed feature hashing of words and character trigrams.
+
+    Needs no model or network, so tests and machines without Ollama can run
+    the semantic path; rows sharing words or spellings score high, but real
+    paraphrases need a real model.
+    """
+    
+    name = 'hash'
+    dimensions = 256
+    
+    def __init__(self):
+        self.id = f"{self.name}-{self.dimensions}"
+    
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for i, text in enumerate(texts):
+            features = []
+            for run in _WORD_RUN_RE.findall(text.lower()):
+                features.append(run)
+                features.extend(run[j:j + 3] for j in range(len(run) - 2))
+            for feature in features:
+                value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+                matrix[i, value % self.dimensions] += 1.0 if value >> 63 else -1.0
+        return matrix
+
+EMBEDDERS = {
+    'ollama': OllamaEmbedder,
+    'hash': HashingEmbedder,
+}
+if SentenceTransformer is not None:
+    EMBEDDERS['local'] = LocalEmbedder
+
+def register_embedder(name, embedder_class):
+    """Register an embedder class (with ``id`` and ``embed(texts) -> float32 matrix``) under ``name``"""
+    EMBEDDERS[name] = embedder_class
+
+def _unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+def _embedding_text(data, row):
+    """What gets embedded for ``row``: 'column: value' pairs so the model sees what each cell means ('' for the header)"""
+    if row in data.header_rows:
+        return ''
+    header = data.header
+    return '; '.join(
+        f"{header[col]}: {cell}" if col < len(header) and header[col] else cell
+        for col, cell in enumerate(data[row]) if cell
+    )
+
+def _embedding_key(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+class EmbeddingIndex:
+    """Unit-length row vectors of one snapshot in a memory-mapped ``.npy`` matrix.
+
+    Stored as ``<EMBEDDING_STORE_DIR>/<source>/<embedder>-<content hash>.npy``
+    with a ``.keys.npy`` beside it holding a 64-bit digest of each row's
+    embedded text. A refreshed snapshot copies the vectors of rows whose
+    digest the previous store already has, so only edited, inserted or
+    appended rows go to the embedder; after a restart the current snapshot's
+    file is mapped back without embedding anything. The header and empty
+    rows stay zero and never score.
+    """
+    
+    COPY_CHUNK_ROWS = 65536
+    
+    def __init__(self, path, embedder_id, content_hash):
+        self.path = path
+        self.embedder_id = embedder_id
+        self.content_hash = content_hash
+        self.vectors = np.load(path, mmap_mode='r')
+        self.keys = np.load(self.keys_path(path))
+        self.embedded = 0
+        self.reused = 0
+        self.build_ms = 0
+    
+    @staticmethod
+    def keys_path(path):
+        return path[:-len('.npy')] + '.keys.npy'
+    
+    @classmethod
+    def build(cls, directory, data, embedder, previous=None):
+        """Store for snapshot ``data``, embedding only the rows ``previous`` lacks; None when no row has text"""
+        started = time.perf_counter()
+        path = os.path.join(directory, f"{embedder.id}-{data.content_hash[:16]}.npy")
+        if os.path.exists(path) and os.path.exists(cls.keys_path(path)):
+            return cls(path, embedder.id, data.content_hash)
+        
+        texts = [_embedding_text(data, row) for row in range(len(data))]
+        wanted = np.array([bool(text) for text in texts], dtype=bool)
+        if not wanted.any():
+            return None
+        keys = np.array([_embedding_key(text) for text in texts], dtype=np.uint64)
+        found = np.zeros(len(texts), dtype=bool)
+        if previous is not None and len(previous.keys):
+            # จับคู่แถวด้วย digest ของข้อความ (แถวที่แทรก/ย้ายตำแหน่งก็ใช้เวกเตอร์เดิมได้)
+            order = np.argsort(previous.keys, kind='stable')
+            sorted_keys = previous.keys[order]
+            positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+            found = wanted & (sorted_keys[positions] == keys)
+            source_rows = order[positions]
+        missing = np.flatnonzero(wanted & ~found)
+        
+        os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        vectors = None
+        try:
+            if found.any():
+                vectors = np.lib.format.open_memmap(
+                    temp_path, mode='w+', dtype=np.float32, shape=(len(texts), previous.vectors.shape[1])
+                )
+                reuse = np.flatnonzero(found)
+                for start in range(0, len(reuse), cls.COPY_CHUNK_ROWS):
+                    rows = reuse[start:start + cls.COPY_CHUNK_ROWS]
+                    vectors[rows] = previous.vectors[source_rows[rows]]
+            for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+                rows = missing[start:start + EMBEDDING_BATCH_SIZE]
+                embedded = _unit_rows(embedder.embed([texts[row] for row in rows]))
+                if vectors is None:
+                    # ขนาดเวกเตอร์รู้จากผลลัพธ์ batch แรก
+                    vectors = np.lib.format.open_memmap(
+                        temp_path, mode='w+', dtype=np.float32, shape=(len(texts), embedded.shape[1])
+                    )
+                vectors[rows] = embedded
+            vectors.flush()
+            del vectors
+            with open(f"{temp_path}.keys", 'wb') as f:
+                np.save(f, keys)
+            os.replace(f"{temp_path}.keys", cls.keys_path(path))
+            os.replace(temp_path, path)  # ไฟล์เวกเตอร์มาทีหลังสุด = store สมบูรณ์
+        except BaseException:
+            for leftover in (temp_path, f"{temp_path}.keys"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+        
+        # เก็บเฉพาะ snapshot ล่าสุดของ embedder นี้
+        current = os.path.basename(path)[:-len('.npy')]
+        for name in os.listdir(directory):
+            if name.startswith(f"{embedder.id}-") and not name.startswith(current) and not name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+        
+        index = cls(path, embedder.id, data.content_hash)
+        index.embedded = len(missing)
+        index.reused = int(found.sum())
+        index.build_ms = round((time.perf_counter() - started) * 1000, 1)
+        return index
+    
+    def top_k(self, query_vector, k, min_score=0.0):
+        """``[(row, cosine score)]`` of the ``k`` rows closest to ``query_vector``, best first"""
+        scores = self.vectors @ query_vector
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        best = np.argpartition(scores, -k)[-k:]
+        best = best[np.argsort(scores[best])[::-1]]
+        return [(int(row), float(scores[row])) for row in best if scores[row] >= min_score]
+    
+    def stats(self):
+        return {
+            'rows': int(self.vectors.shape[0]),
+            'dimensions': int(self.vectors.shape[1]),
+            'embedder': self.embedder_id,
+            'rows_embedded': self.embedded,
+            'rows_reused': self.reused,
+            'build_ms': self.build_ms,
+            'file_mb': round(os.path.getsize(self.path) / 2**20, 2)
+        }
+
+_embedders = {}
+# store ของ snapshot ล่าสุดต่อแหล่งข้อมูล (key = source_identity)
+_embedding_indexes = {}
+_embedding_lock = threading.Lock()
+_embedding_jobs = set()
+# embed ทีละงานเบื้องหลัง - ไม่แย่ง Ollama กับการตอบแชทมากเกินไป
+_embedding_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embedding')
+embedding_stats = {
+    'builds': 0,
+    'rows_embedded': 0,
+    'rows_reused': 0,
+    'queries': 0,
+    'query_ms': 0,
+    'query_errors': 0,
+    'query_skipped': 0,
+    'errors': 0
+}
+# circuit breaker ของการ embed คำถาม (ป้องกันด้วย _embedding_lock)
+_query_breaker = {'failures': 0, 'open_until': 0.0}
+
+def get_embedder_name():
+    name = app_settings.get('embedding_backend', 'ollama')
+    return name if name in EMBEDDERS else 'ollama'
+
+def get_embedder():
+    name = get_embedder_name()
+    embedder = _embedders.get(name)
+    if embedder is None:
+        embedder = _embedders[name] = EMBEDDERS[name]()
+    return embedder
+
+def _embedding_directory(identity):
+    return os.path.join(EMBEDDING_STORE_DIR, hashlib.sha1(json.dumps(identity).encode('utf-8')).hexdigest()[:16])
+
+def _previous_embedding_index(identity, directory, embedder):
+    """Store to copy unchanged rows from: the one in memory, else the newest on disk (after a restart)"""
+    with _embedding_lock:
+        index = _embedding_indexes.get(identity)
+    if index is not None and index.embedder_id == embedder.id:
+        return index
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return None
+    paths = [
+        os.path.join(directory, name) for name in names
+        if name.startswith(f"{embedder.id}-") and name.endswith('.npy') and not name.endswith('.keys.npy')
+        and os.path.exists(EmbeddingIndex.keys_path(os.path.join(directory, name)))
+    ]
+    if not paths:
+        return None
+    return EmbeddingIndex(max(paths, key=os.path.getmtime), embedder.id, None)
+
+def build_embedding_index(identity, data, embedder=None):
+    """Embed snapshot ``data`` of source ``identity`` now (incrementally) and make it the current store"""
+    embedder = embedder or get_embedder()
+    directory = _embedding_directory(identity)
+    index = EmbeddingIndex.build(directory, data, embedder, _previous_embedding_index(identity, directory, embedder))
+    if index is None:
+        return None
+    with _embedding_lock:
+        _embedding_indexes[identity] = index
+        embedding_stats['builds'] += 1
+        embedding_stats['rows_embedded'] += index.embedded
+        embedding_stats['rows_reused'] += index.reused
+    logger.info("Embedded %s: %s", identity, index.stats())
+    return index
+
+def _run_embedding_job(job, identity, data, embedder):
+    try:
+        build_embedding_index(identity, data, embedder)
+    except Exception as e:
+        with _embedding_lock:
+            embedding_stats['errors'] += 1
+        logger.warning("Embedding %s failed: %s", identity, e)
+    finally:
+        with _embedding_lock:
+            _embedding_jobs.discard(job)
+
+def get_embedding_index(identity, data):
+    """Store for snapshot ``data`` when built; otherwise queue its build in the background and return None"""
+    embedder = get_embedder()
+    with _embedding_lock:
+        index = _embedding_indexes.get(identity)
+        if index is not None and index.content_hash == data.content_hash and index.embedder_id == embedder.id:
+            return index
+        job = (identity, data.content_hash, embedder.id)
+        if job in _embedding_jobs:
+            return None
+        _embedding_jobs.add(job)
+    _embedding_pool.submit(_run_embedding_job, job, identity, data, embedder)
+    return None
+
+def _indexed_sources(index):
+    """``[(source, snapshot, first combined row)]`` behind an in-memory search index"""
+    if isinstance(index.data, SourceSet):
+        return [(source, snapshot, offset) for (source, snapshot), offset in zip(index.data.parts, index.data.offsets)]
+    backends = [backend for backend in get_backends() if backend.in_memory]
+    return [(backends[0].source, index.data, 0)] if backends else []
+
+def semantic_hits(index, query, limit):
+    """``(index, row)`` hits closest in meaning to ``query``, best first.
+
+    Covers the in-memory sources; a snapshot whose vectors are still being
+    embedded contributes nothing yet and the lexical search answers alone.
+    """
+    if np is None or index is None:
+        return []
+    stores = []
+    for source, snapshot, offset in _indexed_sources(index):
+        store = get_embedding_index(source_identity(source), snapshot)
+        if store is not None:
+            stores.append((store, offset))
+    if not stores:
+        logger.debug("Semantic search: vectors not ready")
+        return []
+    
+    with _embedding_lock:
+        if time.monotonic() < _query_breaker['open_until']:
+            embedding_stats['query_skipped'] += 1
+            return []
     
+    started = time.perf_counter()
+    min_score = app_settings.get('semantic_min_score', 0.35)
+    embedder = get_embedder()
     try:
-        # วิธีที่ 1: ใช้ codecs.decode สำหรับ unicode_escape
-        cleaned = codecs.decode(text, 'unicode_escape')
-        return cleaned
-    except:
-        try:
-            # วิธีที่ 2: ใช้ encode/decode method
-            cleaned = text.encode().decode('unicode_escape')
-            return cleaned
-        except:
-            try:
-                # วิธีที่ 3: ใช้ regular expression กับ codecs
-                def decode_match(match):
-                    return chr(int(match.group(1), 16))
-                cleaned = re.sub(r'\\u([0-9a-fA-F]{4})', decode_match, text)
-                return cleaned
-            except:
-                # หากแปลงไม่ได้ทุกวิธี ให้คืนค่าเดิม
-                return text
-                
-def get_google_sheet_data(sheet_id, range_name="A:Z"):
-    """Fetch data from Google Sheets with improved error handling and Thai language support"""
+        # embedder ที่ไม่มี embed_query (local/hash) ไม่ผ่านเครือข่าย
+        query_vector = _unit_rows(getattr(embedder, 'embed_query', embedder.embed)([query]))[0]
+    except Exception as e:
+        with _embedding_lock:
+            embedding_stats['query_errors'] += 1
+            _query_breaker['failures'] += 1
+            opened = _query_breaker['failures'] >= EMBEDDING_QUERY_FAILURES
+            if opened:
+                _query_breaker['failures'] = 0
+                _query_breaker['open_until'] = time.monotonic() + EMBEDDING_QUERY_COOLDOWN
+        if opened:
+            logger.warning("Semantic search paused for %.0f s after %d query embedding failures: %s",
+                           EMBEDDING_QUERY_COOLDOWN, EMBEDDING_QUERY_FAILURES, e)
+        else:
+            logger.warning("Query embedding failed: %s", e)
+        return []
+    with _embedding_lock:
+        _query_breaker['failures'] = 0
+    
+    scored = []
     try:
-        # Using public Google Sheets CSV export
-        csv_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid=0"
-        print(f"[DEBUG] Fetching Google Sheet: {csv_url}")
-        
-        # ปรับปรุง headers เพื่อรองรับ UTF-8
-        headers = {
-            'Accept': 'text/csv; charset=utf-8',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+        for store, offset in stores:
+            scored.extend((score, offset + row) for row, score in store.top_k(query_vector, limit, min_score))
+    except Exception as e:
+        with _embedding_lock:
+            embedding_stats['errors'] += 1
+        logger.warning("Semantic search failed: %s", e)
+        return []
+    scored.sort(reverse=True)
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    with _embedding_lock:
+        embedding_stats['queries'] += 1
+        embedding_stats['query_ms'] += elapsed_ms
+    logger.debug("Semantic search: %d rows >= %s in %s ms", len(scored), min_score, elapsed_ms)
+    return [(index, row) for _, row in scored[:limit]]
+
+def fuse_hits(rankings, limit, k=60):
+    """Reciprocal rank fusion of best-first hit lists (ties keep the earlier list's order)"""
+    scores = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking):
+            scores[hit] = scores.get(hit, 0) + 1 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+def get_embedding_stats():
+    with _embedding_lock:
+        stats = dict(embedding_stats)
+        stats['pending'] = len(_embedding_jobs)
+        stats['query_paused'] = time.monotonic() < _query_breaker['open_until']
+        stores = {
+            '/'.join(str(part) for part in identity if part): index.stats()
+            for identity, index in _embedding_indexes.items()
         }
-        
-        response = requests.get(csv_url, headers=headers, timeout=10)
-        print(f"[DEBUG] Google Sheets response status: {response.status_code}")
-        
-        if response.status_code == 200:
-            # ตรวจสอบ encoding ของ response
-            response.encoding = 'utf-8'
-            csv_content = response.text
-            
-            print(f"[DEBUG] Raw CSV response length: {len(csv_content)} characters")
-            print(f"[DEBUG] CSV preview: {csv_content[:200]}...")
-            
-            # Better CSV parsing using csv module
-            csv_data = StringIO(csv_content)
-            reader = csv.reader(csv_data)
-            data = []
-            
-            for row_num, row in enumerate(reader):
-                # ทำความสะอาดข้อมูลในแต่ละเซลล์เพื่อแปลง Unicode escape sequences
-                cleaned_row = []
-                for cell in row:
-                    if cell:
-                        cleaned_cell = clean_thai_text(cell)
-                        cleaned_row.append(cleaned_cell)
-                    else:
-                        cleaned_row.append(cell)
-                
-                data.append(cleaned_row)
-                
-                # Debug: แสดง 3 แถวแรกเพื่อตรวจสอบ
-                if row_num < 3:
-                    print(f"[DEBUG] Row {row_num + 1} (original): {row}")
-                    print(f"[DEBUG] Row {row_num + 1} (cleaned): {cleaned_row}")
-            
-            print(f"[DEBUG] Successfully parsed {len(data)} rows from Google Sheets")
-            print(f"[DEBUG] Sample cleaned data: {data[0] if data else 'No data'}")
-            
-            return data
+    return {
+        'available': np is not None,
+        'mode': app_settings.get('semantic_search', 'off'),
+        'embedder': get_embedder_name(),
+        **stats,
+        'stores': stores
+    }
+
+def _collect_hits(searchers, find, limit):
+    """``(searcher, row)`` hits from each searcher in turn until ``limit``; ``find(searcher, limit)`` returns rows"""
+    hits = []
+    for searcher in searchers:
+        if len(hits) >= limit:
+            break
+        try:
+            hits.extend((searcher, row) for row in find(searcher, limit - len(hits)))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("Search in %s failed: %s", getattr(searcher, 'source', {}).get('label'), e)
+    return hits
+
+# ประมาณจำนวน token ของ Qwen3 (ไม่มี tokenizer จริงในเครื่อง) - ตั้งใจให้ประมาณเกินเล็กน้อย
+_TOKEN_ESTIMATE_RE = re.compile(r'[ก-๙]+|[A-Za-z]+|\d|\S')
+
+def estimate_tokens(text):
+    """Rough Qwen3 token count: Thai runs ~2 chars/token, Latin words ~4 chars/token, one per digit or symbol"""
+    tokens = 0
+    for run in _TOKEN_ESTIMATE_RE.findall(text):
+        if _is_thai_run(run):
+            tokens += (len(run) + 1) // 2
+        elif run.isascii() and run.isalpha():
+            tokens += (len(run) + 3) // 4
         else:
-            print(f"[DEBUG] Google Sheets error: HTTP {response.status_code}")
-            print(f"[DEBUG] Error response: {response.text[:500]}")
-            return None
-            
-    except Exception as e:
-        print(f"[DEBUG] Error fetching Google Sheets data: {e}")
-        import traceback
-        traceback.print_exc()
-        return None
+            tokens += 1
+    return tokens
 
-def authenticate_user(username, password):
-    """Authenticate user - first check default credentials, then Google Sheets"""
-    try:
-        # Check default credentials first
-        if username == DEFAULT_USER and password == DEFAULT_PASSWORD:
-            print(f"[DEBUG] User authenticated with default credentials: {username}")
-            return True
-        
-        # Then check Google Sheets
-        print(f"[DEBUG] Checking Google Sheets for user: {username}")
-        data = get_google_sheet_data(app_settings['google_sheet_id'])
-        if data and len(data) > 1:  # Check if we have data beyond headers
-            print(f"[DEBUG] Searching through {len(data)} rows for user credentials")
-            # Look for user in A2, B2 or scan through the sheet
-            for i, row in enumerate(data[1:], 1):  # Skip header row
-                if len(row) >= 2 and row[0] == username and row[1] == password:
-                    print(f"[DEBUG] User found in Google Sheets at row {i + 1}")
-                    return True
-        
-        print(f"[DEBUG] User authentication failed: {username}")
+def build_context(hits, budget):
+    """Pack best-first hits into at most ``budget`` estimated tokens.
+
+    Each source's header row goes in once, right before its first row, so
+    the model knows what the columns mean. Rows that do not fit are skipped
+    (a shorter, lower-ranked row may still fit); the best row is always
+    kept, cut to the budget if it alone is too long. Returns
+    ``(context, rows packed, estimated tokens)``.
+    """
+    lines = []
+    headers = set()
+    used = 0
+    packed = 0
+    for searcher, row in hits:
+        key, header = searcher.header_line(row)
+        header_key = (id(searcher), key)
+        if header_key in headers:
+            if row == key:
+                continue
+            needed = [searcher.format_row(row)]
+        else:
+            needed = [header] if row == key else [header, searcher.format_row(row)]
+        cost = sum(estimate_tokens(line) for line in needed)
+        if used + cost > budget:
+            if packed:
+                continue
+            # แถวที่ดีที่สุดยาวเกินงบ - ตัดให้พอดี
+            keep = max(budget - used, 1) / cost
+            needed = [line[:max(int(len(line) * keep), 1)] for line in needed]
+            cost = sum(estimate_tokens(line) for line in needed)
+        headers.add(header_key)
+        lines.extend(needed)
+        used += cost
+        packed += 1
+    return "\n".join(lines), packed, used
+
+def pack_search_context(hits):
+    """Search context for the best-first ``hits`` within the configured token budget"""
+    context, packed, tokens = build_context(hits, app_settings.get('context_token_budget', 1500))
+    with _search_index_lock:
+        search_stats['contexts_built'] += 1
+        search_stats['context_rows_dropped'] += len(hits) - packed
+        search_stats['context_tokens'] += tokens
+    logger.debug("Context: %d/%d rows, ~%d tokens", packed, len(hits), tokens,
+                 extra={'rows': packed, 'rows_dropped': len(hits) - packed, 'tokens': tokens})
+    return context
+
+# Common data viewing patterns
+SHOW_DATA_PATTERNS = [
+    'ขอดูข้อมูล', 'แสดงข้อมูล', 'ดูข้อมูล', 'แสดง', 'ดู',
+    'แถวแรก', 'แถว', 'รายการ', 'ข้อมูลทั้งหมด',
+    'show data', 'display data', 'view data', 'first rows'
+]
+
+def is_show_data_request(query):
+    """True when the user asks to see rows rather than ask about them"""
+    query_lower = query.lower()
+    return any(pattern in query_lower for pattern in SHOW_DATA_PATTERNS)
+
+# ข้อความที่ search_sheet_data คืนแทน context เมื่อไม่มีแถวให้ตอบ
+NO_SOURCE_CONTEXT = "ไม่สามารถเข้าถึงข้อมูลได้ในขณะนี้"
+NO_ROWS_CONTEXT = "ไม่พบข้อมูลใน Google Sheets"
+NO_MATCH_CONTEXT = "ไม่พบข้อมูลที่ตรงกับคำค้นหา"
+SEARCH_ERROR_CONTEXT = "เกิดข้อผิดพลาดในการค้นหา"
+
+def search_context_found(context):
+    """True when ``context`` holds sheet rows rather than one of the no-result messages"""
+    if not context or context in (NO_SOURCE_CONTEXT, NO_ROWS_CONTEXT, NO_MATCH_CONTEXT):
         return False
-    except Exception as e:
-        print(f"[DEBUG] Authentication error: {e}")
-        # If Google Sheets fails, still allow default login
-        return username == DEFAULT_USER and password == DEFAULT_PASSWORD
+    return not context.startswith(SEARCH_ERROR_CONTEXT)
 
 def search_sheet_data(query):
     """Search for relevant data in Google Sheets with enhanced pattern matching"""
     try:
-        print(f"[DEBUG] Searching Google Sheets for query: '{query}'")
-        data = get_google_sheet_data(app_settings['google_sheet_id'])
+        logger.debug("Searching Google Sheets for query: %r", query)
+        index = get_sources_search_index()
+        disk_sources = get_disk_sources()
         
-        if not data:
-            print("[DEBUG] No data returned from Google Sheets")
-            return "ไม่สามารถเข้าถึงข้อมูลได้ในขณะนี้"
+        if not index and not disk_sources:
+            logger.warning("No data returned from Google Sheets")
+            return NO_SOURCE_CONTEXT
         
-        print(f"[DEBUG] Searching through {len(data)} rows")
+        # index ในหน่วยความจำก่อน แล้วจึงค้นในไฟล์ CSV ขนาดใหญ่ / SQLite
+        searchers = ([index] if index else []) + disk_sources
+        data = index.data if index else None
+        logger.debug("Searching through %d indexed rows and %d on-disk sources", len(data) if data else 0, len(disk_sources))
         
         query_lower = query.lower()
         
-        # Check for common data viewing patterns
-        show_data_patterns = [
-            'ขอดูข้อมูล', 'แสดงข้อมูล', 'ดูข้อมูล', 'แสดง', 'ดู',
-            'แถวแรก', 'แถว', 'รายการ', 'ข้อมูลทั้งหมด',
-            'show data', 'display data', 'view data', 'first rows'
-        ]
-        
         # Check if user wants to view data
-        is_data_request = any(pattern in query_lower for pattern in show_data_patterns)
+        is_data_request = is_show_data_request(query)
         
         # Extract number of rows if specified
-        import re
         numbers = re.findall(r'\d+', query)
         requested_rows = int(numbers[0]) if numbers else 5
         
+        tokenizer = index.tokenizer if index else get_query_tokenizer()
+        query_terms = index.query_terms(query) if index else tokenize_query(tokenizer, query)
+        max_rows = max(1, app_settings.get('context_max_rows', 20))
+        
+        def rank_terms(searcher, terms, limit):
+            # index ในหน่วยความจำ: BM25 + คอลัมน์ที่ถามถึง, แหล่งบนดิสก์จัดอันดับเอง
+            return searcher.rank(terms, limit=limit) if searcher is index else searcher.search_terms(terms, limit=limit)
+        
+        def rank_phrase(searcher, limit):
+            if searcher is not index:
+                return searcher.search(query_lower, limit=limit)
+            rows = index.search(query_lower, limit=limit * 5)
+            return index.rank(query_terms, limit=limit, candidates=rows) if query_terms and len(rows) > 1 else rows[:limit]
+        
         if is_data_request:
+            # คำถามแบบ "ขอดูข้อมูลลูกค้า SD123" - ถ้ามีคำเฉพาะ (ไม่ใช่ชื่อคอลัมน์หรือจำนวนแถว) ให้ค้นหาก่อน
+            header_tokens = set(index.header_tokens) if index else set()
+            for source in disk_sources:
+                header_tokens.update(tokenizer.tokenize(' '.join(source.header)))
+            specific_terms = [
+                term for term in query_terms
+                if term not in header_tokens and not (term.isdigit() and len(term) <= 3)
+            ]
+            if specific_terms:
+                # คำที่เป็นชื่อคอลัมน์ยังใช้ระบุ field ตอนจัดอันดับ
+                ranked_terms = [term for term in query_terms if term in specific_terms or term in header_tokens]
+                hits = _collect_hits(searchers, lambda searcher, limit: rank_terms(searcher, ranked_terms, limit), max_rows)
+                if hits:
+                    logger.debug("Data request matched terms %s: %d rows", specific_terms, len(hits))
+                    return pack_search_context(hits)
+            
             # Return first N rows of data
-            print(f"[DEBUG] Detected data viewing request for {requested_rows} rows")
-            result_rows = []
+            logger.debug("Detected data viewing request for %d rows", requested_rows)
             
             # Limit to reasonable number
-            max_rows = min(requested_rows, 10, len(data))
-            
-            for i in range(max_rows):
-                if i < len(data) and data[i]:
-                    row_display = ' | '.join([str(cell) for cell in data[i] if cell])
-                    result_rows.append(f"แถวที่ {i + 1}: {row_display}")
+            view_rows = min(requested_rows, max_rows)
+            if data:
+                hits = [(index, i) for i in range(min(view_rows, len(data))) if data[i]]
+            else:
+                hits = [(disk_sources[0], row) for row in disk_sources[0].first_rows(view_rows)]
             
-            if result_rows:
-                result = "\n".join(result_rows)
-                print(f"[DEBUG] Returning {len(result_rows)} rows of data")
-                return result
+            if hits:
+                logger.debug("Returning %d rows of data", len(hits))
+                return pack_search_context(hits)
             else:
-                return "ไม่พบข้อมูลใน Google Sheets"
+                return NO_ROWS_CONTEXT
+        
+        # Original search functionality for specific content (ตอบจาก index)
+        # แถวที่มีทั้งประโยค จัดอันดับด้วย BM25 แล้วบรรจุตามงบ token
+        hits = _collect_hits(searchers, rank_phrase, max_rows)
         
-        # Original search functionality for specific content
-        relevant_data = []
+        search_mode = app_settings.get('search_mode', 'auto')
+        if not hits and query_terms and search_mode != 'fuzzy':
+            # ไม่พบทั้งประโยค - ค้นหาจากคำที่ตัดแล้ว
+            hits = _collect_hits(searchers, lambda searcher, limit: rank_terms(searcher, query_terms, limit), max_rows)
+            logger.debug("Term search %s", query_terms)
         
-        for row_idx, row in enumerate(data):
-            for col_idx, cell in enumerate(row):
-                if cell and query_lower in str(cell).lower():
-                    relevant_data.append(f"แถวที่ {row_idx + 1}: {' | '.join([str(c) for c in row if c])}")
-                    print(f"[DEBUG] Match found at row {row_idx + 1}, col {col_idx + 1}: {cell}")
+        # ค้นหาแบบใกล้เคียงใช้ vocabulary ของ index ในหน่วยความจำเท่านั้น
+        if not hits and index and query_terms and search_mode in ('fuzzy', 'auto'):
+            # ค้นหาแบบใกล้เคียง (พิมพ์ผิด) ภายในเวลาที่กำหนด
+            matched_rows, within_budget = index.search_fuzzy(
+                query_terms,
+                app_settings.get('fuzzy_threshold', 80) / 100,
+                app_settings.get('fuzzy_budget_ms', 50),
+                limit=max_rows
+            )
+            with _search_index_lock:
+                search_stats['fuzzy_queries'] += 1
+                if not within_budget:
+                    search_stats['fuzzy_budget_exceeded'] += 1
+            logger.debug("Fuzzy search %s: %d rows (within budget: %s)", query_terms, len(matched_rows), within_budget)
+            hits = [(index, row_idx) for row_idx in matched_rows]
         
-        print(f"[DEBUG] Found {len(relevant_data)} matches")
+        semantic_mode = app_settings.get('semantic_search', 'off')
+        if index and (semantic_mode == 'hybrid' or (semantic_mode == 'fallback' and not hits)):
+            # คำถามที่ใช้คำต่างจากในชีต (paraphrase) - จัดอันดับตามความหมายของทั้งแถว
+            meaning_hits = semantic_hits(index, query, max_rows)
+            hits = fuse_hits([hits, meaning_hits], max_rows) if hits else meaning_hits
         
-        if relevant_data:
-            # Remove duplicates and return top 5 matches
-            unique_data = list(dict.fromkeys(relevant_data))
-            result = "\n".join(unique_data[:5])
-            print(f"[DEBUG] Returning search results: {result[:200]}...")
+        logger.debug("Found %d matching rows", len(hits))
+        
+        if hits:
+            result = pack_search_context(hits)
+            logger.debug("Returning search results: %.200s...", result)
             return result
         else:
-            print("[DEBUG] No matches found in search")
-            return "ไม่พบข้อมูลที่ตรงกับคำค้นหา"
+            logger.debug("No matches found in search")
+            return NO_MATCH_CONTEXT
             
     except Exception as e:
-        print(f"[DEBUG] Search error: {e}")
-        import traceback
-        traceback.print_exc()
-        return f"เกิดข้อผิดพลาดในการค้นหา: {str(e)}"
+        logger.exception("Search error: %s", e)
+        return f"{SEARCH_ERROR_CONTEXT}: {str(e)}"
 
-def filter_ai_response(response):
-    """Filter out unwanted content from AI response - Enhanced version"""
-    if not response:
-        return response
-    
-    import re
-    
-    # Remove thinking process tags and content (case insensitive)
-    thinking_patterns = [
+# Post-processing ของคำตอบ AI - compile ครั้งเดียวตอนโหลดโมดูล (ลำดับเดิม)
+_THINKING_PATTERNS = [
+    re.compile(pattern, re.DOTALL | re.IGNORECASE) for pattern in (
         r'<think>.*?</think>',
-        r'<thinking>.*?</thinking>', 
+        r'<thinking>.*?</thinking>',
         r'<analysis>.*?</analysis>',
         r'<reasoning>.*?</reasoning>',
         r'<internal>.*?</internal>',
@@ -258,151 +4102,614 @@ def filter_ai_response(response):
         r'\(thinking:.*?\)',
         r'<พิจารณา>.*?</พิจารณา>',
         r'<คิด>.*?</คิด>'
-    ]
+    )
+]
+# วลีภาษาอังกฤษที่ขึ้นต้นบรรทัด (ไม่มีคำไหนเป็น prefix ของอีกคำ จึงรวมเป็น pattern เดียวได้)
+_ENGLISH_INTRO_RE = re.compile(
+    r'^(?:Looking at|Based on|From the|In the|The user|I can see|According to|Analyzing).*?(?=\n|\.|$)',
+    re.MULTILINE | re.IGNORECASE
+)
+_THAI_CHAR_RE = re.compile(r'[ก-๙]')
+_LATIN_CHAR_RE = re.compile(r'[a-zA-Z]')
+_LEADING_DIGIT_RE = re.compile(r'\d')
+_DATA_LINE_MARKERS = ('SD', ':', '-', '**', '•', '1.', '2.')
+EMPTY_FILTERED_RESPONSE = "ขออภัย ไม่สามารถประมวลผลคำตอบได้ในขณะนี้ กรุณาลองใหม่อีกครั้ง"
+
+@span('filter_response')
+def filter_ai_response(response):
+    """Filter out unwanted content from AI response - Enhanced version"""
+    if not response:
+        return response
     
-    for pattern in thinking_patterns:
-        response = re.sub(pattern, '', response, flags=re.DOTALL | re.IGNORECASE)
+    # Remove thinking process tags and content (case insensitive)
+    for pattern in _THINKING_PATTERNS:
+        response = pattern.sub('', response)
     
     # Remove common English thinking phrases at the beginning
-    english_patterns = [
-        r'^Looking at.*?(?=\n|\.|$)',
-        r'^Based on.*?(?=\n|\.|$)', 
-        r'^From the.*?(?=\n|\.|$)',
-        r'^In the.*?(?=\n|\.|$)',
-        r'^The user.*?(?=\n|\.|$)',
-        r'^I can see.*?(?=\n|\.|$)',
-        r'^According to.*?(?=\n|\.|$)',
-        r'^Analyzing.*?(?=\n|\.|$)'
-    ]
-    
-    for pattern in english_patterns:
-        response = re.sub(pattern, '', response, flags=re.MULTILINE | re.IGNORECASE)
+    response = _ENGLISH_INTRO_RE.sub('', response)
     
     # Split response and keep only Thai content parts
-    lines = response.split('\n')
     filtered_lines = []
-    
-    for line in lines:
+    for line in response.split('\n'):
         line = line.strip()
         if not line:
             continue
-            
-        # Skip lines that are predominantly English (rough check)
-        thai_chars = len(re.findall(r'[ก-๙]', line))
-        english_chars = len(re.findall(r'[a-zA-Z]', line))
-        
-        # Keep line if it has Thai content or essential data
-        if (thai_chars > 0 or 
-            any(keyword in line for keyword in ['SD', ':', '-', '**', '•', '1.', '2.']) or
-            re.match(r'^\d+', line) or  # Lines starting with numbers
-            len(line) < 50):  # Short lines might be data
+        
+        # Keep line if it is short (might be data), has essential data markers, Thai content or starts with a number
+        if (len(line) < 50 or
+            any(marker in line for marker in _DATA_LINE_MARKERS) or
+            _THAI_CHAR_RE.search(line) or
+            _LEADING_DIGIT_RE.match(line)):
             filtered_lines.append(line)
     
-    # Reconstruct response
-    response = '\n'.join(filtered_lines)
-    
-    # Clean up multiple newlines and spaces
-    response = re.sub(r'\n\s*\n\s*\n+', '\n\n', response)
-    response = re.sub(r'^\s+|\s+$', '', response)
+    # บรรทัดถูก strip และไม่มีบรรทัดว่างแล้ว จึงไม่ต้องยุบบรรทัดว่าง/ช่องว่างซ้ำอีก
+    if not filtered_lines:
+        return EMPTY_FILTERED_RESPONSE
     
     # Ensure the response starts properly (remove any leftover English intro)
-    if response:
-        first_line = response.split('\n')[0]
-        if (len(re.findall(r'[a-zA-Z]', first_line)) > len(re.findall(r'[ก-๙]', first_line)) and
-            len(first_line) > 30):
-            # Remove first line if it's predominantly English
-            response = '\n'.join(response.split('\n')[1:])
+    first_line = filtered_lines[0]
+    if (len(first_line) > 30 and
+            len(_LATIN_CHAR_RE.findall(first_line)) > len(_THAI_CHAR_RE.findall(first_line))):
+        # Remove first line if it's predominantly English
+        filtered_lines = filtered_lines[1:]
     
     # Ensure the response is not empty
-    if not response or response.isspace():
-        return "ขออภัย ไม่สามารถประมวลผลคำตอบได้ในขณะนี้ กรุณาลองใหม่อีกครั้ง"
+    if not filtered_lines:
+        return EMPTY_FILTERED_RESPONSE
     
-    return response.strip()
-def call_ai_model(prompt, context=""):
-    """Call the AI model with context and enhanced debugging"""
+    return '\n'.join(filtered_lines)
+
+def build_model_messages(prompt, context=""):
+    """Chat messages: the system prompt alone and unchanged first, then the sheet context and question.
+
+    Ollama keeps the KV state of the last prompt and only evaluates what
+    differs from it, so a byte-identical system message means every request
+    starts with an already-computed prefix; anything per-request goes after it.
+    """
+    return [
+        {'role': 'system', 'content': app_settings['system_prompt']},
+        {'role': 'user', 'content': f"Context from Google Sheets:\n{context}\n\nUser question: {prompt}"}
+    ]
+
+def get_keep_alive():
+    """``keep_alive`` for Ollama: plain numbers are seconds, anything else a duration string"""
+    keep_alive = str(app_settings.get('model_keep_alive', '30m')).strip()
+    return int(keep_alive) if keep_alive.lstrip('-').isdigit() else keep_alive
+
+def get_model_options():
+    """Ollama ``options`` from the AI settings (``max_tokens`` is Ollama's ``num_predict``)"""
+    params = app_settings['model_params']
+    return {
+        'temperature': params['temperature'],
+        'top_p': params['top_p'],
+        'num_predict': params['max_tokens']
+    }
+
+def normalize_model_params(data, current):
+    """Temperature/top_p/max_tokens from a request, falling back to ``current``; raises ValueError when out of range"""
+    params = {
+        'temperature': float(data.get('temperature', current['temperature'])),
+        'max_tokens': int(data.get('max_tokens', current['max_tokens'])),
+        'top_p': float(data.get('top_p', current['top_p']))
+    }
+    if not 0 <= params['temperature'] <= 2:
+        raise ValueError('temperature ต้องอยู่ระหว่าง 0 ถึง 2')
+    if not 0 < params['top_p'] <= 1:
+        raise ValueError('top_p ต้องมากกว่า 0 และไม่เกิน 1')
+    if params['max_tokens'] < 1:
+        raise ValueError('max_tokens ต้องมากกว่า 0')
+    return params
+
+def build_model_payload(prompt, context="", stream=False):
+    """Request body for Ollama's chat endpoint"""
+    messages = build_model_messages(prompt, context)
+    metrics.observe('prompt_chars', sum(len(message['content']) for message in messages))
+    return {
+        "model": CHAT_MODEL,
+        "messages": messages,
+        "stream": stream,
+        "keep_alive": get_keep_alive(),
+        "options": get_model_options()
+    }
+
+def model_response_text(result):
+    """Answer text of a chat response or stream chunk (``response`` for generate-style replies)"""
+    message = result.get('message')
+    if message is not None:
+        return message.get('content', '')
+    return result.get('response', '')
+
+def call_ai_model(prompt, context="", priority='chat', role='chat'):
+    """Call the AI model with context and enhanced debugging.
+
+    ``role`` picks the backend group (``small`` for show-data requests).
+    Raises ModelBusyError when the model scheduler sheds the call.
+    """
     try:
-        # Enhanced system prompt to handle data viewing requests better
-        enhanced_system_prompt = f"""{app_settings['system_prompt']}
-
-คำแนะนำเพิ่มเติม:
-- ห้ามแสดงกระบวนการคิด (thinking process) หรือ internal analysis
-- ห้ามใช้ tag <think> หรือแท็กคล้ายๆ ในการตอบ
-- ตอบเป็นภาษาไทยเท่านั้น
-- เมื่อผู้ใช้ถามขอดูข้อมูล แสดงข้อมูล หรือคำถามคล้ายกัน ให้แสดงข้อมูลที่มีใน Context
-- หากมีข้อมูลใน Context แล้ว ไม่ต้องบอกว่า "ไม่พบข้อมูล"
-- จัดรูปแบบข้อมูลให้อ่านง่าย เช่น ใส่หัวข้อ หรือจัดเรียงเป็นตาราง
-- หาก Context มีข้อมูล ให้ตอบจากข้อมูลนั้นเสมอ"""
-        
-        full_prompt = f"{enhanced_system_prompt}\n\nContext from Google Sheets:\n{context}\n\nUser question: {prompt}"
-        
-        payload = {
-            "model": CHAT_MODEL,
-            "prompt": full_prompt,
-            "stream": False
-        }
+        payload = build_model_payload(prompt, context)
+        prompt_length = sum(len(message['content']) for message in payload['messages'])
         
-        print(f"[DEBUG] Calling AI model: {CHAT_MODEL}")
-        print(f"[DEBUG] API URL: {CHAT_API_URL}")
-        print(f"[DEBUG] Prompt length: {len(full_prompt)} characters")
-        print(f"[DEBUG] Context preview: {context[:200]}...")
+        logger.debug("Calling AI model: role %s", role)
+        logger.debug("Prompt length: %d characters", prompt_length)
+        logger.debug("Context preview: %.200s...", context)
         
-        response = requests.post(CHAT_API_URL, json=payload, timeout=30)
+        # prompt + context เดียวกันที่กำลังรอผลอยู่ ใช้ผลลัพธ์ร่วมกัน
+        status_code, result = model_flight.do((role, model_flight_key(payload)), post_model_chat, payload,
+                                              priority=priority, role=role)
         
-        print(f"[DEBUG] AI response status: {response.status_code}")
+        logger.debug("AI response status: %s", status_code)
         
-        if response.status_code == 200:
-            result = response.json()
-            ai_response = result.get('response', 'ไม่สามารถสร้างคำตอบได้')
-            print(f"[DEBUG] AI response length: {len(ai_response)} characters")
-            print(f"[DEBUG] AI response preview: {ai_response[:200]}...")
+        if status_code == 200:
+            ai_response = model_response_text(result) or 'ไม่สามารถสร้างคำตอบได้'
+            logger.debug("AI response length: %d characters", len(ai_response))
+            logger.debug("AI response preview: %.200s...", ai_response)
             return ai_response
         else:
-            error_msg = f"HTTP {response.status_code}: {response.text}"
-            print(f"[DEBUG] AI error: {error_msg}")
-            return "ขออภัย เกิดข้อผิดพลาดในการเชื่อมต่อ AI"
+            error_msg = f"HTTP {status_code}: {result}"
+            logger.warning("AI error: %s", error_msg)
+            return AI_CONNECTION_ERROR
             
+    except ModelBusyError:
+        raise
     except Exception as e:
-        print(f"[DEBUG] AI Model error: {e}")
-        import traceback
-        traceback.print_exc()
-        return "เกิดข้อผิดพลาดในการประมวลผล โปรดลองใหม่อีกครั้ง"
+        logger.exception("AI Model error: %s", e)
+        return AI_PROCESSING_ERROR
+
+def post_model_chat(payload, timeout=None, priority='chat', role='chat'):
+    """POST to a pool backend, failing over to the next one on connection errors, 404 and 5xx.
+
+    Returns ``(status_code, parsed JSON or error text)`` of the last backend
+    tried; raises the last connection error when no backend answered.
+    """
+    kwargs = {'timeout': timeout} if timeout else {}
+    response = error = None
+    # รอ slot ก่อน แล้วจึงจับเวลาขั้น model (เวลารอคิววัดแยกเป็น model_queue)
+    with model_scheduler.slot(priority), span('model'):
+        for backend in model_pool.failover(role):
+            started = time.perf_counter()
+            try:
+                response = model_client.post(backend.chat_url(), json=dict(payload, model=backend.model), **kwargs)
+            except requests.RequestException as e:
+                response, error = None, e
+                model_pool.release(backend, started, e)
+                continue
+            if model_backend_failed(response.status_code):
+                model_pool.release(backend, started, f"HTTP {response.status_code}")
+                continue
+            model_pool.release(backend, started)
+            break
+    if response is None:
+        raise error
+    if response.status_code == 200:
+        result = response.json()
+        record_model_timings(result)
+        return response.status_code, result
+    return response.status_code, response.text
+
+# เวลาที่ Ollama รายงานกับคำตอบ (nanoseconds) แยก cold start / warm
+model_stats = {
+    'requests': 0,
+    'cold_starts': 0,
+    'cold_total_ms': 0.0,
+    'warm_total_ms': 0.0,
+    'load_ms': 0.0,
+    'last_load_ms': None,
+    'last_cold_start': None,
+    'prompt_eval_tokens': 0,
+    'prompt_eval_ms': 0.0,
+    'eval_tokens': 0,
+    'eval_ms': 0.0,
+    'warmups': 0,
+    'warmup_errors': 0
+}
+_model_stats_lock = threading.Lock()
+
+def record_model_timings(result, warmup=False):
+    """Account the timing fields of a finished answer (full response or final stream chunk); returns True on a cold start"""
+    load_ms = result.get('load_duration', 0) / 1e6
+    total_ms = result.get('total_duration', 0) / 1e6
+    cold = load_ms >= MODEL_COLD_LOAD_MS
+    with _model_stats_lock:
+        model_stats['last_load_ms'] = round(load_ms, 1)
+        if warmup:
+            model_stats['warmups'] += 1
+            return cold
+        model_stats['requests'] += 1
+        model_stats['load_ms'] += load_ms
+        if cold:
+            model_stats['cold_starts'] += 1
+            model_stats['cold_total_ms'] += total_ms
+            model_stats['last_cold_start'] = datetime.now().isoformat()
+        else:
+            model_stats['warm_total_ms'] += total_ms
+        # prompt_eval_count นับเฉพาะ token ที่ไม่ได้มาจาก prefix ใน KV cache
+        model_stats['prompt_eval_tokens'] += result.get('prompt_eval_count', 0)
+        model_stats['prompt_eval_ms'] += result.get('prompt_eval_duration', 0) / 1e6
+        model_stats['eval_tokens'] += result.get('eval_count', 0)
+        model_stats['eval_ms'] += result.get('eval_duration', 0) / 1e6
+    if result.get('eval_duration'):
+        metrics.observe('model_tokens_per_second', result.get('eval_count', 0) / (result['eval_duration'] / 1e9))
+    if cold:
+        logger.info("Model cold start: load %.0f ms, total %.0f ms", load_ms, total_ms,
+                    extra={'load_ms': round(load_ms, 1), 'total_ms': round(total_ms, 1)})
+    return cold
 
-def call_ai_model(prompt, context=""):
-    """Call the AI model with context and enhanced debugging"""
+def get_model_stats():
+    with _model_stats_lock:
+        stats = dict(model_stats)
+    warm = stats['requests'] - stats['cold_starts']
+    stats.update({
+        'model': model_pool.primary().model,
+        'keep_alive': get_keep_alive(),
+        'avg_cold_ms': round(stats['cold_total_ms'] / stats['cold_starts'], 1) if stats['cold_starts'] else None,
+        'avg_warm_ms': round(stats['warm_total_ms'] / warm, 1) if warm else None,
+        'avg_prompt_eval_tokens': round(stats['prompt_eval_tokens'] / stats['requests'], 1) if stats['requests'] else None,
+        'eval_tokens_per_second': round(stats['eval_tokens'] / (stats['eval_ms'] / 1000), 1) if stats['eval_ms'] else None
+    })
+    for key in ('cold_total_ms', 'warm_total_ms', 'load_ms', 'prompt_eval_ms', 'eval_ms'):
+        stats[key] = round(stats[key], 1)
+    return stats
+
+def warm_model(backend=None):
+    """Load the model and evaluate the system-prompt prefix before the first question arrives"""
+    backend = backend or model_pool.primary()
+    payload = {
+        'model': backend.model,
+        'messages': [build_model_messages('')[0], {'role': 'user', 'content': 'สวัสดี'}],
+        'stream': False,
+        'keep_alive': get_keep_alive(),
+        'options': {'num_predict': 1}
+    }
     try:
-        full_prompt = f"{app_settings['system_prompt']}\n\nContext from Google Sheets:\n{context}\n\nUser question: {prompt}"
-        
-        payload = {
-            "model": CHAT_MODEL,
-            "prompt": full_prompt,
-            "stream": False
-        }
-        
-        print(f"[DEBUG] Calling AI model: {CHAT_MODEL}")
-        print(f"[DEBUG] API URL: {CHAT_API_URL}")
-        print(f"[DEBUG] Prompt length: {len(full_prompt)} characters")
-        print(f"[DEBUG] Context preview: {context[:200]}...")
+        with model_scheduler.slot('background'):
+            response = model_client.post(backend.chat_url(), json=payload, timeout=max(MODEL_HTTP_TIMEOUT, 120))
+        response.raise_for_status()
+        result = response.json()
+    except ModelBusyError:
+        # มีงานใช้โมเดลอยู่แล้ว - โมเดลถูกโหลดอยู่ ไม่ต้อง warm-up
+        logger.info("Model warm-up skipped for %s: model is busy", backend.name)
+        return None
+    except (requests.RequestException, ValueError) as e:
+        with _model_stats_lock:
+            model_stats['warmup_errors'] += 1
+        logger.warning("Model warm-up failed for %s: %s", backend.name, e)
+        return None
+    record_model_timings(result, warmup=True)
+    logger.info("Model warm-up %s: load %.0f ms, prompt %d tokens", backend.name,
+                result.get('load_duration', 0) / 1e6, result.get('prompt_eval_count', 0))
+    return result
+
+def warm_all_models():
+    for backend in list(model_pool.backends):
+        warm_model(backend)
+
+def warm_model_async():
+    """Warm every pool backend in a background thread (startup, system prompt changes)"""
+    if MODEL_WARMUP:
+        threading.Thread(target=warm_all_models, name='model-warmup', daemon=True).start()
+
+class ThinkTagStripper:
+    """Incrementally remove <think>...</think>-style blocks from streamed model output.
+
+    Feed chunks as they arrive; text outside thinking tags is returned as
+    soon as it can no longer be the start of a tag. Tags split across
+    chunks are handled by holding back the ambiguous tail.
+    """
+    
+    TAG_NAMES = ('think', 'thinking', 'analysis', 'reasoning', 'internal', 'thought', 'พิจารณา', 'คิด')
+    OPEN_TAG_RE = re.compile(r'<(' + '|'.join(TAG_NAMES) + r')>', re.IGNORECASE)
+    MAX_OPEN_TAG = max(len(name) for name in TAG_NAMES) + 2
+    
+    def __init__(self):
+        self.buffer = ''
+        self.inside = None
+        self.started = False
+    
+    def _could_open_tag(self, tail):
+        tail = tail.lower()
+        return any(f"<{name}>".startswith(tail) for name in self.TAG_NAMES)
+    
+    def _emit(self, text):
+        # ตัดช่องว่างที่ขึ้นต้นคำตอบ (มักตามหลัง </think>)
+        if not self.started:
+            text = text.lstrip()
+            if text:
+                self.started = True
+        return text
+    
+    def feed(self, chunk):
+        self.buffer += chunk
+        output = []
+        while self.buffer:
+            if self.inside:
+                close_tag = f"</{self.inside}>"
+                match = re.search(re.escape(close_tag), self.buffer, re.IGNORECASE)
+                if not match:
+                    # เก็บเฉพาะส่วนท้ายที่อาจเป็นจุดเริ่มของ tag ปิด
+                    self.buffer = self.buffer[-(len(close_tag) - 1):]
+                    break
+                self.buffer = self.buffer[match.end():]
+                self.inside = None
+                continue
+            
+            match = self.OPEN_TAG_RE.search(self.buffer)
+            if match:
+                output.append(self.buffer[:match.start()])
+                self.inside = match.group(1).lower()
+                self.buffer = self.buffer[match.end():]
+                continue
+            
+            cut = self.buffer.rfind('<')
+            if cut != -1 and len(self.buffer) - cut < self.MAX_OPEN_TAG and self._could_open_tag(self.buffer[cut:]):
+                output.append(self.buffer[:cut])
+                self.buffer = self.buffer[cut:]
+            else:
+                output.append(self.buffer)
+                self.buffer = ''
+            break
+        return self._emit(''.join(output))
+    
+    def flush(self):
+        """Return any held-back text; an unclosed thinking block is dropped"""
+        text = '' if self.inside else self.buffer
+        self.buffer = ''
+        return self._emit(text)
+
+# สถิติการ stream คำตอบ (time-to-first-token)
+streaming_stats = {
+    'streams': 0,
+    'errors': 0,
+    'last_ttft_ms': None,
+    'total_ttft_ms': 0.0,
+    'ttft_samples': 0
+}
+_streaming_stats_lock = threading.Lock()
+
+class ModelStream:
+    """Per-request state of a streamed model answer.
+
+    Turns Ollama's NDJSON lines into ``token`` events (thinking blocks
+    stripped) and a final ``done`` event with the full answer and timing.
+    Shared by the Flask generator and the async server so both report the
+    same events and TTFT statistics.
+    """
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.admitted = self.started
+        self.stripper = ThinkTagStripper()
+        self.pieces = []
+        self.first_upstream_ms = None
+        self.ttft_ms = None
+        self.finished = False
+        self.cold_start = None
+    
+    def on_line(self, line):
+        """Process one NDJSON line; returns a token event or None"""
+        if not line:
+            return None
+        chunk = json.loads(line)
+        if self.first_upstream_ms is None:
+            self.first_upstream_ms = (time.perf_counter() - self.started) * 1000
         
-        response = requests.post(CHAT_API_URL, json=payload, timeout=30)
+        text = self.stripper.feed(model_response_text(chunk))
+        if chunk.get('done'):
+            text += self.stripper.flush()
+            self.finished = True
+            self.cold_start = record_model_timings(chunk)
+        if not text:
+            return None
+        if self.ttft_ms is None:
+            self.ttft_ms = (time.perf_counter() - self.started) * 1000
+        self.pieces.append(text)
+        return {'type': 'token', 'text': text}
+    
+    def admit(self):
+        """Mark the moment the scheduler gave this stream a slot (the model stage starts here)"""
+        self.admitted = time.perf_counter()
+    
+    def error_event(self, message):
+        metrics.observe('stage_duration_seconds', time.perf_counter() - self.admitted, stage='model')
+        with _streaming_stats_lock:
+            streaming_stats['errors'] += 1
+        return {'type': 'error', 'error': message}
+    
+    def busy_event(self, error):
+        """Error event for a stream the scheduler shed (no model time to record)"""
+        with _streaming_stats_lock:
+            streaming_stats['errors'] += 1
+        return {'type': 'error', 'error': MODEL_BUSY_MESSAGE, 'busy': True, 'retry_after': error.retry_after}
+    
+    def done_event(self):
+        total_ms = (time.perf_counter() - self.started) * 1000
+        metrics.observe('stage_duration_seconds', time.perf_counter() - self.admitted, stage='model')
+        if self.ttft_ms is not None:
+            metrics.observe('stage_duration_seconds', self.ttft_ms / 1000, stage='model_first_token')
+        with _streaming_stats_lock:
+            streaming_stats['streams'] += 1
+            if self.ttft_ms is not None:
+                streaming_stats['last_ttft_ms'] = round(self.ttft_ms, 1)
+                streaming_stats['total_ttft_ms'] += self.ttft_ms
+                streaming_stats['ttft_samples'] += 1
         
-        print(f"[DEBUG] AI response status: {response.status_code}")
+        logger.debug("AI stream completed - TTFT: %s ms, total: %.0f ms", self.ttft_ms, total_ms)
         
-        if response.status_code == 200:
-            result = response.json()
-            ai_response = result.get('response', 'ไม่สามารถสร้างคำตอบได้')
-            print(f"[DEBUG] AI response length: {len(ai_response)} characters")
-            print(f"[DEBUG] AI response preview: {ai_response[:200]}...")
-            return ai_response
-        else:
-            error_msg = f"HTTP {response.status_code}: {response.text}"
-            print(f"[DEBUG] AI error: {error_msg}")
-            return "ขออภัย เกิดข้อผิดพลาดในการเชื่อมต่อ AI"
-            
+        return {
+            'type': 'done',
+            'response': ''.join(self.pieces) or 'ไม่สามารถสร้างคำตอบได้',
+            'ttft_ms': round(self.ttft_ms, 1) if self.ttft_ms is not None else None,
+            'first_upstream_token_ms': round(self.first_upstream_ms, 1) if self.first_upstream_ms is not None else None,
+            'total_ms': round(total_ms, 1),
+            'cold_start': self.cold_start
+        }
+
+def open_model_stream(payload, role='chat'):
+    """Open a streamed chat on the first pool backend that accepts it.
+
+    Failover happens only here, before any chunk is read. Returns
+    ``(backend, started, response)``; the caller releases the backend.
+    Raises the last connection error when no backend answered.
+    """
+    response = error = None
+    for backend in model_pool.failover(role):
+        started = time.perf_counter()
+        try:
+            # timeout ของการอ่านคือช่วงห่างระหว่าง chunk ไม่ใช่เวลารวมของคำตอบ
+            response = model_client.post(backend.chat_url(), json=dict(payload, model=backend.model),
+                                         stream=True, timeout=(5, 60))
+        except requests.RequestException as e:
+            response, error = None, e
+            model_pool.release(backend, started, e)
+            continue
+        if not model_backend_failed(response.status_code):
+            return backend, started, response
+        response.close()
+        model_pool.release(backend, started, f"HTTP {response.status_code}")
+    if response is None:
+        raise error
+    # ทุก backend ตอบ error - ส่ง response สุดท้ายให้ผู้เรียกรายงาน
+    return None, None, response
+
+def stream_ai_model(prompt, context="", priority='chat', role='chat'):
+    """Stream the model answer from Ollama, yielding NDJSON-ready event dicts.
+
+    Yields ``{'type': 'token', 'text': ...}`` for visible text as it arrives,
+    then one ``{'type': 'done', ...}`` event with the full answer and timing.
+    """
+    state = ModelStream()
+    payload = build_model_payload(prompt, context, stream=True)
+    
+    logger.debug("Streaming AI model: role %s", role)
+    
+    try:
+        # ถือ slot ไว้จนจบ stream (ปิด generator กลางทาง = คืน slot)
+        with model_scheduler.slot(priority):
+            state.admit()
+            backend, started, response = open_model_stream(payload, role)
+            error = None
+            try:
+                with response:
+                    if response.status_code != 200:
+                        logger.warning("AI stream error: HTTP %s", response.status_code)
+                        yield state.error_event(AI_CONNECTION_ERROR)
+                        return
+                    
+                    for line in response.iter_lines():
+                        event = state.on_line(line)
+                        if event:
+                            yield event
+                        if state.finished:
+                            break
+                    if not state.finished:
+                        # ขาดกลางทาง - ไม่ส่ง done เพื่อไม่ให้คำตอบที่ไม่ครบถูก cache
+                        raise ValueError('model stream ended before the final chunk')
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                if backend is not None:
+                    model_pool.release(backend, started, error)
+    except ModelBusyError as e:
+        yield state.busy_event(e)
+        return
     except Exception as e:
-        print(f"[DEBUG] AI Model error: {e}")
-        import traceback
-        traceback.print_exc()
-        return "เกิดข้อผิดพลาดในการประมวลผล โปรดลองใหม่อีกครั้ง"
+        logger.warning("AI stream error: %s", e)
+        yield state.error_event(AI_PROCESSING_ERROR)
+        return
+    
+    yield state.done_event()
+
+def get_streaming_stats():
+    with _streaming_stats_lock:
+        samples = streaming_stats['ttft_samples']
+        return {
+            'streams': streaming_stats['streams'],
+            'errors': streaming_stats['errors'],
+            'last_ttft_ms': streaming_stats['last_ttft_ms'],
+            'avg_ttft_ms': round(streaming_stats['total_ttft_ms'] / samples, 1) if samples else None
+        }
+
+def model_busy_response(error, body=None):
+    """Fast 503 for a call the model scheduler shed"""
+    body = dict(body or {'error': MODEL_BUSY_MESSAGE})
+    body.update({'busy': True, 'reason': error.reason, 'retry_after': error.retry_after})
+    response = jsonify(body)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def prepare_chat_turn(message):
+    """Sheet search and response-cache lookup for one chat message.
+
+    Shared by the Flask routes and the async server; the caller only has
+    to produce the model answer when ``cached_response`` is None.
+    """
+    logger.debug("Starting Google Sheets search...")
+    with span('search'):
+        context = search_sheet_data(message)
+    role = model_role_for(message)
+    cache_key = response_cache.make_key(message, context, role)
+    return {
+        'message': message,
+        'context': context,
+        'context_found': search_context_found(context),
+        'cache_key': cache_key,
+        'cached_response': response_cache.get(cache_key),
+        'role': role
+    }
+
+def chat_result(turn, ai_response):
+    """Store a fresh answer in the response cache and build the /api/chat JSON body"""
+    cached = turn['cached_response'] is not None
+    if not cached:
+        response_cache.put(turn['cache_key'], ai_response, turn['context'])
+        metrics.observe('response_chars', len(ai_response))
+    count_chat_request('chat', cached)
+    
+    context = turn['context']
+    logger.debug("Chat response completed - Context found: %s", turn['context_found'])
+    
+    return {
+        'response': ai_response,
+        'context_found': turn['context_found'],
+        'cached': cached,
+        'timestamp': datetime.now().isoformat(),
+        'debug_info': {
+            'context_preview': context[:100] + '...' if len(context) > 100 else context,
+            'context_tokens': estimate_tokens(context),
+            'sheet_id': app_settings['google_sheet_id']
+        }
+    }
+
+def cached_stream_events(turn):
+    """Token and done events that replay a cached answer on the streaming endpoint"""
+    # คำตอบที่เก็บจาก /api/chat อาจยังมี <think> อยู่
+    stripper = ThinkTagStripper()
+    text = stripper.feed(turn['cached_response']) + stripper.flush()
+    return [
+        {'type': 'token', 'text': text},
+        {'type': 'done', 'response': text, 'ttft_ms': 0.0, 'first_upstream_token_ms': None, 'total_ms': 0.0, 'cold_start': None}
+    ]
+
+def stream_event_line(turn, event):
+    """Serialize one stream event as an NDJSON line, caching the answer on ``done``"""
+    if event['type'] == 'done':
+        cached = turn['cached_response'] is not None
+        if not cached:
+            response_cache.put(turn['cache_key'], event['response'], turn['context'])
+            metrics.observe('response_chars', len(event['response']))
+        count_chat_request('stream', cached)
+        event['cached'] = cached
+        event['context_found'] = turn['context_found']
+        event['timestamp'] = datetime.now().isoformat()
+    return json.dumps(event, ensure_ascii=False) + '\n'
+
+def stream_meta_line(turn):
+    return json.dumps({
+        'type': 'meta',
+        'context_found': turn['context_found'],
+        'cached': turn['cached_response'] is not None
+    }, ensure_ascii=False) + '\n'
 
 @app.route('/')
 def index():
@@ -415,26 +4722,26 @@ def login():
         username = data.get('username')
         password = data.get('password')
         
-        print(f"[DEBUG] Login attempt for user: {username}")
+        logger.debug("Login attempt for user: %s", username)
         
         if authenticate_user(username, password):
             session['logged_in'] = True
             session['username'] = username
-            print(f"[DEBUG] Login successful for user: {username}")
+            logger.info("Login successful for user: %s", username)
             return jsonify({'success': True, 'message': 'เข้าสู่ระบบสำเร็จ'})
         else:
-            print(f"[DEBUG] Login failed for user: {username}")
+            logger.warning("Login failed for user: %s", username)
             return jsonify({'success': False, 'message': 'ชื่อผู้ใช้หรือรหัสผ่านไม่ถูกต้อง'})
             
     except Exception as e:
-        print(f"[DEBUG] Login error: {e}")
+        logger.error("Login error: %s", e)
         return jsonify({'success': False, 'message': 'เกิดข้อผิดพลาดในระบบ'})
 
 @app.route('/api/logout', methods=['POST'])
 def logout():
     username = session.get('username', 'unknown')
     session.clear()
-    print(f"[DEBUG] User logged out: {username}")
+    logger.info("User logged out: %s", username)
     return jsonify({'success': True, 'message': 'ออกจากระบบสำเร็จ'})
 
 @app.route('/api/chat', methods=['POST'])
@@ -446,39 +4753,63 @@ def chat():
         data = request.json
         message = data.get('message', '')
         
-        print(f"[DEBUG] Chat message received: '{message}'")
+        logger.debug("Chat message received: %r", message)
         
         if not message:
             return jsonify({'error': 'กรุณาใส่ข้อความ'})
         
-        # Search for relevant context in Google Sheets
-        print("[DEBUG] Starting Google Sheets search...")
-        context = search_sheet_data(message)
-        
-        # Get AI response
-        print("[DEBUG] Starting AI model call...")
-        ai_response = call_ai_model(message, context)
-        
-        context_found = bool(context and 'ไม่พบข้อมูล' not in context and 'ไม่สามารถเข้าถึงข้อมูล' not in context)
-        
-        print(f"[DEBUG] Chat response completed - Context found: {context_found}")
+        with span('total'):
+            # Search for relevant context in Google Sheets
+            turn = prepare_chat_turn(message)
+            
+            # Get AI response (ใช้คำตอบจาก cache ถ้าเคยถามคำถามเดียวกันด้วย context เดียวกัน)
+            ai_response = turn['cached_response']
+            if ai_response is not None:
+                logger.debug("Response cache hit")
+            else:
+                logger.debug("Starting AI model call...")
+                ai_response = call_ai_model(message, turn['context'], role=turn['role'])
         
-        return jsonify({
-            'response': ai_response,
-            'context_found': context_found,
-            'timestamp': datetime.now().isoformat(),
-            'debug_info': {
-                'context_preview': context[:100] + '...' if len(context) > 100 else context,
-                'sheet_id': app_settings['google_sheet_id']
-            }
-        })
+        return jsonify(chat_result(turn, ai_response))
         
+    except ModelBusyError as e:
+        return model_busy_response(e)
     except Exception as e:
-        print(f"[DEBUG] Chat error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Chat error: %s", e)
         return jsonify({'error': 'เกิดข้อผิดพลาดในการประมวลผล'}), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streaming variant of /api/chat - NDJSON events, one JSON object per line"""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'กรุณาเข้าสู่ระบบก่อน'}), 401
+    
+    data = request.json
+    message = data.get('message', '')
+    
+    logger.debug("Streaming chat message received: %r", message)
+    
+    if not message:
+        return jsonify({'error': 'กรุณาใส่ข้อความ'})
+    
+    turn = prepare_chat_turn(message)
+    
+    def generate():
+        yield stream_meta_line(turn)
+        if turn['cached_response'] is not None:
+            events = cached_stream_events(turn)
+        else:
+            events = stream_ai_model(message, turn['context'], role=turn['role'])
+        
+        for event in events:
+            yield stream_event_line(turn, event)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/admin-help', methods=['POST'])
 def admin_help():
     if not session.get('logged_in'):
@@ -488,7 +4819,7 @@ def admin_help():
         data = request.json
         question = data.get('message', '')
         
-        print(f"[DEBUG] Admin help request: '{question}'")
+        logger.debug("Admin help request: %r", question)
         
         # Admin helper responses
         help_responses = {
@@ -531,7 +4862,7 @@ def admin_help():
         return jsonify({'response': response})
         
     except Exception as e:
-        print(f"[DEBUG] Admin help error: {e}")
+        logger.error("Admin help error: %s", e)
         return jsonify({'error': 'เกิดข้อผิดพลาดในระบบช่วยเหลือ'}), 500
 
 @app.route('/api/settings', methods=['GET', 'POST'])
@@ -543,22 +4874,66 @@ def settings():
         try:
             data = request.json
             old_sheet_id = app_settings['google_sheet_id']
+            old_system_prompt = app_settings['system_prompt']
             
-            app_settings.update({
+            # ตรวจทุกค่าก่อน แล้วจึงบันทึกพร้อมกัน (ค่าผิดค่าเดียวไม่ทำให้บันทึกไปครึ่งเดียว)
+            updates = {
                 'system_prompt': data.get('system_prompt', app_settings['system_prompt']),
-                'google_sheet_id': data.get('google_sheet_id', app_settings['google_sheet_id']),
                 'line_token': data.get('line_token', app_settings['line_token']),
-                'telegram_api': data.get('telegram_api', app_settings['telegram_api'])
-            })
+                'telegram_api': data.get('telegram_api', app_settings['telegram_api']),
+                'sheet_cache_ttl': int(data.get('sheet_cache_ttl', app_settings['sheet_cache_ttl'])),
+                'search_mode': data.get('search_mode', app_settings['search_mode']),
+                'fuzzy_threshold': int(data.get('fuzzy_threshold', app_settings['fuzzy_threshold'])),
+                'fuzzy_budget_ms': int(data.get('fuzzy_budget_ms', app_settings['fuzzy_budget_ms'])),
+                'context_max_rows': int(data.get('context_max_rows', app_settings['context_max_rows'])),
+                'context_token_budget': int(data.get('context_token_budget', app_settings['context_token_budget'])),
+                'semantic_search': data.get('semantic_search', app_settings['semantic_search']),
+                'embedding_backend': data.get('embedding_backend', app_settings['embedding_backend']),
+                'semantic_min_score': float(data.get('semantic_min_score', app_settings['semantic_min_score']))
+            }
+            if updates['search_mode'] not in SEARCH_MODES:
+                raise ValueError(f"search_mode ต้องเป็น {', '.join(SEARCH_MODES)}")
+            if updates['semantic_search'] not in SEMANTIC_SEARCH_MODES:
+                raise ValueError(f"semantic_search ต้องเป็น {', '.join(SEMANTIC_SEARCH_MODES)}")
+            if updates['embedding_backend'] not in EMBEDDERS:
+                raise ValueError(f"embedding_backend ต้องเป็น {', '.join(EMBEDDERS)}")
+            log_level = str(data['log_level']).upper() if 'log_level' in data else None
+            if log_level is not None and log_level not in LOG_LEVELS:
+                raise ValueError(f"log_level ต้องเป็น {', '.join(LOG_LEVELS)}")
+            limits = {
+                'max_in_flight': data.get('model_max_in_flight'),
+                'max_queue': data.get('model_max_queue'),
+                'queue_timeout': data.get('model_queue_timeout')
+            }
+            limits = {name: (float if name == 'queue_timeout' else int)(value)
+                      for name, value in limits.items() if value is not None}
+            
+            app_settings.update(updates)
+            model_scheduler.configure(**limits)
+            if log_level is not None:
+                logger.setLevel(log_level)
             
-            print(f"[DEBUG] Settings updated - Sheet ID changed from {old_sheet_id} to {app_settings['google_sheet_id']}")
+            replace_sheet_id(old_sheet_id, data.get('google_sheet_id', old_sheet_id))
+            if app_settings['system_prompt'] != old_system_prompt:
+                response_cache.clear('system prompt changed')
+                warm_model_async()  # prefix ใหม่ - ประมวลผล system prompt ไว้ก่อนคำถามแรก
+            
+            logger.info("Settings updated - Sheet ID changed from %s to %s", old_sheet_id, app_settings['google_sheet_id'])
             
             return jsonify({'success': True, 'message': 'บันทึกการตั้งค่าสำเร็จ'})
+        except (ValueError, TypeError) as e:
+            logger.warning("Settings rejected: %s", e)
+            return jsonify({'success': False, 'message': f'ค่าการตั้งค่าไม่ถูกต้อง: {e}'}), 400
         except Exception as e:
-            print(f"[DEBUG] Settings update error: {e}")
+            logger.error("Settings update error: %s", e)
             return jsonify({'success': False, 'message': 'เกิดข้อผิดพลาดในการบันทึก'})
     
-    return jsonify(app_settings)
+    return jsonify({
+        **app_settings,
+        'model_max_in_flight': model_scheduler.max_in_flight,
+        'model_max_queue': model_scheduler.max_queue,
+        'model_queue_timeout': model_scheduler.queue_timeout
+    })
 
 @app.route('/api/test-connection', methods=['POST'])
 def test_connection():
@@ -566,28 +4941,19 @@ def test_connection():
         return jsonify({'error': 'กรุณาเข้าสู่ระบบก่อน'}), 401
     
     try:
-        print("[DEBUG] Starting connection test...")
+        logger.debug("Starting connection test...")
         
         # Test Google Sheets connection
-        print("[DEBUG] Testing Google Sheets connection...")
+        logger.debug("Testing Google Sheets connection...")
         data = get_google_sheet_data(app_settings['google_sheet_id'])
         sheets_status = bool(data)
         sheets_details = f"Found {len(data)} rows" if data else "No data accessible"
         
         # Test AI model connection
-        print("[DEBUG] Testing AI model connection...")
-        try:
-            test_response = requests.post(CHAT_API_URL, 
-                                        json={"model": CHAT_MODEL, "prompt": "test", "stream": False}, 
-                                        timeout=10)
-            ai_status = test_response.status_code == 200
-            ai_details = f"HTTP {test_response.status_code}"
-            if test_response.status_code == 200:
-                ai_result = test_response.json()
-                ai_details += f" - Response: {ai_result.get('response', 'No response')[:50]}..."
-        except Exception as e:
-            ai_status = False
-            ai_details = f"Error: {str(e)}"
+        logger.debug("Testing AI model connection...")
+        health = check_model_health(force=True)
+        ai_status = health['status'] == 'connected'
+        ai_details = describe_model_health(health)
         
         result = {
             'google_sheets': sheets_status,
@@ -597,17 +4963,17 @@ def test_connection():
             'message': f"Google Sheets: {'✅ ' + sheets_details if sheets_status else '❌ ' + sheets_details}, AI Model: {'✅ ' + ai_details if ai_status else '❌ ' + ai_details}",
             'debug_info': {
                 'sheet_id': app_settings['google_sheet_id'],
-                'sheet_url': f"https://docs.google.com/spreadsheets/d/{app_settings['google_sheet_id']}/export?format=csv&gid=0",
-                'ai_model': CHAT_MODEL,
-                'ai_url': CHAT_API_URL
+                'sheet_url': build_sheet_csv_url(app_settings['google_sheet_id']),
+                'ai_model': model_pool.primary().model,
+                'ai_url': model_chat_url()
             }
         }
         
-        print(f"[DEBUG] Connection test completed: Sheets={sheets_status}, AI={ai_status}")
+        logger.info("Connection test completed: Sheets=%s, AI=%s", sheets_status, ai_status)
         return jsonify(result)
         
     except Exception as e:
-        print(f"[DEBUG] Connection test error: {e}")
+        logger.error("Connection test error: %s", e)
         return jsonify({'error': f'เกิดข้อผิดพลาดในการทดสอบ: {str(e)}'}), 500
 
 # New endpoint for detailed Google Sheets testing
@@ -617,12 +4983,12 @@ def test_sheet():
         return jsonify({'error': 'กรุณาเข้าสู่ระบบก่อน'}), 401
     
     sheet_id = app_settings['google_sheet_id']
-    csv_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid=0"
+    csv_url = build_sheet_csv_url(sheet_id)
     
-    print(f"[DEBUG] Testing Google Sheet access: {sheet_id}")
+    logger.debug("Testing Google Sheet access: %s", sheet_id)
     
     try:
-        response = requests.get(csv_url, timeout=10)
+        response = sheets_client.get(csv_url)
         
         result = {
             'sheet_id': sheet_id,
@@ -645,11 +5011,11 @@ def test_sheet():
             except Exception as parse_error:
                 result['parse_error'] = str(parse_error)
         
-        print(f"[DEBUG] Sheet test result: {result['success']}")
+        logger.debug("Sheet test result: %s", result['success'])
         return jsonify(result)
         
     except Exception as e:
-        print(f"[DEBUG] Sheet test error: {e}")
+        logger.error("Sheet test error: %s", e)
         return jsonify({
             'sheet_id': sheet_id,
             'url': csv_url,
@@ -667,14 +5033,16 @@ def preview_data():
         data = request.json
         num_rows = data.get('rows', 5)
         
-        sheet_data = get_google_sheet_data(app_settings['google_sheet_id'])
+        # แหล่งข้อมูลแรก (ชีต, CSV หรือ SQLite) - อ่านเฉพาะแถวที่แสดง
+        preview = get_primary_preview(max(num_rows, 3))
         
-        if not sheet_data:
+        if not preview:
             return jsonify({
                 'success': False,
                 'error': 'ไม่สามารถเข้าถึง Google Sheet ได้'
             })
         
+        source, sheet_data, total_rows = preview
         preview_rows = []
         for i, row in enumerate(sheet_data[:num_rows]):
             preview_rows.append({
@@ -685,15 +5053,16 @@ def preview_data():
         
         return jsonify({
             'success': True,
-            'total_rows': len(sheet_data),
+            'total_rows': total_rows,
             'preview_rows': len(preview_rows),
             'data': preview_rows,
             'sheet_id': app_settings['google_sheet_id'],
+            'source': source,
             'raw_sample': sheet_data[:3] if sheet_data else []
         })
         
     except Exception as e:
-        print(f"[DEBUG] Preview data error: {e}")
+        logger.error("Preview data error: %s", e)
         return jsonify({
             'success': False,
             'error': f'เกิดข้อผิดพลาด: {str(e)}'
@@ -768,10 +5137,10 @@ def test_search():
         if not query:
             return jsonify({'error': 'กรุณาใส่คำค้นหา'})
         
-        print(f"[DEBUG] Test search for: '{query}'")
+        logger.debug("Test search for: %r", query)
         
-        # Get raw sheet data
-        sheet_data = get_google_sheet_data(app_settings['google_sheet_id'])
+        # Get raw sheet data (ดึงครั้งเดียว การค้นหาจะใช้ข้อมูลจาก cache ชุดเดียวกัน)
+        preview = get_primary_preview(3)
         
         # Perform search
         search_result = search_sheet_data(query)
@@ -779,14 +5148,14 @@ def test_search():
         return jsonify({
             'success': True,
             'query': query,
-            'sheet_rows': len(sheet_data) if sheet_data else 0,
+            'sheet_rows': preview[2] if preview else 0,
             'search_result': search_result,
-            'sheet_preview': sheet_data[:3] if sheet_data else [],
+            'sheet_preview': preview[1] if preview else [],
             'sheet_id': app_settings['google_sheet_id']
         })
         
     except Exception as e:
-        print(f"[DEBUG] Test search error: {e}")
+        logger.error("Test search error: %s", e)
         return jsonify({'error': f'เกิดข้อผิดพลาด: {str(e)}'})
 
 # New endpoint for viewing sheet data
@@ -796,11 +5165,12 @@ def view_sheet():
         return jsonify({'error': 'กรุณาเข้าสู่ระบบก่อน'}), 401
     
     try:
-        data = get_google_sheet_data(app_settings['google_sheet_id'])
+        preview = get_primary_preview(10)
         
-        if not data:
+        if not preview:
             return jsonify({'error': 'ไม่สามารถเข้าถึง Google Sheet ได้'})
         
+        source, data, total_rows = preview
         # Return first 10 rows for inspection
         preview_data = []
         for i, row in enumerate(data[:10]):
@@ -812,15 +5182,16 @@ def view_sheet():
         
         return jsonify({
             'success': True,
-            'total_rows': len(data),
+            'total_rows': total_rows,
             'preview_rows': len(preview_data),
             'data': preview_data,
             'headers': data[0] if data else [],
-            'sheet_id': app_settings['google_sheet_id']
+            'sheet_id': app_settings['google_sheet_id'],
+            'source': source
         })
         
     except Exception as e:
-        print(f"[DEBUG] View sheet error: {e}")
+        logger.error("View sheet error: %s", e)
         return jsonify({'error': f'เกิดข้อผิดพลาด: {str(e)}'})
 
 @app.route('/dashboard')
@@ -854,14 +5225,16 @@ def dashboard_stats():
         return jsonify({'error': 'กรุณาเข้าสู่ระบบก่อน'}), 401
     
     try:
-        # สถิติพื้นฐาน
+        # สถิติพื้นฐาน (จำนวนแชทนับทั้ง process ไม่ใช่ต่อ session)
+        chats = get_chat_counts()
         stats = {
             'system_status': 'online',
-            'ai_model': CHAT_MODEL,
+            'ai_model': model_pool.primary().model,
             'google_sheet_id': app_settings['google_sheet_id'][:15] + '...',
             'last_update': datetime.now().isoformat(),
-            'total_queries': session.get('query_count', 0),
-            'system_uptime': '24h 30m'  # สามารถคำนวณจริงได้
+            'total_queries': chats['total'],
+            'today_queries': chats['today'],
+            'system_uptime': format_uptime(get_uptime_seconds())
         }
         
         # ทดสอบการเชื่อมต่อ
@@ -869,20 +5242,68 @@ def dashboard_stats():
         stats['google_sheets_status'] = 'connected' if data else 'error'
         stats['data_rows'] = len(data) - 1 if data else 0
         
-        # ทดสอบ AI Model
-        try:
-            test_response = requests.post(CHAT_API_URL, 
-                                        json={"model": CHAT_MODEL, "prompt": "test", "stream": False}, 
-                                        timeout=5)
-            stats['ai_model_status'] = 'connected' if test_response.status_code == 200 else 'error'
-        except:
-            stats['ai_model_status'] = 'error'
+        # สถานะ AI Model จาก health check (cache สั้นๆ ไม่เรียกให้โมเดลตอบ)
+        health = check_model_health()
+        stats['ai_model_status'] = 'connected' if health['status'] == 'connected' else 'error'
+        stats['ai_model_latency_ms'] = health.get('latency_ms')
         
         return jsonify(stats)
         
     except Exception as e:
         return jsonify({'error': f'เกิดข้อผิดพลาด: {str(e)}'}), 500
 
+@app.route('/api/stats', methods=['GET'])
+def system_stats():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'กรุณาเข้าสู่ระบบก่อน'}), 401
+    
+    return jsonify({
+        'sheet_cache': get_sheet_cache_stats(),
+        'data_sources': get_data_source_status(),
+        'search_index': {
+            f"{key[0]}/{key[1]}": index.stats() for key, index in list(_search_indexes.items())
+        },
+        'search': dict(search_stats),
+        'semantic': get_embedding_stats(),
+        'streaming': get_streaming_stats(),
+        'model': get_model_stats(),
+        'scheduler': model_scheduler.stats(),
+        'model_pool': model_pool.stats(),
+        'response_cache': response_cache.stats(),
+        'health': get_health_stats(),
+        'auth': get_login_stats(),
+        'logging': get_logging_stats(),
+        'single_flight': {
+            'sheets': sheet_flight.stats(),
+            'model': model_flight.stats(),
+            'index': index_flight.stats(),
+            'backends': backend_flight.stats()
+        },
+        'http': {
+            'model': model_client.stats(),
+            'sheets': sheets_client.stats()
+        },
+        'timestamp': datetime.now().isoformat()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint (text format); needs the METRICS_TOKEN bearer token, or a login when no token is set"""
+    if METRICS_TOKEN:
+        authorized = hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+    else:
+        authorized = bool(session.get('logged_in'))
+    if not authorized:
+        return Response('unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_summary():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'กรุณาเข้าสู่ระบบก่อน'}), 401
+    
+    return jsonify(get_metrics_summary())
+
 # API Routes สำหรับ AI Configuration
 @app.route('/api/ai-config', methods=['GET', 'POST'])
 def ai_configuration():
@@ -892,35 +5313,52 @@ def ai_configuration():
     if request.method == 'POST':
         try:
             data = request.json
+            if not isinstance(data, dict):
+                raise ValueError('รูปแบบข้อมูลไม่ถูกต้อง')
             
-            # อัพเดตการตั้งค่า AI
+            # ตรวจทุกค่าก่อน แล้วจึงบันทึกพร้อมกัน (ค่าผิดค่าเดียวไม่ทำให้บันทึกไปครึ่งเดียว)
+            updates = {'model_params': normalize_model_params(data, app_settings['model_params'])}
             if 'system_prompt' in data:
-                app_settings['system_prompt'] = data['system_prompt']
-            
-            # พารามิเตอร์โมเดล (อาจเพิ่มในอนาคต)
-            model_params = {
-                'temperature': data.get('temperature', 0.3),
-                'max_tokens': data.get('max_tokens', 500),
-                'top_p': data.get('top_p', 0.8)
-            }
+                if not isinstance(data['system_prompt'], str):
+                    raise ValueError('system_prompt ต้องเป็นข้อความ')
+                updates['system_prompt'] = data['system_prompt']
+            if 'keep_alive' in data:
+                updates['model_keep_alive'] = str(data['keep_alive']).strip() or '30m'
+            if 'routing' in data:
+                if data['routing'] not in MODEL_ROUTING_POLICIES:
+                    raise ValueError(f"ไม่รองรับการกระจายงานแบบ {data['routing']}")
+                updates['model_routing'] = data['routing']
+            if 'small_model_routing' in data:
+                updates['small_model_routing'] = bool(data['small_model_routing'])
+            backends = normalize_model_backends(data['backends']) if 'backends' in data else None
             
-            # เก็บการตั้งค่าพารามิเตอร์
-            app_settings['model_params'] = model_params
+            prompt_changed = updates.get('system_prompt', app_settings['system_prompt']) != app_settings['system_prompt']
+            app_settings.update(updates)
+            if backends is not None:
+                set_model_backends(backends)
+            if prompt_changed:
+                response_cache.clear('system prompt changed')
+            if prompt_changed or backends is not None:
+                warm_model_async()  # prefix หรือ host/โมเดลใหม่ - โหลดไว้ก่อนคำถามแรก
             
             return jsonify({'success': True, 'message': 'บันทึกการตั้งค่า AI สำเร็จ'})
             
+        except (ValueError, TypeError) as e:
+            logger.warning("AI config rejected: %s", e)
+            return jsonify({'success': False, 'message': f'ค่าการตั้งค่าไม่ถูกต้อง: {e}'}), 400
         except Exception as e:
             return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาด: {str(e)}'})
     
     # GET request - ส่งการตั้งค่าปัจจุบัน
     return jsonify({
         'system_prompt': app_settings.get('system_prompt', ''),
-        'model_params': app_settings.get('model_params', {
-            'temperature': 0.3,
-            'max_tokens': 500,
-            'top_p': 0.8
-        }),
-        'current_model': CHAT_MODEL
+        'model_params': app_settings['model_params'],
+        'current_model': model_pool.primary().model,
+        'keep_alive': get_keep_alive(),
+        'routing': app_settings['model_routing'],
+        'small_model_routing': app_settings['small_model_routing'],
+        'backends': app_settings['model_backends'],
+        'backends_status': model_pool.stats()['backends']
     })
 @app.route('/api/data-sources', methods=['GET', 'POST'])
 def data_sources_api():
@@ -935,7 +5373,7 @@ def data_sources_api():
             if action == 'update_sheet_id':
                 new_sheet_id = data.get('sheet_id', '')
                 if new_sheet_id:
-                    app_settings['google_sheet_id'] = new_sheet_id
+                    replace_sheet_id(app_settings['google_sheet_id'], new_sheet_id)
                     return jsonify({'success': True, 'message': 'อัพเดต Google Sheet ID สำเร็จ'})
                 else:
                     return jsonify({'success': False, 'message': 'กรุณาใส่ Sheet ID'})
@@ -953,6 +5391,50 @@ def data_sources_api():
                 else:
                     return jsonify({'success': False, 'message': 'ไม่สามารถเชื่อมต่อได้'})
             
+            elif action == 'set_sources':
+                try:
+                    sources = set_data_sources(data.get('sources', []))
+                except ValueError as e:
+                    return jsonify({'success': False, 'message': str(e)})
+                return jsonify({'success': True, 'message': f'บันทึกแหล่งข้อมูล {len(sources)} รายการ', 'sources': sources})
+            
+            elif action == 'add_source':
+                try:
+                    sources = set_data_sources(get_data_sources() + [data])
+                except ValueError as e:
+                    return jsonify({'success': False, 'message': str(e)})
+                return jsonify({'success': True, 'message': 'เพิ่มแหล่งข้อมูลสำเร็จ', 'sources': sources})
+            
+            elif action == 'remove_source':
+                removed = source_identity(data)
+                remaining = [source for source in get_data_sources() if source_identity(source) != removed]
+                try:
+                    sources = set_data_sources(remaining)
+                except ValueError as e:
+                    return jsonify({'success': False, 'message': str(e)})
+                return jsonify({'success': True, 'message': 'ลบแหล่งข้อมูลสำเร็จ', 'sources': sources})
+            
+            elif action == 'test_sources':
+                # ดาวน์โหลดทุกแหล่งพร้อมกัน แล้วรายงานเวลาแยกตามแหล่ง
+                started = time.perf_counter()
+                results = [
+                    {**source, 'success': bool(snapshot), 'rows': len(snapshot) if snapshot else 0, 'wait_ms': wait_ms}
+                    for source, snapshot, wait_ms in fetch_data_sources()
+                ]
+                # CSV ขนาดใหญ่ / SQLite ไม่ได้โหลดเข้าหน่วยความจำ - ตรวจว่าเปิดอ่านได้
+                for backend in get_disk_sources():
+                    source_started = time.perf_counter()
+                    try:
+                        results.append({**backend.source, 'success': True, 'rows': len(backend),
+                                        'wait_ms': round((time.perf_counter() - source_started) * 1000, 1)})
+                    except (OSError, sqlite3.Error) as e:
+                        results.append({**backend.source, 'success': False, 'rows': 0, 'error': str(e)})
+                return jsonify({
+                    'success': all(result['success'] for result in results),
+                    'total_ms': round((time.perf_counter() - started) * 1000, 1),
+                    'sources': results
+                })
+            
             elif action == 'analyze_data':
                 analysis = analyze_sheet_structure(get_google_sheet_data(app_settings['google_sheet_id']))
                 if analysis:
@@ -966,7 +5448,8 @@ def data_sources_api():
     # GET request - ส่งข้อมูลปัจจุบัน
     return jsonify({
         'google_sheet_id': app_settings.get('google_sheet_id', ''),
-        'sheet_url': f"https://docs.google.com/spreadsheets/d/{app_settings.get('google_sheet_id', '')}"
+        'sheet_url': f"https://docs.google.com/spreadsheets/d/{app_settings.get('google_sheet_id', '')}",
+        'sources': get_data_source_status()
     })
 
 # API Routes สำหรับ Testing
@@ -998,24 +5481,26 @@ def testing_api():
             }
             
             # ทดสอบ AI Model
-            try:
-                ai_response = requests.post(CHAT_API_URL, 
-                                          json={"model": CHAT_MODEL, "prompt": "test connection", "stream": False}, 
-                                          timeout=10)
-                results['tests']['ai_model'] = {
-                    'status': 'pass' if ai_response.status_code == 200 else 'fail',
-                    'message': f'HTTP {ai_response.status_code}',
-                    'details': {
-                        'model': CHAT_MODEL,
-                        'url': CHAT_API_URL,
-                        'response_time': '< 1s'
-                    }
+            health = check_model_health(force=True)
+            results['tests']['ai_model'] = {
+                'status': 'pass' if health['status'] == 'connected' else 'fail',
+                'message': describe_model_health(health),
+                'details': {
+                    'model': health['model'],
+                    'url': model_chat_url(),
+                    'model_available': health['model_available'],
+                    'version': health.get('version'),
+                    'response_time': f"{health['latency_ms']} ms"
                 }
-            except Exception as e:
-                results['tests']['ai_model'] = {
-                    'status': 'fail',
-                    'message': str(e),
-                    'details': {'error': str(e)}
+            }
+            
+            # ทุก backend ใน pool (host สำรอง / โมเดลเล็ก)
+            if len(model_pool.backends) > 1:
+                backends = check_pool_health(force=True)
+                results['tests']['ai_backends'] = {
+                    'status': 'pass' if all(item['status'] == 'connected' for item in backends) else 'fail',
+                    'message': ', '.join(f"{item['model']}@{item['base_url']}: {describe_model_health(item)}" for item in backends),
+                    'details': {'backends': backends}
                 }
             
             return jsonify(results)
@@ -1026,7 +5511,10 @@ def testing_api():
             
             # ใช้ฟังก์ชันค้นหาที่ปรับปรุงแล้ว
             context = search_sheet_data(test_query)
-            ai_response = call_ai_model(test_query, context)
+            try:
+                ai_response = call_ai_model(test_query, context, priority='test')
+            except ModelBusyError as e:
+                return model_busy_response(e, {'success': False, 'message': MODEL_BUSY_MESSAGE})
             
             return jsonify({
                 'success': True,
@@ -1038,43 +5526,11 @@ def testing_api():
             
     except Exception as e:
         return jsonify({'success': False, 'message': f'เกิดข้อผิดพลาด: {str(e)}'})
-# เพิ่มฟังก์ชันสำหรับอัพเดต call_ai_model ให้รองรับพารามิเตอร์
-def call_ai_model_enhanced(prompt, context=""):
-    """Enhanced AI model call with configurable parameters"""
-    try:
-        model_params = app_settings.get('model_params', {
-            'temperature': 0.3,
-            'max_tokens': 500,
-            'top_p': 0.8
-        })
-        
-        full_prompt = f"{app_settings['system_prompt']}\n\nContext from Google Sheets:\n{context}\n\nUser question: {prompt}"
-        
-        payload = {
-            "model": CHAT_MODEL,
-            "prompt": full_prompt,
-            "stream": False,
-            "temperature": model_params.get('temperature', 0.3),
-            "top_p": model_params.get('top_p', 0.8),
-            "max_tokens": model_params.get('max_tokens', 500)
-        }
-        
-        response = requests.post(CHAT_API_URL, json=payload, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            ai_response = result.get('response', 'ไม่สามารถสร้างคำตอบได้')
-            return filter_ai_response(ai_response)
-        else:
-            return "ขออภัย เกิดข้อผิดพลาดในการเชื่อมต่อ AI"
-            
-    except Exception as e:
-        print(f"[DEBUG] Enhanced AI Model error: {e}")
-        return "เกิดข้อผิดพลาดในการประมวลผล โปรดลองใหม่อีกครั้ง"
 
 if __name__ == '__main__':
-    print("[DEBUG] Starting Flask application...")
-    print(f"[DEBUG] Default Google Sheet ID: {DEFAULT_SHEET_ID}")
-    print(f"[DEBUG] AI Model: {CHAT_MODEL}")
-    print(f"[DEBUG] AI API URL: {CHAT_API_URL}")
+    logger.info("Starting Flask application...")
+    logger.info("Default Google Sheet ID: %s", DEFAULT_SHEET_ID)
+    for backend in model_pool.backends:
+        logger.info("AI backend (%s): %s", backend.role, backend.name)
+    warm_model_async()
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False)
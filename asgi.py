@@ -0,0 +1,360 @@
+"""ASGI entry point - async chat pipeline in front of the Flask app.
+
+/api/chat and /api/chat/stream are served natively on the event loop: the
+sheet download and the model call use an async HTTP client, so concurrent
+chats multiplex on one loop instead of each pinning a worker thread for the
+whole generation. Every other route is passed through to the Flask app
+unchanged.
+
+Run with:  uvicorn asgi:application --host 0.0.0.0 --port 5000
+The sync server (gunicorn app:app / python app.py) keeps working as before.
+"""
+import asyncio
+import contextvars
+import json
+import os
+import time
+from http.cookies import SimpleCookie
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+import app as core
+
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', 100))
+
+flask_app = core.app
+wsgi_application = WsgiToAsgi(flask_app)
+
+_http_client = None
+
+
+def _get_http_client():
+    # สร้างครั้งแรกภายใน event loop ที่ใช้งานจริง
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(core.MODEL_HTTP_TIMEOUT, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=core.MODEL_HTTP_POOL_SIZE
+            )
+        )
+    return _http_client
+
+
+def _load_session(scope):
+    """Decode the Flask session cookie sent with this request"""
+    headers = dict(scope.get('headers') or [])
+    cookie_header = headers.get(b'cookie', b'').decode('latin-1')
+    cookie = SimpleCookie()
+    cookie.load(cookie_header)
+    morsel = cookie.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return {}
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+    try:
+        return serializer.loads(morsel.value, max_age=max_age) or {}
+    except Exception:
+        return {}
+
+
+async def _read_json(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return json.loads(body or b'{}')
+
+
+async def _read_message(receive, send):
+    """``message`` of the JSON body, or None after answering 400 for a malformed body"""
+    try:
+        data = await _read_json(receive)
+        return str(data.get('message') or '')
+    except (ValueError, AttributeError):
+        await _send_json(send, {'error': 'รูปแบบข้อมูลไม่ถูกต้อง'}, 400)
+        return None
+
+
+async def _send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *headers
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _fetch_sheet(sheet_id, gid):
+    started = time.perf_counter()
+    try:
+        with core.span('sheet_download'):
+            response = await _get_http_client().get(
+                core.build_sheet_csv_url(sheet_id, gid),
+                headers=core.SHEET_REQUEST_HEADERS,
+                timeout=core.SHEETS_HTTP_TIMEOUT
+            )
+    except httpx.HTTPError as e:
+        core.metrics.inc('upstream_responses_total', upstream='sheets', status='error')
+        core.logger.warning("Async sheet fetch error: %s", e)
+        return
+    core.metrics.inc('upstream_responses_total', upstream='sheets', status=response.status_code)
+    if response.status_code == 200:
+        response.encoding = 'utf-8'
+        # แปลง CSV ใน thread pool เพื่อไม่ให้ event loop ค้าง
+        await asyncio.to_thread(
+            core.cache_sheet_csv, sheet_id, gid, response.text,
+            response.headers.get('ETag'), response.headers.get('Last-Modified'),
+            round((time.perf_counter() - started) * 1000, 1)
+        )
+
+
+async def _warm_sheet_cache(sheet_id, gid=0):
+    """Download the sheet asynchronously on a cold cache, so the search never blocks on the network"""
+    if core.is_sheet_cached(sheet_id, gid):
+        return
+    await core.sheet_flight.do_async(('async', sheet_id, str(gid)), _fetch_sheet, sheet_id, gid)
+
+
+async def _prepare_turn(message):
+    # ดาวน์โหลดทุกชีตที่ยังไม่อยู่ใน cache พร้อมกัน (ไฟล์ในเครื่องอ่านใน thread ของการค้นหา)
+    await asyncio.gather(*(
+        _warm_sheet_cache(source['sheet_id'], source['gid'])
+        for source in core.get_data_sources() if source.get('type', 'sheets') == 'sheets'
+    ))
+    # การค้นหาเป็นงาน CPU สั้นๆ บนข้อมูลใน cache
+    return await asyncio.to_thread(core.prepare_chat_turn, message)
+
+
+async def _post_backend(backend, payload):
+    try:
+        response = await _get_http_client().post(backend.chat_url(), json=dict(payload, model=backend.model))
+    except httpx.HTTPError:
+        core.metrics.inc('upstream_responses_total', upstream='model', status='error')
+        raise
+    core.metrics.inc('upstream_responses_total', upstream='model', status=response.status_code)
+    return response
+
+
+async def _post_model_chat(payload, role='chat'):
+    response = error = None
+    # slot เดียวกับ thread ของ Flask - นับรวมใน max in-flight ของ process
+    async with core.model_scheduler.slot_async('chat'):
+        with core.span('model'):
+            for backend in core.model_pool.failover(role):
+                started = time.perf_counter()
+                try:
+                    response = await _post_backend(backend, payload)
+                except httpx.HTTPError as e:
+                    response, error = None, e
+                    core.model_pool.release(backend, started, e)
+                    continue
+                if core.model_backend_failed(response.status_code):
+                    core.model_pool.release(backend, started, f"HTTP {response.status_code}")
+                    continue
+                core.model_pool.release(backend, started)
+                break
+    if response is None:
+        raise error
+    if response.status_code == 200:
+        result = response.json()
+        core.record_model_timings(result)
+        return response.status_code, result
+    return response.status_code, response.text
+
+
+async def _call_model(message, context, role='chat'):
+    payload = core.build_model_payload(message, context)
+    try:
+        # prompt + context เดียวกันที่กำลังรอผลอยู่ ใช้ผลลัพธ์ร่วมกัน
+        status_code, result = await core.model_flight.do_async(
+            (role, core.model_flight_key(payload)), _post_model_chat, payload, role
+        )
+    except httpx.HTTPError as e:
+        core.logger.warning("Async AI model error: %s", e)
+        return core.AI_PROCESSING_ERROR
+
+    if status_code != 200:
+        core.logger.warning("Async AI error: HTTP %s", status_code)
+        return core.AI_CONNECTION_ERROR
+    return core.model_response_text(result) or 'ไม่สามารถสร้างคำตอบได้'
+
+
+async def chat(scope, receive, send):
+    if not _load_session(scope).get('logged_in'):
+        await _send_json(send, {'error': 'กรุณาเข้าสู่ระบบก่อน'}, 401)
+        return
+
+    message = await _read_message(receive, send)
+    if message is None:
+        return
+    try:
+        if not message:
+            await _send_json(send, {'error': 'กรุณาใส่ข้อความ'})
+            return
+
+        with core.span('total'):
+            turn = await _prepare_turn(message)
+            ai_response = turn['cached_response']
+            if ai_response is None:
+                ai_response = await _call_model(message, turn['context'], turn['role'])
+
+        await _send_json(send, core.chat_result(turn, ai_response))
+    except core.ModelBusyError as e:
+        await _send_json(send, {'error': core.MODEL_BUSY_MESSAGE, 'busy': True, 'reason': e.reason,
+                                'retry_after': e.retry_after},
+                         503, [(b'retry-after', str(e.retry_after).encode())])
+    except Exception as e:
+        core.logger.exception("Async chat error: %s", e)
+        await _send_json(send, {'error': 'เกิดข้อผิดพลาดในการประมวลผล'}, 500)
+
+
+async def _open_model_stream(payload, role):
+    """Async twin of core.open_model_stream: fail over only before the first chunk"""
+    client = _get_http_client()
+    response = error = None
+    for backend in core.model_pool.failover(role):
+        started = time.perf_counter()
+        request = client.build_request('POST', backend.chat_url(), json=dict(payload, model=backend.model),
+                                       timeout=httpx.Timeout(60.0, connect=5.0))
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            response, error = None, e
+            core.metrics.inc('upstream_responses_total', upstream='model', status='error')
+            core.model_pool.release(backend, started, e)
+            continue
+        core.metrics.inc('upstream_responses_total', upstream='model', status=response.status_code)
+        if not core.model_backend_failed(response.status_code):
+            return backend, started, response
+        await response.aclose()
+        core.model_pool.release(backend, started, f"HTTP {response.status_code}")
+    if response is None:
+        raise error
+    return None, None, response
+
+
+async def _stream_model_events(message, context, role='chat'):
+    state = core.ModelStream()
+    payload = core.build_model_payload(message, context, stream=True)
+    try:
+        async with core.model_scheduler.slot_async('chat'):
+            state.admit()
+            backend, started, response = await _open_model_stream(payload, role)
+            error = None
+            try:
+                if response.status_code != 200:
+                    yield state.error_event(core.AI_CONNECTION_ERROR)
+                    return
+                async for line in response.aiter_lines():
+                    event = state.on_line(line)
+                    if event:
+                        yield event
+                    if state.finished:
+                        break
+                if not state.finished:
+                    # ขาดกลางทาง - ไม่ส่ง done เพื่อไม่ให้คำตอบที่ไม่ครบถูก cache
+                    raise ValueError('model stream ended before the final chunk')
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                await response.aclose()
+                if backend is not None:
+                    core.model_pool.release(backend, started, error)
+    except core.ModelBusyError as e:
+        yield state.busy_event(e)
+        return
+    except httpx.HTTPError as e:
+        core.metrics.inc('upstream_responses_total', upstream='model', status='error')
+        core.logger.warning("Async AI stream error: %s", e)
+        yield state.error_event(core.AI_PROCESSING_ERROR)
+        return
+    except Exception as e:
+        # response 200 เริ่มส่งไปแล้ว - ต้องจบด้วย error event เสมอ
+        core.logger.warning("Async AI stream error: %s", e)
+        yield state.error_event(core.AI_PROCESSING_ERROR)
+        return
+
+    yield state.done_event()
+
+
+async def chat_stream(scope, receive, send):
+    if not _load_session(scope).get('logged_in'):
+        await _send_json(send, {'error': 'กรุณาเข้าสู่ระบบก่อน'}, 401)
+        return
+
+    message = await _read_message(receive, send)
+    if message is None:
+        return
+    if not message:
+        await _send_json(send, {'error': 'กรุณาใส่ข้อความ'})
+        return
+
+    try:
+        turn = await _prepare_turn(message)
+    except Exception as e:
+        core.logger.exception("Async chat stream error: %s", e)
+        await _send_json(send, {'error': 'เกิดข้อผิดพลาดในการประมวลผล'}, 500)
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'application/x-ndjson'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')
+        ]
+    })
+
+    async def send_line(line):
+        await send({'type': 'http.response.body', 'body': line.encode('utf-8'), 'more_body': True})
+
+    await send_line(core.stream_meta_line(turn))
+    if turn['cached_response'] is not None:
+        for event in core.cached_stream_events(turn):
+            await send_line(core.stream_event_line(turn, event))
+    else:
+        async for event in _stream_model_events(message, turn['context'], turn['role']):
+            await send_line(core.stream_event_line(turn, event))
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+ASYNC_ROUTES = {
+    '/api/chat': chat,
+    '/api/chat/stream': chat_stream,
+}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # โหลดโมเดลและ system prompt ไว้ก่อนแชทแรก
+                core.warm_model_async()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _http_client is not None:
+                    await _http_client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    handler = ASYNC_ROUTES.get(scope.get('path')) if scope['type'] == 'http' and scope.get('method') == 'POST' else None
+    if handler is not None:
+        await handler(scope, receive, send)
+    else:
+        # asgiref เก็บ executor ของ thread ไว้ใน context - คำขอพร้อมกันที่ใช้ context เดียวกัน
+        # ได้ executor ของกันและกันแล้วล้มด้วย "CurrentThreadExecutor already quit"; แยก context ต่อคำขอ
+        await contextvars.Context().run(asyncio.create_task, wsgi_application(scope, receive, send))
@@ -0,0 +1,129 @@
+"""Compare /api/chat concurrency of the sync (gunicorn) and async (uvicorn + asgi.py) servers.
+
+Starts the fake upstreams, then for each server mode fires N concurrent chat
+requests while polling a cheap admin endpoint, and reports wall time,
+throughput, chat latency and how long the admin endpoint stalled.
+
+    python bench/chat_concurrency.py --concurrency 32 --model-latency 2
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_upstreams import start_fake_upstreams
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_COMMANDS = {
+    'sync': lambda port, workers: ['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', '--timeout', '120', 'app:app'],
+    'async': lambda port, workers: ['uvicorn', 'asgi:application', '--workers', str(workers), '--port', str(port), '--log-level', 'warning'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def login(base_url):
+    client = requests.Session()
+    client.post(f"{base_url}/api/login", json={'username': 'admin', 'password': 'password'}, timeout=10)
+    return client
+
+
+def run_mode(mode, args, upstream_port):
+    port = free_port()
+    env = dict(os.environ,
+               CHAT_API_URL=f"http://127.0.0.1:{upstream_port}/api/generate",
+               GOOGLE_SHEETS_BASE_URL=f"http://127.0.0.1:{upstream_port}/sheets")
+    server = subprocess.Popen(SERVER_COMMANDS[mode](port, args.workers), cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        base_url = f"http://127.0.0.1:{port}"
+        cookies = login(base_url).cookies
+        # อุ่น cache ของชีตก่อนวัดผล
+        requests.post(f"{base_url}/api/test-search", json={'query': 'SD00001'}, cookies=cookies, timeout=30)
+
+        stop = threading.Event()
+        probe_latencies = []
+
+        def probe():
+            while not stop.is_set():
+                started = time.perf_counter()
+                try:
+                    requests.get(f"{base_url}/api/stats", cookies=cookies, timeout=60)
+                except requests.RequestException:
+                    pass
+                probe_latencies.append(time.perf_counter() - started)
+                time.sleep(0.1)
+
+        def one_chat(i):
+            started = time.perf_counter()
+            response = requests.post(f"{base_url}/api/chat", json={'message': f"SD{i:05d}"},
+                                     cookies=cookies, timeout=120)
+            return time.perf_counter() - started, response.status_code
+
+        probe_thread = threading.Thread(target=probe, daemon=True)
+        probe_thread.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(one_chat, range(1, args.concurrency + 1)))
+        wall = time.perf_counter() - started
+        stop.set()
+        probe_thread.join()
+
+        latencies = sorted(latency for latency, _ in results)
+        return {
+            'mode': mode,
+            'ok': sum(1 for _, status in results if status == 200),
+            'wall_s': wall,
+            'rps': len(results) / wall,
+            'p50_s': statistics.median(latencies),
+            'max_s': latencies[-1],
+            'admin_max_s': max(probe_latencies) if probe_latencies else 0.0,
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--model-latency', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--modes', default='sync,async')
+    args = parser.parse_args()
+
+    upstream = start_fake_upstreams(model_latency=args.model_latency)
+    print(f"{'mode':<6} {'ok':>4} {'wall s':>8} {'req/s':>8} {'p50 s':>8} {'max s':>8} {'admin max s':>12}")
+    for mode in args.modes.split(','):
+        r = run_mode(mode, args, upstream.server_port)
+        print(f"{r['mode']:<6} {r['ok']:>4} {r['wall_s']:>8.2f} {r['rps']:>8.2f} {r['p50_s']:>8.2f} "
+              f"{r['max_s']:>8.2f} {r['admin_max_s']:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Local stand-ins for the Ollama server and the Google Sheets CSV export.
+
+Point the app at them with:
+    CHAT_API_URL=http://127.0.0.1:<port>/api/generate
+    GOOGLE_SHEETS_BASE_URL=http://127.0.0.1:<port>/sheets
+
+/api/generate and /api/chat answer after ``model_latency`` plus one
+``token_interval`` per answer token, streamed (NDJSON, one token per line)
+or as one JSON body. The sheet export is a Thai customer table of
+``sheet_rows`` rows; with ``escaped_every`` = n every n-th row carries its
+Thai cells as \\uXXXX escapes, as some exports do.
+
+/api/chat simulates model residency: the first request, and any request
+after the previous one's keep_alive has run out, waits ``load_latency`` and
+reports it as ``load_duration``; a system message identical to the last one
+is not counted in ``prompt_eval_count`` (prefix reuse).
+
+Run standalone:  python bench/fake_upstreams.py --port 18080 --model-latency 2
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+ANSWER_WORDS = ['ลูกค้า', 'รายนี้', 'อยู่ที่', 'จังหวัด', 'เชียงใหม่', 'มียอดขาย', 'รวม', '1,250', 'บาท', 'ครับ']
+
+
+def escape_text(text):
+    return ''.join(f'\\u{ord(ch):04x}' if ord(ch) > 127 else ch for ch in text)
+
+
+def build_sheet_csv(rows, escaped_every=0):
+    """Customer sheet; every ``escaped_every``-th row has its Thai cells as \\uXXXX escapes (0 = none)"""
+    lines = ['ชื่อ,รหัส,จังหวัด,ยอดขาย']
+    provinces = ['กรุงเทพมหานคร', 'เชียงใหม่', 'ขอนแก่น', 'ภูเก็ต', 'สงขลา']
+    for i in range(1, rows):
+        name, province = f"ลูกค้า{i}", provinces[i % len(provinces)]
+        if escaped_every and i % escaped_every == 0:
+            name, province = escape_text(name), escape_text(province)
+        lines.append(f"{name},SD{i:05d},{province},{i * 37 % 10000}")
+    return '\n'.join(lines) + '\n'
+
+
+def build_answer(tokens):
+    return ' '.join(ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(tokens))
+
+
+def keep_alive_seconds(value):
+    """Ollama keep_alive (seconds or a duration such as '30m') in seconds; negative keeps forever"""
+    if value is None:
+        return 300
+    if isinstance(value, (int, float)) or str(value).lstrip('-').isdigit():
+        return float(value)
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * units[unit] for number, unit in re.findall(r'(-?[\d.]+)(ms|s|m|h)', str(value)))
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith('/sheets/') and path.endswith('/export'):
+            self._send_body(self.config['sheet_csv'], 'text/csv; charset=utf-8')
+        elif path == '/api/tags':
+            self._send_body(json.dumps({'models': [{'name': self.config['model']}]}).encode(), 'application/json')
+        elif path == '/api/version':
+            self._send_body(b'{"version": "fake"}', 'application/json')
+        else:
+            self._send_body(b'not found', 'text/plain', 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        path = urlparse(self.path).path
+        if path not in ('/api/generate', '/api/chat'):
+            self._send_body(b'not found', 'text/plain', 404)
+            return
+
+        answer = self.config['answer']
+        timings = self._simulate_model(request)
+        time.sleep(self.config['model_latency'])
+        if not request.get('stream'):
+            # ไม่ stream ก็ยังต้องรอสร้างทุก token
+            time.sleep(self.config['token_interval'] * self.config['answer_tokens'])
+            body = json.dumps({'model': request.get('model'), **self._answer(path, answer), 'done': True, **timings}, ensure_ascii=False)
+            self._send_body(body.encode('utf-8'), 'application/json')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for word in answer.split(' '):
+            line = json.dumps({**self._answer(path, word + ' '), 'done': False}, ensure_ascii=False) + '\n'
+            self._write_chunk(line.encode('utf-8'))
+            time.sleep(self.config['token_interval'])
+        self._write_chunk((json.dumps({**self._answer(path, ''), 'done': True, **timings}) + '\n').encode())
+        self.wfile.write(b'0\r\n\r\n')
+
+    @staticmethod
+    def _answer(path, text):
+        return {'message': {'role': 'assistant', 'content': text}} if path == '/api/chat' else {'response': text}
+
+    def _simulate_model(self, request):
+        """Load the model if it is not resident and return Ollama-style timing fields (ns)"""
+        state = self.config['state']
+        # /api/generate ส่ง prompt เดียว - นับเป็นข้อความ user ไม่มี system แยก
+        messages = request.get('messages') or [{'role': 'user', 'content': request.get('prompt', '')}]
+        system = messages[0]['content'] if messages and messages[0].get('role') == 'system' else None
+        with state['lock']:
+            now = time.monotonic()
+            cold = now >= state['resident_until']
+            if cold:
+                time.sleep(self.config['load_latency'])
+            keep_alive = keep_alive_seconds(request.get('keep_alive'))
+            state['resident_until'] = float('inf') if keep_alive < 0 else time.monotonic() + keep_alive
+            reused = not cold and system is not None and system == state['last_system']
+            state['last_system'] = system
+        prompt_tokens = sum(len(message.get('content', '')) // 2 for message in messages[1 if reused else 0:])
+        return {
+            'load_duration': int(self.config['load_latency'] * 1e9) if cold else 200000,
+            'total_duration': int(((self.config['load_latency'] if cold else 0) + self.config['model_latency']) * 1e9),
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': prompt_tokens * 1000000,
+            'eval_count': self.config['answer_tokens'],
+            'eval_duration': int(self.config['answer_tokens'] * self.config['token_interval'] * 1e9)
+        }
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+        self.wfile.flush()
+
+
+def start_fake_upstreams(port=0, model_latency=1.0, token_interval=0.02, sheet_rows=1000, model='Qwen3:14b', load_latency=0.0,
+                         answer_tokens=16, escaped_every=0):
+    """Start the fake servers in a background thread; returns the server (``server.server_port``)"""
+    handler = type('ConfiguredFakeUpstreamHandler', (FakeUpstreamHandler,), {'config': {
+        'model_latency': model_latency,
+        'token_interval': token_interval,
+        'answer_tokens': answer_tokens,
+        'answer': build_answer(answer_tokens),
+        'sheet_csv': build_sheet_csv(sheet_rows, escaped_every).encode('utf-8'),
+        'model': model,
+        'load_latency': load_latency,
+        'state': {'lock': threading.Lock(), 'resident_until': 0.0, 'last_system': None},
+    }})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--model-latency', type=float, default=1.0)
+    parser.add_argument('--token-interval', type=float, default=0.02, help='seconds per generated token')
+    parser.add_argument('--answer-tokens', type=int, default=16)
+    parser.add_argument('--sheet-rows', type=int, default=1000)
+    parser.add_argument('--escaped-every', type=int, default=0, help='write every n-th sheet row as \\uXXXX escapes')
+    parser.add_argument('--load-latency', type=float, default=0.0, help='seconds to "load" a non-resident model')
+    args = parser.parse_args()
+    server = start_fake_upstreams(args.port, args.model_latency, args.token_interval, args.sheet_rows,
+                                  load_latency=args.load_latency, answer_tokens=args.answer_tokens,
+                                  escaped_every=args.escaped_every)
+    print(f"Fake Ollama + Sheets listening on http://127.0.0.1:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,177 @@
+"""Micro-benchmark for filter_ai_response against the original implementation.
+
+Checks that the compiled filter returns exactly the same output as the legacy
+version on the Qwen3 output corpus (bench/corpus/qwen3_outputs.jsonl), on long
+generations built from it and on randomly generated inputs, then times both.
+Exits non-zero on any output mismatch or when the compiled filter is not
+faster than the legacy one by --max-ratio.
+
+    python bench/filter_response.py --repeat 200 --max-ratio 0.8
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from app import filter_ai_response
+
+CORPUS_PATH = os.path.join(ROOT, 'bench', 'corpus', 'qwen3_outputs.jsonl')
+
+
+def legacy_filter_ai_response(response):
+    """filter_ai_response as it was before compiling the patterns (reference output)"""
+    if not response:
+        return response
+
+    thinking_patterns = [
+        r'<think>.*?</think>',
+        r'<thinking>.*?</thinking>',
+        r'<analysis>.*?</analysis>',
+        r'<reasoning>.*?</reasoning>',
+        r'<internal>.*?</internal>',
+        r'<thought>.*?</thought>',
+        r'\*thinking\*.*?\*thinking\*',
+        r'\[thinking\].*?\[/thinking\]',
+        r'\(thinking:.*?\)',
+        r'<พิจารณา>.*?</พิจารณา>',
+        r'<คิด>.*?</คิด>'
+    ]
+    for pattern in thinking_patterns:
+        response = re.sub(pattern, '', response, flags=re.DOTALL | re.IGNORECASE)
+
+    english_patterns = [
+        r'^Looking at.*?(?=\n|\.|$)',
+        r'^Based on.*?(?=\n|\.|$)',
+        r'^From the.*?(?=\n|\.|$)',
+        r'^In the.*?(?=\n|\.|$)',
+        r'^The user.*?(?=\n|\.|$)',
+        r'^I can see.*?(?=\n|\.|$)',
+        r'^According to.*?(?=\n|\.|$)',
+        r'^Analyzing.*?(?=\n|\.|$)'
+    ]
+    for pattern in english_patterns:
+        response = re.sub(pattern, '', response, flags=re.MULTILINE | re.IGNORECASE)
+
+    filtered_lines = []
+    for line in response.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        thai_chars = len(re.findall(r'[ก-๙]', line))
+        english_chars = len(re.findall(r'[a-zA-Z]', line))
+        if (thai_chars > 0 or
+            any(keyword in line for keyword in ['SD', ':', '-', '**', '•', '1.', '2.']) or
+            re.match(r'^\d+', line) or
+            len(line) < 50):
+            filtered_lines.append(line)
+
+    response = '\n'.join(filtered_lines)
+    response = re.sub(r'\n\s*\n\s*\n+', '\n\n', response)
+    response = re.sub(r'^\s+|\s+$', '', response)
+
+    if response:
+        first_line = response.split('\n')[0]
+        if (len(re.findall(r'[a-zA-Z]', first_line)) > len(re.findall(r'[ก-๙]', first_line)) and
+            len(first_line) > 30):
+            response = '\n'.join(response.split('\n')[1:])
+
+    if not response or response.isspace():
+        return "ขออภัย ไม่สามารถประมวลผลคำตอบได้ในขณะนี้ กรุณาลองใหม่อีกครั้ง"
+
+    return response.strip()
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['response'] for line in f if line.strip()]
+
+
+def long_generations(corpus, target_chars=20000):
+    """Concatenate corpus samples into long outputs, like a verbose generation"""
+    outputs = []
+    for offset in range(len(corpus)):
+        parts, size = [], 0
+        while size < target_chars:
+            sample = corpus[(offset + len(parts)) % len(corpus)]
+            parts.append(sample)
+            size += len(sample)
+        outputs.append('\n'.join(parts))
+    return outputs
+
+
+FUZZ_PIECES = [
+    '<think>', '</think>', '<THINKING>', '</thinking>', '<analysis>', '</Analysis>', '<reasoning>',
+    '</reasoning>', '<internal>', '</internal>', '<thought>', '</thought>', '*thinking*', '*THINKING*',
+    '[thinking]', '[/thinking]', '(thinking:', ')', '<พิจารณา>', '</พิจารณา>', '<คิด>', '</คิด>',
+    '<thi', 'nk>', '<', '>', 'Looking at', 'based on', 'From the', 'IN THE', 'The user', 'I can see',
+    'According to', 'Analyzing', '.', '\n', '\n\n', '  ', '\t', '\r', '\xa0', 'SD', ':', '-', '**', '•',
+    '1.', '2.', '42', '๓', 'สวัสดีค่ะ', 'ข้อมูล', 'พบ 3 รายการ', 'hello world', 'x' * 40, 'ı', 'İ', 'ſ', 'K',
+]
+
+
+def fuzz_inputs(count, seed):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(FUZZ_PIECES) for _ in range(rng.randint(0, 60))) for _ in range(count)]
+
+
+def check_equivalence(inputs):
+    mismatches = 0
+    for text in inputs:
+        expected = legacy_filter_ai_response(text)
+        actual = filter_ai_response(text)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"MISMATCH for input {text[:120]!r}\n  legacy:   {expected[:120]!r}\n  compiled: {actual[:120]!r}")
+    return mismatches
+
+
+def time_filter(fn, inputs, repeat):
+    """Median seconds for one pass over all inputs"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in inputs:
+            fn(text)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--fuzz', type=int, default=5000, help='number of random inputs for the equivalence check')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-ratio', type=float, default=0.8,
+                        help='fail when compiled time / legacy time exceeds this')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    long_outputs = long_generations(corpus)
+
+    mismatches = check_equivalence(corpus + long_outputs + fuzz_inputs(args.fuzz, args.seed))
+    print(f"equivalence: {mismatches} mismatches")
+
+    failed = mismatches > 0
+    for label, inputs, repeat in (('corpus', corpus, args.repeat), ('long', long_outputs, max(1, args.repeat // 10))):
+        legacy = time_filter(legacy_filter_ai_response, inputs, repeat)
+        compiled = time_filter(filter_ai_response, inputs, repeat)
+        ratio = compiled / legacy
+        per_call = lambda seconds: seconds / len(inputs) * 1e6
+        print(f"{label:>6}: legacy {per_call(legacy):9.1f} us/call  compiled {per_call(compiled):9.1f} us/call  "
+              f"ratio {ratio:.2f} (max {args.max_ratio})")
+        if ratio > args.max_ratio:
+            print(f"REGRESSION: {label} ratio {ratio:.2f} > {args.max_ratio}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
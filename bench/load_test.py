@@ -0,0 +1,298 @@
+"""Load test: login, chat and dashboard traffic against the app on fake upstreams.
+
+Starts bench/fake_upstreams.py in its own process, launches the app against
+it (gunicorn or uvicorn + asgi.py) and runs N virtual users. Each user logs
+in through /api/login, then loops over a weighted mix of /api/chat,
+/api/chat/stream and /api/dashboard-stats until the duration or request
+budget is spent. Reports ok/busy/errors, p50/p95/p99/max latency and req/s
+per endpoint, plus time to the first token for streams ("busy" = shed by
+the model scheduler), and the server's own per-stage percentiles from
+/api/metrics.
+
+    python bench/load_test.py --server sync --workers 2 --concurrency 16 --duration 30
+    python bench/load_test.py --server async --mix chat=6,stream=3,dashboard=1
+    python bench/load_test.py --url http://127.0.0.1:5000   # app already running
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from chat_concurrency import ROOT, SERVER_COMMANDS, free_port, wait_for_port
+
+QUESTION_TEMPLATES = ['ลูกค้า{n} อยู่จังหวัดอะไร', 'SD{n:05d}', 'ยอดขายของลูกค้า{n}', 'ขอดูข้อมูลลูกค้า{n}']
+ENDPOINTS = ('login', 'chat', 'stream', 'stream_first_token', 'dashboard')
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('chat', 'stream', 'dashboard'):
+            raise SystemExit(f"unknown endpoint in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class Recorder:
+    """Latencies and errors per endpoint, shared by all virtual users"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.busy = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, outcome='ok'):
+        """``outcome`` is 'ok', 'busy' (shed by the server) or anything else for an error"""
+        with self._lock:
+            if outcome == 'ok':
+                self.latencies[endpoint].append(seconds)
+            elif outcome == 'busy':
+                self.busy[endpoint] += 1
+            else:
+                self.errors[endpoint] += 1
+
+    def report(self, wall):
+        rows = []
+        for endpoint in ENDPOINTS:
+            latencies = sorted(self.latencies.get(endpoint, []))
+            errors = self.errors.get(endpoint, 0)
+            busy = self.busy.get(endpoint, 0)
+            if not latencies and not errors and not busy:
+                continue
+            rows.append({
+                'endpoint': endpoint,
+                'ok': len(latencies),
+                'busy': busy,
+                'errors': errors,
+                'p50_ms': _ms(percentile(latencies, 0.50)),
+                'p95_ms': _ms(percentile(latencies, 0.95)),
+                'p99_ms': _ms(percentile(latencies, 0.99)),
+                'max_ms': _ms(latencies[-1] if latencies else None),
+                # token แรกเป็นส่วนหนึ่งของคำขอ stream - ไม่นับเป็นคำขอแยก
+                'rps': None if endpoint == 'stream_first_token' else round((len(latencies) + busy + errors) / wall, 2)
+            })
+        return rows
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def login(base_url, recorder, username, password):
+    client = requests.Session()
+    started = time.perf_counter()
+    try:
+        response = client.post(f"{base_url}/api/login", json={'username': username, 'password': password}, timeout=30)
+        ok = response.status_code == 200 and response.json().get('success')
+    except requests.RequestException:
+        ok = False
+    recorder.add('login', time.perf_counter() - started, 'ok' if ok else 'error')
+    return client if ok else None
+
+
+def outcome(response):
+    if response.status_code == 503 and response.json().get('busy'):
+        return 'busy'
+    return 'ok' if response.status_code == 200 and 'error' not in response.json() else 'error'
+
+
+def chat(client, base_url, question):
+    return outcome(client.post(f"{base_url}/api/chat", json={'message': question}, timeout=300))
+
+
+def chat_stream(client, base_url, question, recorder, started):
+    """Read the NDJSON stream to the end; records the first token separately"""
+    with client.post(f"{base_url}/api/chat/stream", json={'message': question}, stream=True, timeout=300) as response:
+        if response.status_code != 200:
+            return 'error'
+        first_token = True
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event['type'] == 'token' and first_token:
+                recorder.add('stream_first_token', time.perf_counter() - started)
+                first_token = False
+            elif event['type'] == 'error':
+                return 'busy' if event.get('busy') else 'error'
+            elif event['type'] == 'done':
+                return 'ok'
+    return 'error'
+
+
+def virtual_user(user, args, base_url, recorder, deadline, budget):
+    rng = random.Random(args.seed + user)
+    client = login(base_url, recorder, args.username, args.password)
+    if client is None:
+        return
+    names, weights = zip(*args.mix.items())
+    while time.perf_counter() < deadline and budget.take():
+        endpoint = rng.choices(names, weights)[0]
+        # คำถามซ้ำกันได้ (response cache) ตามจำนวนคำถามที่ไม่ซ้ำ - 0 คือไม่ซ้ำเลย
+        n = rng.randrange(1, args.distinct_questions + 1) if args.distinct_questions else rng.randrange(1, args.sheet_rows)
+        template = QUESTION_TEMPLATES[n % len(QUESTION_TEMPLATES)]
+        question = template.format(n=n % args.sheet_rows or 1)
+        if not args.distinct_questions:
+            question += f" ({user}-{rng.random():.6f})"
+        started = time.perf_counter()
+        try:
+            if endpoint == 'chat':
+                result = chat(client, base_url, question)
+            elif endpoint == 'stream':
+                result = chat_stream(client, base_url, question, recorder, started)
+            else:
+                result = outcome(client.get(f"{base_url}/api/dashboard-stats", timeout=60))
+        except (requests.RequestException, ValueError):
+            result = 'error'
+        recorder.add(endpoint, time.perf_counter() - started, result)
+
+
+class Budget:
+    """Shared request budget (None = unlimited)"""
+
+    def __init__(self, total):
+        self.remaining = total
+        self._lock = threading.Lock()
+
+    def take(self):
+        if self.remaining is None:
+            return True
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def start_upstreams(args):
+    port = free_port()
+    command = [sys.executable, os.path.join(ROOT, 'bench', 'fake_upstreams.py'), '--port', str(port),
+               '--model-latency', str(args.model_latency), '--token-interval', str(args.token_interval),
+               '--answer-tokens', str(args.answer_tokens), '--sheet-rows', str(args.sheet_rows),
+               '--escaped-every', str(args.escaped_every)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process, port
+
+
+def start_app(args, upstream_port):
+    port = free_port()
+    env = dict(os.environ,
+               CHAT_API_URL=f"http://127.0.0.1:{upstream_port}/api/generate",
+               GOOGLE_SHEETS_BASE_URL=f"http://127.0.0.1:{upstream_port}/sheets",
+               LOG_LEVEL='WARNING')
+    process = subprocess.Popen(SERVER_COMMANDS[args.server](port, args.workers), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def server_stages(base_url, args):
+    """Per-stage percentiles from /api/metrics (the worker that answered this request)"""
+    client = requests.Session()
+    client.post(f"{base_url}/api/login", json={'username': args.username, 'password': args.password}, timeout=30)
+    try:
+        return client.get(f"{base_url}/api/metrics", timeout=30).json().get('stages_ms', [])
+    except (requests.RequestException, ValueError):
+        return []
+
+
+def run(args, base_url):
+    recorder = Recorder()
+    if not args.cold:
+        # อุ่น cache ของชีตและโหลดโมเดลก่อนวัดผล (ไม่นับในผลลัพธ์)
+        client = login(base_url, Recorder(), args.username, args.password)
+        if client is None:
+            raise SystemExit(f"login as {args.username} failed")
+        chat(client, base_url, 'SD00001')
+
+    budget = Budget(args.requests)
+    started = time.perf_counter()
+    deadline = started + args.duration
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda user: virtual_user(user, args, base_url, recorder, deadline, budget),
+                      range(args.concurrency)))
+    wall = time.perf_counter() - started
+    return recorder, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='load an already running app instead of starting one')
+    parser.add_argument('--server', choices=sorted(SERVER_COMMANDS), default='sync')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=8, help='virtual users')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds')
+    parser.add_argument('--requests', type=int, help='stop after this many requests in total')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('chat=7,stream=2,dashboard=1'))
+    parser.add_argument('--distinct-questions', type=int, default=200, help='0 = every question unique (no cache hits)')
+    parser.add_argument('--cold', action='store_true', help='skip the warm-up chat')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    upstream = parser.add_argument_group('fake upstreams')
+    upstream.add_argument('--model-latency', type=float, default=0.5)
+    upstream.add_argument('--token-interval', type=float, default=0.02)
+    upstream.add_argument('--answer-tokens', type=int, default=16)
+    upstream.add_argument('--sheet-rows', type=int, default=1000)
+    upstream.add_argument('--escaped-every', type=int, default=10)
+    args = parser.parse_args()
+
+    processes = []
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            upstream_process, upstream_port = start_upstreams(args)
+            processes.append(upstream_process)
+            app_process, base_url = start_app(args, upstream_port)
+            processes.append(app_process)
+        recorder, wall = run(args, base_url)
+        rows = recorder.report(wall)
+        stages = server_stages(base_url, args)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+
+    total = sum(row['ok'] + row['busy'] + row['errors'] for row in rows if row['endpoint'] not in ('login', 'stream_first_token'))
+    if args.json:
+        print(json.dumps({'wall_s': round(wall, 2), 'rps': round(total / wall, 2), 'endpoints': rows,
+                          'server_stages_ms': stages}, ensure_ascii=False, indent=2))
+        return
+
+    target = args.url or f"{args.server} x{args.workers}"
+    print(f"{target}, {args.concurrency} users, {wall:.1f} s, {total} requests, {total / wall:.2f} req/s")
+    print(f"  {'endpoint':<19} {'ok':>6} {'busy':>5} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'req/s':>7}")
+    for row in rows:
+        print(f"  {row['endpoint']:<19} {row['ok']:>6} {row['busy']:>5} {row['errors']:>5} "
+              + ' '.join(f"{'-' if row[key] is None else row[key]:>9}" for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms'))
+              + f" {'-' if row['rps'] is None else row['rps']:>7}")
+    if stages:
+        print("  server stages (one worker's /api/metrics):")
+        for stage in stages:
+            print(f"    {stage['stage']:<17} n={stage['count']:<6} p50 {stage['p50']} ms  p95 {stage['p95']} ms  p99 {stage['p99']} ms")
+
+
+if __name__ == '__main__':
+    main()
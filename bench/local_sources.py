@@ -0,0 +1,89 @@
+"""Query latency and memory of the on-disk data sources at 1M rows.
+
+Writes a service-ticket table as a CSV file and as a SQLite database into a
+temporary LOCAL_DATA_DIR, then times the first load of each backend
+(record offsets for the memory-mapped CSV, the background FTS5 build for SQLite) and a
+set of chat-style lookups through search_sheet_data. Memory is the Python
+heap kept alive by the backend (tracemalloc); the mapped file itself is page
+cache, not heap.
+
+    python bench/local_sources.py --rows 1000000
+"""
+import argparse
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app
+from sheet_memory import build_ticket_sheet
+
+QUERIES = ['SD-2567-00042', 'บริษัท ลูกค้า2999 จำกัด', 'ลูกค้าขอเลื่อนนัด ภูเก็ต', 'ช่าง7 ซ่อมบำรุง', 'ไม่มีในข้อมูล']
+
+
+def write_sources(directory, rows):
+    content = build_ticket_sheet(rows)
+    csv_path = os.path.join(directory, 'tickets.csv')
+    with open(csv_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+    lines = content.splitlines()
+    header = lines[0].split(',')
+    connection = sqlite3.connect(os.path.join(directory, 'tickets.sqlite'))
+    columns = ', '.join(f'"{column}" TEXT' for column in header)
+    connection.execute(f'CREATE TABLE tickets ({columns})')
+    connection.executemany(
+        f"INSERT INTO tickets VALUES ({', '.join('?' * len(header))})",
+        (line.split(',') for line in lines[1:])
+    )
+    connection.commit()
+    connection.close()
+    return len(content)
+
+
+def measure(label, source):
+    tracemalloc.start()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.set_data_sources([source])
+        backend = app.get_disk_sources()[0]
+        if isinstance(backend, app.SQLiteBackend) and app.SQLITE_BUILD_FTS:
+            backend.fts_ready.wait()
+        rows = len(backend)
+    load = time.perf_counter() - started
+    heap, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}: {rows} rows, first load {load * 1000:8.1f} ms, heap kept {heap / 2**20:6.2f} MiB")
+
+    for query in QUERIES:
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            result = app.search_sheet_data(query)
+            elapsed = time.perf_counter() - started
+        hits = 0 if result.startswith('ไม่พบ') else result.count('\n') + 1
+        print(f"  {query:<28} {elapsed * 1000:8.1f} ms  {hits} rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        size = write_sources(directory, args.rows)
+        print(f"{args.rows} rows, {size / 2**20:.0f} MiB CSV")
+        app.LOCAL_DATA_DIR = directory
+        app.SQLITE_FTS_DIR = os.path.join(directory, 'fts')
+        measure('csv (mmap)', {'type': 'csv', 'path': 'tickets.csv', 'mode': 'mmap', 'label': 'งาน'})
+        measure('sqlite (fts5)', {'type': 'sqlite', 'path': 'tickets.sqlite', 'table': 'tickets', 'label': 'งาน'})
+
+
+if __name__ == '__main__':
+    main()
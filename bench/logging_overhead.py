@@ -0,0 +1,107 @@
+"""Per-request cost of logging on the chat search path.
+
+Runs prepare_chat_turn + chat_result (sheet search, context packing,
+response cache) over a cached synthetic sheet with the log output going to
+a line-buffered file, and reports CPU time per request on the request
+thread and for the whole process (CPU time, not wall time, so a noisy
+machine does not swamp differences of a few microseconds), under:
+
+    off          logger above CRITICAL - the floor every mode is compared to
+    print storm  every DEBUG line written synchronously by the request thread,
+                 which is what the old [DEBUG] prints did under gunicorn
+    debug queue  DEBUG through the queue handler (writes on the listener thread)
+    info queue   the default: INFO through the queue handler
+
+    python bench/logging_overhead.py --requests 1000 --rounds 5
+"""
+import argparse
+import gc
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app
+from fake_upstreams import build_sheet_csv
+
+QUESTIONS = ['ลูกค้า42 อยู่จังหวัดอะไร', 'SD00137', 'ยอดขายของลูกค้า999', 'ลูกค้าในภูเก็ต', 'ขอดูข้อมูล 5 แถว']
+
+
+def run_requests(count):
+    """``(request-thread CPU, whole-process CPU)`` seconds per request.
+
+    Thread CPU is what a request pays itself; process CPU adds the listener
+    thread's formatting and writing, which competes for the GIL and cores.
+    """
+    gc.collect()
+    gc.disable()
+    thread_started, process_started = time.thread_time(), time.process_time()
+    for i in range(count):
+        turn = app.prepare_chat_turn(QUESTIONS[i % len(QUESTIONS)])
+        app.chat_result(turn, 'คำตอบทดสอบ')
+    app.stop_logging()  # รวมเวลาที่ listener เขียนคิวที่เหลือ
+    thread_cpu = time.thread_time() - thread_started
+    process_cpu = time.process_time() - process_started
+    gc.enable()
+    return thread_cpu / count, process_cpu / count
+
+
+def use_sync_handler(stream):
+    """The old behaviour: format and write each line in the request thread"""
+    app.stop_logging()
+    for handler in list(app.logger.handlers):
+        app.logger.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('[DEBUG] %(message)s'))
+    app.logger.addHandler(handler)
+    app.logger.setLevel(logging.DEBUG)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # line-buffered เหมือน stdout ของ worker: เขียนทุกบรรทัด
+        log_file = open(os.path.join(directory, 'app.log'), 'w', encoding='utf-8', buffering=1)
+        app.configure_logging(level='CRITICAL', stream=log_file)
+        app.set_data_sources([{'type': 'sheets', 'sheet_id': 'bench', 'gid': '0', 'label': 'bench'}])
+        app.cache_sheet_csv('bench', '0', build_sheet_csv(args.rows))
+        app.app_settings['sheet_cache_ttl'] = 10 ** 9
+        run_requests(50)
+
+        modes = [
+            ('off', lambda: app.configure_logging(level='CRITICAL', stream=log_file)),
+            ('print storm', lambda: use_sync_handler(log_file)),
+            ('debug queue', lambda: app.configure_logging(level='DEBUG', stream=log_file)),
+            ('info queue', lambda: app.configure_logging(level='INFO', stream=log_file)),
+        ]
+        # รอบสลับกันหลายรอบ แล้วใช้ค่าที่ดีที่สุดของแต่ละโหมด (ลดผลของ noise)
+        results = {}
+        for _ in range(args.rounds):
+            for label, setup in modes:
+                setup()
+                thread_cpu, process_cpu = run_requests(args.requests)
+                best = results.get(label, (thread_cpu, process_cpu))
+                results[label] = (min(best[0], thread_cpu), min(best[1], process_cpu))
+
+        floor_thread, floor_process = results['off']
+        print(f"{args.requests} requests over {args.rows} rows, log lines per request: "
+              f"{sum(1 for _ in open(log_file.name, encoding='utf-8')) / (2 * args.rounds * args.requests):.1f} at DEBUG")
+        print(f"  {'mode':<12} {'request thread us':>18} {'overhead':>9} {'whole process us':>17} {'overhead':>9}")
+        for label, (thread_cpu, process_cpu) in results.items():
+            print(f"  {label:<12} {thread_cpu * 1e6:18.1f} {(thread_cpu - floor_thread) * 1e6:9.1f} "
+                  f"{process_cpu * 1e6:17.1f} {(process_cpu - floor_process) * 1e6:9.1f}")
+        log_file.close()
+        app.configure_logging()
+
+
+if __name__ == '__main__':
+    main()
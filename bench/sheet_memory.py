@@ -0,0 +1,86 @@
+"""Memory per 10k rows: list-of-lists rows vs the columnar SheetSnapshot.
+
+Parses the same synthetic Thai sheets both ways and measures the memory each
+representation keeps alive (tracemalloc), plus build time and the cost of
+reading every cell back.
+
+    python bench/sheet_memory.py --rows 10000
+"""
+import argparse
+import contextlib
+import gc
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from app import SheetSnapshot, parse_sheet_csv
+from fake_upstreams import build_sheet_csv
+
+PROVINCES = ['กรุงเทพมหานคร', 'เชียงใหม่', 'ขอนแก่น', 'ภูเก็ต', 'สงขลา', 'ชลบุรี']
+STATUSES = ['รอดำเนินการ', 'กำลังดำเนินการ', 'เสร็จสิ้น', 'ยกเลิก']
+CATEGORIES = ['ติดตั้ง', 'ซ่อมบำรุง', 'ตรวจเช็ค', 'เปลี่ยนอะไหล่', 'ให้คำปรึกษา']
+
+
+def build_ticket_sheet(rows):
+    """Service-ticket sheet: unique ids and customers, repeated statuses/provinces/dates"""
+    lines = ['รหัสงาน,ลูกค้า,จังหวัด,ประเภทงาน,สถานะ,ผู้รับผิดชอบ,วันที่รับเรื่อง,ค่าบริการ,หมายเหตุ']
+    for i in range(1, rows):
+        lines.append(','.join([
+            f'SD-2567-{i:05d}', f'บริษัท ลูกค้า{i % 3000} จำกัด', PROVINCES[i % len(PROVINCES)],
+            CATEGORIES[i % len(CATEGORIES)], STATUSES[i * 7 % len(STATUSES)], f'ช่าง{i % 25}',
+            f'{i % 28 + 1:02d}/{i % 12 + 1:02d}/2567', str(i * 37 % 5000), '' if i % 4 else 'ลูกค้าขอเลื่อนนัด'
+        ]))
+    return '\n'.join(lines) + '\n'
+
+
+def retained(build, content):
+    """(object, bytes kept alive after build, build seconds)"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        obj = build(content)
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, size, elapsed
+
+
+def read_all(rows):
+    started = time.perf_counter()
+    for row in rows:
+        for cell in row:
+            pass
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+
+    sheets = [
+        ('customers (4 cols)', build_sheet_csv(args.rows)),
+        ('tickets (9 cols)', build_ticket_sheet(args.rows)),
+    ]
+    scale = 10000 / args.rows
+    for label, content in sheets:
+        rows, rows_bytes, rows_time = retained(parse_sheet_csv, content)
+        snapshot, snapshot_bytes, snapshot_time = retained(SheetSnapshot.from_csv, content)
+        assert [list(row) for row in snapshot] == rows
+        print(f"{label}: {len(rows)} rows, {len(content) / 1024:.0f} KiB CSV")
+        print(f"  list of rows : {rows_bytes * scale / 2**20:7.2f} MiB per 10k rows  "
+              f"build {rows_time * 1000:6.1f} ms  read all {read_all(rows) * 1000:6.1f} ms")
+        print(f"  SheetSnapshot: {snapshot_bytes * scale / 2**20:7.2f} MiB per 10k rows  "
+              f"build {snapshot_time * 1000:6.1f} ms  read all {read_all(snapshot) * 1000:6.1f} ms  "
+              f"({rows_bytes / snapshot_bytes:.1f}x smaller, {snapshot.stats()['distinct_values']} distinct values)")
+        del rows, snapshot
+
+
+if __name__ == '__main__':
+    main()
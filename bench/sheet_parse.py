@@ -0,0 +1,105 @@
+"""Before/after timing of parse_sheet_csv on synthetic Thai sheets.
+
+The legacy parser cleans every cell with clean_thai_text in a Python double
+loop and prints the first rows on each fetch; the current one returns cells
+untouched when the buffer has no \\u escapes and otherwise decodes each
+escape-bearing column with one codec call. Each scenario checks that both
+parsers return the same rows.
+
+    python bench/sheet_parse.py --rows 5000 --cols 10
+"""
+import argparse
+import contextlib
+import csv
+import io
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from app import clean_thai_text, parse_sheet_csv
+
+THAI_WORDS = ['กรุงเทพมหานคร', 'เชียงใหม่', 'ขอนแก่น', 'ลูกค้า', 'สาขา', 'ดำเนินการ', 'เสร็จสิ้น', 'รอตรวจสอบ', 'ซ่อมบำรุง']
+
+
+def legacy_parse_sheet_csv(csv_content):
+    """parse_sheet_csv before the bulk escape path (reference output and timing)"""
+    reader = csv.reader(io.StringIO(csv_content))
+    data = []
+    for row_num, row in enumerate(reader):
+        cleaned_row = []
+        for cell in row:
+            if cell:
+                cleaned_row.append(clean_thai_text(cell))
+            else:
+                cleaned_row.append(cell)
+        data.append(cleaned_row)
+        if row_num < 3:
+            print(f"[DEBUG] Row {row_num + 1} (original): {row}")
+            print(f"[DEBUG] Row {row_num + 1} (cleaned): {cleaned_row}")
+    return data
+
+
+def escape_text(text):
+    return ''.join(f'\\u{ord(ch):04x}' if ord(ch) > 127 else ch for ch in text)
+
+
+def build_sheet(rows, cols, escaped_cols, seed=1):
+    """CSV with Thai text; the first ``escaped_cols`` columns hold \\uXXXX escapes instead"""
+    rng = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow([f'คอลัมน์{c}' for c in range(cols)])
+    for r in range(1, rows):
+        row = []
+        for c in range(cols):
+            if c % 3 == 2:
+                cell = f'SD{r:05d}-{c}'
+            else:
+                cell = f'{rng.choice(THAI_WORDS)} {rng.choice(THAI_WORDS)} {r}'
+            row.append(escape_text(cell) if c < escaped_cols else cell)
+        writer.writerow(row)
+    return out.getvalue()
+
+
+def time_parse(fn, content, repeat):
+    samples = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            fn(content)
+            samples.append(time.perf_counter() - started)
+    return min(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--cols', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    scenarios = [
+        ('no escapes', 0),
+        ('2 escaped columns', 2),
+        ('all columns escaped', args.cols),
+    ]
+    failed = False
+    print(f"{args.rows} rows x {args.cols} cols = {args.rows * args.cols} cells")
+    for label, escaped_cols in scenarios:
+        content = build_sheet(args.rows, args.cols, escaped_cols)
+        with contextlib.redirect_stdout(io.StringIO()):
+            same = legacy_parse_sheet_csv(content) == parse_sheet_csv(content)
+        before = time_parse(legacy_parse_sheet_csv, content, args.repeat)
+        after = time_parse(parse_sheet_csv, content, args.repeat)
+        print(f"{label:>20}: before {before * 1000:8.1f} ms  after {after * 1000:8.1f} ms  "
+              f"speedup {before / after:5.1f}x  {'same output' if same else 'OUTPUT DIFFERS'}")
+        failed = failed or not same
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
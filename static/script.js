@@ -230,7 +230,7 @@ async function handleChatMessage(e) {
     const typingId = addTypingIndicator('chat-messages');
     
     try {
-        const response = await fetch('/api/chat', {
+        const response = await fetch('/api/chat/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -238,9 +238,14 @@ async function handleChatMessage(e) {
             body: JSON.stringify({ message })
         });
         
+        if (response.ok && response.body && (response.headers.get('Content-Type') || '').includes('ndjson')) {
+            await readChatStream(response, typingId);
+            return;
+        }
+        
         const result = await response.json();
         
-        if (response.ok) {
+        if (response.ok && result.response) {
             addChatMessage(result.response, 'bot');
         } else {
             addChatMessage(result.error || 'เกิดข้อผิดพลาดในการประมวลผล', 'bot');
@@ -253,6 +258,50 @@ async function handleChatMessage(e) {
     }
 }
 
+// Read NDJSON events from /api/chat/stream and render tokens as they arrive
+async function readChatStream(response, typingId) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    let text = '';
+    let messageDiv = null;
+    
+    const handleEvent = (event) => {
+        if (event.type === 'token') {
+            text += event.text;
+            if (!messageDiv) {
+                removeTypingIndicator(typingId);
+                messageDiv = addChatMessage(text, 'bot');
+            } else {
+                updateChatMessage(messageDiv, text);
+            }
+        } else if (event.type === 'done') {
+            console.log('Chat stream done - TTFT:', event.ttft_ms, 'ms, total:', event.total_ms, 'ms');
+            if (!messageDiv) {
+                messageDiv = addChatMessage(event.response, 'bot');
+            } else {
+                updateChatMessage(messageDiv, event.response);
+            }
+        } else if (event.type === 'error') {
+            addChatMessage(event.error || 'เกิดข้อผิดพลาดในการประมวลผล', 'bot');
+        }
+    };
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+    }
+    
+    if (buffer.trim()) {
+        handleEvent(JSON.parse(buffer));
+    }
+}
+
 async function handleAdminMessage(e) {
     e.preventDefault();
     
@@ -326,6 +375,16 @@ function addChatMessage(message, sender) {
     
     // Re-initialize icons
     lucide.createIcons();
+    
+    return messageDiv;
+}
+
+function updateChatMessage(messageDiv, message) {
+    const content = messageDiv.querySelector('.message-content');
+    content.innerHTML = escapeHtml(message).replace(/\n/g, '<br>');
+    
+    const chatMessages = document.getElementById('chat-messages');
+    chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
 function addAdminMessage(message, sender) {
@@ -0,0 +1,50 @@
+import copy
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as core  # noqa: E402
+
+core.configure_logging(level='CRITICAL')
+
+
+def sheet_csv(rows, edits=None):
+    """Customer sheet CSV with ``rows`` rows (header included); ``edits`` maps row number -> name"""
+    provinces = ['กรุงเทพมหานคร', 'เชียงใหม่', 'ขอนแก่น', 'ภูเก็ต', 'สงขลา']
+    lines = ['ชื่อ,รหัส,จังหวัด,ยอดขาย']
+    for i in range(1, rows):
+        name = (edits or {}).get(i, f"ลูกค้า{i}")
+        lines.append(f"{name},SD{i:05d},{provinces[i % len(provinces)]},{i * 37 % 10000}")
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(monkeypatch):
+    """Each test starts from the import-time settings, model pool, scheduler and caches"""
+    settings = copy.deepcopy(core.app_settings)
+    scheduler = (core.model_scheduler.max_queue, core.model_scheduler.queue_timeout)
+    log_level = core.logger.level
+    # ไม่ยิงคำขอ warm-up ไปยัง host จริง
+    monkeypatch.setattr(core, 'warm_model_async', lambda *args, **kwargs: None)
+    yield
+    core.app_settings.clear()
+    core.app_settings.update(settings)
+    core.set_model_backends(settings['model_backends'])
+    core.model_scheduler.configure(max_queue=scheduler[0], queue_timeout=scheduler[1])
+    core.logger.setLevel(log_level)
+    core.set_data_sources(settings['data_sources'])
+    core.invalidate_sheet_cache()
+    with core._search_index_lock:
+        core._search_indexes.clear()
+
+
+@pytest.fixture
+def client():
+    """Flask test client with a logged-in session"""
+    client = core.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    return client
@@ -0,0 +1,58 @@
+import app as core
+
+USERS_CSV = 'ชื่อผู้ใช้,รหัสผ่าน\nsomchai,secret1\nsuda,secret2\nshared,first\nshared,second\n'
+
+
+def snapshot(csv_content):
+    return core.SheetSnapshot.from_csv(csv_content)
+
+
+def test_verify():
+    store = core.CredentialStore(snapshot(USERS_CSV))
+    assert store.verify('somchai', 'secret1') == 1
+    assert store.verify('somchai', 'secret2') is None
+    assert store.verify('nobody', 'secret1') is None
+    # ชื่อซ้ำ - รหัสของแถวใดก็ได้
+    assert store.verify('shared', 'second') == 4
+
+
+def test_row_digests_are_computed_once():
+    store = core.CredentialStore(snapshot(USERS_CSV))
+    computed = core.login_stats['hashes_computed']
+    for _ in range(3):
+        store.verify('suda', 'secret2')
+    store.verify('nobody', 'x')
+    assert core.login_stats['hashes_computed'] == computed + 1
+    assert store.stats()['hashed_rows'] == 1
+
+
+def test_incremental_refresh_keeps_digests_of_unchanged_rows():
+    previous_data = snapshot(USERS_CSV)
+    previous = core.CredentialStore(previous_data)
+    previous.verify('somchai', 'secret1')
+    previous.verify('suda', 'secret2')
+
+    data = snapshot(USERS_CSV.replace('suda,secret2', 'suda,changed'))
+    core._apply_snapshot_change(('users', '0'), previous_data, data, stats=dict.fromkeys(
+        ('incremental_refreshes', 'full_refreshes', 'rows_changed'), 0))
+    store = core.CredentialStore(data, previous=previous)
+    assert store.patched
+    assert set(store.hashes) == {1}
+    assert store.verify('suda', 'secret2') is None
+    assert store.verify('suda', 'changed') == 2
+
+
+def test_authenticate_user_caches_failures_per_snapshot():
+    core.app_settings['google_sheet_id'] = 'users-sheet'
+    core.app_settings['sheet_cache_ttl'] = 10 ** 9
+    core.cache_sheet_csv('users-sheet', '0', USERS_CSV)
+    negative_hits = core.login_stats['negative_hits']
+    assert not core.authenticate_user('somchai', 'wrong')
+    assert not core.authenticate_user('somchai', 'wrong')
+    assert core.login_stats['negative_hits'] == negative_hits + 1
+    assert core.authenticate_user('somchai', 'secret1')
+
+    # ชีตเปลี่ยน - ความล้มเหลวที่จำไว้ใช้ไม่ได้แล้ว
+    core.cache_sheet_csv('users-sheet', '0', USERS_CSV.replace('secret1', 'wrong'))
+    assert core.authenticate_user('somchai', 'wrong')
+    assert core.login_stats['negative_hits'] == negative_hits + 1
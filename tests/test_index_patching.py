@@ -0,0 +1,98 @@
+import threading
+from collections import defaultdict
+
+import app as core
+from conftest import sheet_csv
+
+SHEET = {'type': 'sheets', 'sheet_id': 'sheet-a', 'gid': '0', 'label': 'a'}
+OTHER_SHEET = {'type': 'sheets', 'sheet_id': 'sheet-b', 'gid': '0', 'label': 'b'}
+
+
+def postings(index):
+    return (
+        {term: list(rows) for term, rows in index.postings.items()},
+        {term: list(rows) for term, rows in index.token_postings.items()}
+    )
+
+
+def assert_same_as_fresh_build(index):
+    """A patched index holds what a fresh build of its snapshot would"""
+    fresh = core.SheetIndex(index.data, index.tokenizer.name)
+    assert index.haystacks == fresh.haystacks
+    assert postings(index)[0] == postings(fresh)[0]
+    # token ขึ้นกับ dictionary ที่ tokenizer เรียนรู้ไว้ - เทียบกับการตัดคำแถวด้วย tokenizer เดียวกัน
+    expected = defaultdict(list)
+    lengths = []
+    for row in range(len(index.data)):
+        tokens = index._row_terms(index.data, row)[1]
+        lengths.append(len(tokens))
+        for term in tokens:
+            expected[term].append(row)
+    assert postings(index)[1] == dict(expected)
+    assert list(index.row_lengths) == lengths
+    assert index.total_length == sum(lengths)
+
+
+def load(sources, **sheets):
+    core.app_settings['sheet_cache_ttl'] = 10 ** 9
+    core.set_data_sources(sources)
+    for sheet_id, csv_content in sheets.items():
+        core.cache_sheet_csv(sheet_id.replace('_', '-'), '0', csv_content)
+    return core.get_sources_search_index()
+
+
+def test_small_refresh_patches_the_index():
+    index = load([SHEET], sheet_a=sheet_csv(500))
+    patches = core.search_stats['index_patches']
+    core.cache_sheet_csv('sheet-a', '0', sheet_csv(500, {10: 'ลูกค้าใหม่'}) + "ลูกค้าเพิ่ม,SD99999,ภูเก็ต,1\n")
+    patched = core.get_sources_search_index()
+    assert patched is not index
+    assert core.search_stats['index_patches'] == patches + 1
+    assert_same_as_fresh_build(patched)
+    assert patched.search('ลูกค้าใหม่', 5) == [10]
+    assert patched.search('ลูกค้าเพิ่ม', 5) == [500]
+    # index เดิมยังตอบตาม snapshot เดิม (copy-on-write)
+    assert index.search('ลูกค้าใหม่', 5) == []
+
+
+def test_large_refresh_rebuilds_the_index():
+    load([SHEET], sheet_a=sheet_csv(200))
+    builds = core.search_stats['index_builds']
+    core.cache_sheet_csv('sheet-a', '0', sheet_csv(200, {i: f"คนใหม่{i}" for i in range(1, 200)}))
+    index = core.get_sources_search_index()
+    assert core.search_stats['index_builds'] == builds + 1
+    assert index.search('คนใหม่7', 5)
+
+
+def test_merged_index_patches_the_changed_part():
+    merged = load([SHEET, OTHER_SHEET], sheet_a=sheet_csv(300), sheet_b=sheet_csv(200))
+    assert isinstance(merged.data, core.SourceSet)
+    patches = core.search_stats['index_patches']
+    core.cache_sheet_csv('sheet-b', '0', sheet_csv(200, {5: 'ลูกค้าใหม่'}))
+    patched = core.get_sources_search_index()
+    assert core.search_stats['index_patches'] == patches + 1
+    assert_same_as_fresh_build(patched)
+    # แถวของแท็บที่สองต่อจากแถวของแท็บแรก
+    assert patched.search('ลูกค้าใหม่', 5) == [300 + 5]
+
+
+def test_merged_rebuild_is_counted():
+    load([SHEET], sheet_a=sheet_csv(100))
+    builds = core.search_stats['index_builds']
+    load([SHEET, OTHER_SHEET], sheet_b=sheet_csv(100))
+    assert core.search_stats['index_builds'] > builds
+
+
+def test_concurrent_index_requests_share_one_build():
+    core.app_settings['sheet_cache_ttl'] = 10 ** 9
+    core.set_data_sources([SHEET])
+    core.cache_sheet_csv('sheet-a', '0', sheet_csv(5000))
+    builds = core.search_stats['index_builds']
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(core.get_sources_search_index())) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert len({id(index) for index in results}) == 1
+    assert core.search_stats['index_builds'] == builds + 1
@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app as core
+
+
+@pytest.fixture
+def upstream():
+    """Start local Ollama stand-ins: ``upstream(status)`` returns the base URL and records the requests"""
+    servers = []
+    requests_seen = []
+
+    def start(status):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                requests_seen.append((self.server.server_port, self.path, body))
+                if status == 200 and self.path == '/api/embed':
+                    payload = {'embeddings': [[1.0, 0.0]] * len(body['input'])}
+                else:
+                    payload = {'message': {'role': 'assistant', 'content': 'ตอบ'}, 'done': True}
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps(payload).encode())
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}"
+
+    start.requests = requests_seen
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_health_monitor(monkeypatch):
+    # stand-in ไม่มี /api/tags - ไม่ให้ health probe พัก backend ระหว่างทดสอบ
+    monkeypatch.setattr(core.model_pool, '_monitor_pid', os.getpid())
+
+
+@pytest.mark.parametrize('backends, message', [
+    ('http://127.0.0.1:9', 'รายการของ object'),
+    ([{'url': 'ftp://host', 'model': 'm'}], 'url'),
+    ([{'url': 'http://host', 'model': 'm', 'role': 'judge'}], 'role'),
+    ([{'url': 'http://host', 'model': 'm', 'role': 'small'}], 'role chat'),
+])
+def test_invalid_backend_lists_are_rejected(backends, message):
+    with pytest.raises(ValueError, match=message):
+        core.normalize_model_backends(backends)
+
+
+def test_backend_urls_are_normalized():
+    normalized = core.normalize_model_backends([{'url': 'http://host:11434/api/generate', 'model': 'm'}])
+    assert normalized == [{'url': 'http://host:11434', 'model': 'm', 'role': 'chat',
+                           'max_in_flight': core.MODEL_MAX_IN_FLIGHT}]
+
+
+def test_post_model_chat_fails_over_and_ejects_a_failing_backend(upstream):
+    failing, healthy = upstream(500), upstream(200)
+    core.set_model_backends([{'url': failing, 'model': 'a'}, {'url': healthy, 'model': 'b'}])
+    # least_outstanding เลือกสุ่มระหว่าง backend ที่ว่างเท่ากัน - เรียกพอให้ตัวที่เสียถูกเลือกครบจนถูกพัก
+    for _ in range(30):
+        status, result = core.post_model_chat(core.build_model_payload('สวัสดี'))
+        assert status == 200
+        assert result['message']['content'] == 'ตอบ'
+    backend = {backend.model: backend for backend in core.model_pool.backends}
+    assert backend['a'].failures == core.MODEL_EJECT_FAILURES
+    assert not backend['a'].available(time.monotonic())
+    assert all(backend.outstanding == 0 for backend in core.model_pool.backends)
+    # แต่ละ backend ได้ชื่อโมเดลของตัวเอง
+    assert {(port, body['model']) for port, _, body in upstream.requests} == {
+        (int(failing.rsplit(':', 1)[1]), 'a'), (int(healthy.rsplit(':', 1)[1]), 'b')
+    }
+
+
+def test_small_role_falls_back_to_chat_backends():
+    core.set_model_backends([{'url': 'http://127.0.0.1:9', 'model': 'big'}])
+    core.app_settings['small_model_routing'] = True
+    assert core.model_role_for('ขอดูข้อมูล 5 แถว') == 'chat'
+    core.set_model_backends([{'url': 'http://127.0.0.1:9', 'model': 'big'},
+                             {'url': 'http://127.0.0.1:9', 'model': 'tiny', 'role': 'small'}])
+    assert core.model_role_for('ขอดูข้อมูล 5 แถว') == 'small'
+    assert core.model_pool.models_for('small') == ['big', 'tiny']
+    tried = []
+    for backend in core.model_pool.failover('small'):
+        tried.append(backend.model)
+        core.model_pool.release(backend, time.perf_counter())
+    assert tried == ['tiny', 'big']
+
+
+def test_model_params_are_sent_as_ollama_options(upstream):
+    core.set_model_backends([{'url': upstream(200), 'model': 'm'}])
+    core.app_settings['model_params'] = {'temperature': 0.1, 'max_tokens': 64, 'top_p': 0.5}
+    core.post_model_chat(core.build_model_payload('สวัสดี'))
+    assert upstream.requests[-1][2]['options'] == {'temperature': 0.1, 'top_p': 0.5, 'num_predict': 64}
+
+
+def test_embeddings_use_the_configured_pool(upstream):
+    missing_model, healthy = upstream(404), upstream(200)
+    core.set_model_backends([{'url': missing_model, 'model': 'a'}, {'url': healthy, 'model': 'b'}])
+    # เลือกสุ่มว่าจะลองตัวไหนก่อน - เรียกพอให้ได้ลองตัวที่ตอบ 404 ด้วย
+    for _ in range(20):
+        assert core.OllamaEmbedder().embed(['ลูกค้า1', 'ลูกค้า2']).shape == (2, 2)
+    assert {port for port, _, _ in upstream.requests} == {int(missing_model.rsplit(':', 1)[1]), int(healthy.rsplit(':', 1)[1])}
+    assert all(path == '/api/embed' for _, path, _ in upstream.requests)
+    # 404 (ไม่มี embedding model) ไม่นับเป็นความเสียของ backend แชท
+    assert all(backend.failures == 0 for backend in core.model_pool.backends)
+    assert core.model_scheduler.in_flight == 0
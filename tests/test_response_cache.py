@@ -0,0 +1,58 @@
+import app as core
+
+
+def test_key_ignores_polite_particles_and_punctuation():
+    cache = core.ResponseCache()
+    assert cache.make_key('ยอดขายของลูกค้า1 ครับ?', 'ctx') == cache.make_key('ยอดขายของลูกค้า1', 'ctx')
+
+
+def test_key_changes_with_context_prompt_role_and_model_params():
+    cache = core.ResponseCache()
+    keys = [
+        cache.make_key('ยอดขาย', 'ctx'),
+        cache.make_key('ยอดขาย', 'ctx2'),
+        cache.make_key('ยอดขาย', 'ctx', role='small')
+    ]
+    core.app_settings['model_params'] = dict(core.app_settings['model_params'], temperature=0.9)
+    keys.append(cache.make_key('ยอดขาย', 'ctx'))
+    core.app_settings['system_prompt'] += ' ตอบสั้นๆ'
+    keys.append(cache.make_key('ยอดขาย', 'ctx'))
+    assert len(set(keys)) == len(keys)
+
+
+def test_key_changes_with_the_backend_models():
+    cache = core.ResponseCache()
+    key = cache.make_key('ยอดขาย', 'ctx')
+    core.set_model_backends([{'url': 'http://127.0.0.1:9', 'model': 'other-model'}])
+    assert cache.make_key('ยอดขาย', 'ctx') != key
+
+
+def test_error_answers_are_not_cached():
+    cache = core.ResponseCache()
+    for response in core.AI_ERROR_RESPONSES:
+        cache.put('key', response)
+        assert cache.get('key') is None
+
+
+def test_lru_and_ttl():
+    cache = core.ResponseCache(max_entries=2, ttl=600)
+    cache.put('a', 'A')
+    cache.put('b', 'B')
+    cache.get('a')
+    cache.put('c', 'C')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert cache.stats()['evictions'] == 1
+
+    expired = core.ResponseCache(ttl=-1)
+    expired.put('a', 'A')
+    assert expired.get('a') is None
+
+
+def test_evict_containing_drops_only_answers_quoting_changed_rows():
+    cache = core.ResponseCache()
+    cache.put('a', 'A', context='แถวที่ 2: ลูกค้า1 | SD00001')
+    cache.put('b', 'B', context='แถวที่ 3: ลูกค้า2 | SD00002')
+    assert cache.evict_containing(['ลูกค้า1 | SD00001', '']) == 1
+    assert cache.get('a') is None
+    assert cache.get('b') == 'B'
@@ -0,0 +1,95 @@
+import copy
+
+import pytest
+
+import app as core
+
+
+def current_config():
+    return (
+        copy.deepcopy(core.app_settings),
+        [backend.key for backend in core.model_pool.backends],
+        core.model_scheduler.max_in_flight,
+        core.logger.level
+    )
+
+
+def test_settings_require_login():
+    assert core.app.test_client().post('/api/settings', json={}).status_code == 401
+
+
+@pytest.mark.parametrize('update', [
+    {'search_mode': 'semantic'},
+    {'semantic_search': 'on'},
+    {'embedding_backend': 'openai'},
+    {'log_level': 'loud'},
+    {'fuzzy_threshold': 'high'},
+    {'model_max_in_flight': 'many'},
+])
+def test_invalid_settings_change_nothing(client, update):
+    before = current_config()
+    response = client.post('/api/settings', json={'context_max_rows': 3, 'model_max_queue': 1, **update})
+    assert response.status_code == 400
+    assert response.json['success'] is False
+    assert current_config() == before
+
+
+def test_valid_settings_are_applied(client):
+    response = client.post('/api/settings', json={
+        'search_mode': 'fuzzy',
+        'semantic_search': 'hybrid',
+        'embedding_backend': 'hash',
+        'log_level': 'debug',
+        'model_max_in_flight': 3
+    })
+    assert response.json['success'] is True
+    assert core.app_settings['search_mode'] == 'fuzzy'
+    assert core.app_settings['semantic_search'] == 'hybrid'
+    assert core.app_settings['embedding_backend'] == 'hash'
+    assert core.model_scheduler.max_in_flight == 3
+    assert core.logger.level == 10
+
+
+@pytest.mark.parametrize('update', [
+    {'routing': 'random'},
+    {'backends': 'http://127.0.0.1:9'},
+    {'backends': [{'url': 'http://127.0.0.1:9', 'model': 'm', 'role': 'small'}]},
+    {'temperature': 5},
+    {'top_p': 0},
+    {'max_tokens': 'lots'},
+])
+def test_invalid_ai_config_changes_nothing(client, monkeypatch, update):
+    cleared = []
+    monkeypatch.setattr(core.response_cache, 'clear', lambda reason='': cleared.append(reason))
+    before = current_config()
+    response = client.post('/api/ai-config', json={'system_prompt': 'พรอมต์ใหม่', 'keep_alive': '5m', **update})
+    assert response.status_code == 400
+    assert response.json['success'] is False
+    assert current_config() == before
+    assert not cleared
+
+
+def test_ai_config_applies_everything_together(client, monkeypatch):
+    cleared = []
+    monkeypatch.setattr(core.response_cache, 'clear', lambda reason='': cleared.append(reason))
+    response = client.post('/api/ai-config', json={
+        'system_prompt': 'พรอมต์ใหม่',
+        'routing': 'latency_weighted',
+        'temperature': 0.7,
+        'top_p': 0.9,
+        'max_tokens': 256,
+        'backends': [{'url': 'http://127.0.0.1:9/api/chat', 'model': 'new-model'}]
+    })
+    assert response.json['success'] is True
+    assert core.app_settings['system_prompt'] == 'พรอมต์ใหม่'
+    assert core.app_settings['model_routing'] == 'latency_weighted'
+    assert core.model_pool.primary().key == ('http://127.0.0.1:9', 'new-model')
+    assert cleared == ['system prompt changed']
+    assert core.build_model_payload('คำถาม')['options'] == {'temperature': 0.7, 'top_p': 0.9, 'num_predict': 256}
+    assert client.get('/api/ai-config').json['model_params'] == {'temperature': 0.7, 'max_tokens': 256, 'top_p': 0.9}
+
+
+def test_ai_config_keeps_model_params_that_are_not_sent(client):
+    core.app_settings['model_params'] = {'temperature': 0.2, 'max_tokens': 100, 'top_p': 0.5}
+    assert client.post('/api/ai-config', json={'temperature': 0.4}).json['success'] is True
+    assert core.app_settings['model_params'] == {'temperature': 0.4, 'max_tokens': 100, 'top_p': 0.5}
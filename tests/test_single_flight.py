@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import app as core
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def run_concurrently(flight, fn, callers):
+    """Start one leader, then ``callers - 1`` followers once the leader is inside ``fn``"""
+    results = []
+
+    def call():
+        try:
+            results.append(flight.do('key', fn))
+        except BaseException as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(callers)]
+    threads[0].start()
+    wait_until(lambda: flight.leaders == 1)
+    for thread in threads[1:]:
+        thread.start()
+    wait_until(lambda: flight.coalesced == callers - 1)
+    return threads, results
+
+
+def test_do_coalesces_concurrent_calls():
+    flight = core.SingleFlight('test')
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return 'rows'
+
+    threads, results = run_concurrently(flight, fetch, 5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['rows'] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {'leaders': 1, 'coalesced': 4, 'in_flight': 0}
+
+
+def test_do_shares_the_leader_error():
+    flight = core.SingleFlight('test')
+    release = threading.Event()
+
+    def fetch():
+        release.wait(5)
+        raise ValueError('upstream down')
+
+    threads, results = run_concurrently(flight, fetch, 3)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert all(isinstance(result, ValueError) for result in results)
+    # คำขอถัดไปเริ่มใหม่ ไม่ได้ error เดิม
+    assert flight.do('key', lambda: 'ok') == 'ok'
+
+
+def test_do_followers_fail_when_the_leader_is_interrupted():
+    flight = core.SingleFlight('test')
+    release = threading.Event()
+
+    def fetch():
+        release.wait(5)
+        raise KeyboardInterrupt
+
+    threads, results = run_concurrently(flight, fetch, 3)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert sum(isinstance(result, KeyboardInterrupt) for result in results) == 1
+    assert sum(isinstance(result, core.SingleFlightAborted) for result in results) == 2
+
+
+def test_do_async_coalesces_concurrent_calls():
+    flight = core.SingleFlight('test')
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'answer'
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async('key', fetch) for _ in range(4)))
+
+    assert asyncio.run(main()) == ['answer'] * 4
+    assert len(calls) == 1
+    assert flight.stats()['coalesced'] == 3
+
+
+def test_do_async_shares_the_leader_error():
+    flight = core.SingleFlight('test')
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        raise ValueError('bad chunk')
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async('key', fetch) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(main()))
+
+
+def test_do_async_followers_wake_when_the_leader_is_cancelled():
+    flight = core.SingleFlight('test')
+
+    async def main():
+        started = asyncio.Event()
+
+        async def fetch():
+            started.set()
+            await asyncio.sleep(10)
+
+        leader = asyncio.create_task(flight.do_async('key', fetch))
+        await started.wait()
+        follower = asyncio.create_task(flight.do_async('key', fetch))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(core.SingleFlightAborted):
+            await asyncio.wait_for(follower, 2)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+
+    asyncio.run(main())
+    assert flight.stats()['in_flight'] == 0